@@ -1,31 +1,60 @@
 import os
-import shutil
-import subprocess
 import torch
 import torchaudio
-from fastapi import FastAPI, File, UploadFile, Form
+from fastapi import FastAPI, File, UploadFile, Form, Request
 from models import voicecraft
-from data.tokenizer import AudioTokenizer, TextTokenizer
+from data.tokenizer import AudioTokenizer, TextTokenizer, PhonemeCache, BatchPhonemizer
 from inference_tts_scale import inference_one_sample
+from long_form import AUDIO_FORMATS, encode_audio, synthesize_long_form
+from pretrained import get_model, model_cache_stats
+from voice import save_voice, align_voice, find_prompt, find_voice, encode_voice
+from speech_edit import edit_mask_intervals, edit_one_sample
+from result_cache import ResultCache
+from metrics import StageTimer, queue_depth, render
+from models.modules.profiler import DecodeProfiler
 from pydantic import BaseModel
 import io
-from starlette.responses import StreamingResponse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from starlette.responses import Response, StreamingResponse
+import atexit
+import contextlib
 import getpass
 import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
 import platform
 from huggingface_hub import hf_hub_download
-import requests
 
-# Configure logging
+# Configure logging, records are written to the file and the console by a background thread, so that requests don't wait for the disk
+log_queue = queue.SimpleQueue()
+log_listener = QueueListener(log_queue, logging.FileHandler('api.log'), logging.StreamHandler())
 logging.basicConfig(level=logging.DEBUG,
                     format='%(asctime)s - %(levelname)s - %(message)s',
-                    handlers=[
-                        logging.FileHandler('api.log'),
-                        logging.StreamHandler()
-                    ])
+                    handlers=[QueueHandler(log_queue)])
+log_listener.start()
+atexit.register(log_listener.stop)
 
-app = FastAPI()
+# phonemizer with a process pool for long form requests. the pool is started with the app, before any request thread is running
+batch_phonemizer = None
 
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    global batch_phonemizer
+    batch_phonemizer = BatchPhonemizer(n_workers=min(4, os.cpu_count() or 1), backend="espeak", cache=phoneme_cache)
+    try:
+        yield
+    finally:
+        batch_phonemizer.close()
+
+app = FastAPI(lifespan=lifespan)
+
+# generated codes and audio of seeded requests, so that identical requests (retries, re-renders) don't touch the model again
+result_cache = ResultCache("./result_cache", max_bytes=2 * 1024**3)
+# phonemized prompt transcripts and texts, shared by all requests and kept across restarts
+phoneme_cache = PhonemeCache("./pretrained_models/phoneme_cache.sqlite")
+# responses are encoded off the event loop, so that encoding one overlaps with generating the next
+encode_pool = ThreadPoolExecutor(max_workers=2)
 class AdditionalArgs(BaseModel):
     top_k: int = 0
     top_p: float = 0.9
@@ -40,11 +69,43 @@ def get_available_models():
     models.sort()  # Sort the models alphabetically
     return models
 
+@app.middleware("http")
+async def track_requests(request: Request, call_next):
+    # every request gets a timer for its stages, which are sent back in the Server-Timing header
+    request.state.timer = StageTimer()
+    queue_depth.inc()
+    try:
+        response = await call_next(request)
+    finally:
+        queue_depth.dec()
+    if request.state.timer.timings:
+        response.headers["Server-Timing"] = request.state.timer.server_timing()
+    if getattr(request.state, "profile_trace", None) is not None:
+        response.headers["X-Profile-Trace"] = request.state.profile_trace
+    return response
+
+@app.get("/metrics")
+def get_metrics():
+    model_requests = model_cache_stats["hits"] + model_cache_stats["misses"]
+    content, content_type = render({
+        "model": model_cache_stats["hits"] / model_requests if model_requests > 0 else 0.,
+        "phoneme": phoneme_cache.hit_rate,
+        "result": result_cache.hit_rate,
+    })
+    return Response(content, media_type=content_type)
+
 @app.get("/models")
 def get_models():
     models = get_available_models()
     return {"models": models}
 
+def get_profiler(request, model, name):
+    # Profile the decoding if the request asks for it with an X-Profile: 1 header, the trace is saved in ./profiles
+    if request.headers.get("X-Profile", "0") != "1":
+        return contextlib.nullcontext()
+    os.makedirs("./profiles", exist_ok=True)
+    return DecodeProfiler(model, trace_path=f"./profiles/{name}_{int(request.state.timer.stime * 1000)}_trace.json")
+
 def get_latest_snapshot_dir(model_dir):
     snapshot_dir = os.path.join(model_dir, "snapshots")
     if not os.path.exists(snapshot_dir):
@@ -69,47 +130,9 @@ def get_latest_snapshot_dir(model_dir):
     latest_snapshot_subdir = max(snapshot_subdirs, key=lambda x: os.path.getmtime(os.path.join(snapshot_dir, x)))
     return os.path.join(snapshot_dir, latest_snapshot_subdir)
 
-def get_model(model_name, device=None):
-    
-    model_dir = f"./pretrained_models/{model_name}"
-    config_path = os.path.join(model_dir, "config.json")
-    model_file_path = os.path.join(model_dir, "model.safetensors")
-    
-    if not os.path.exists(model_dir):
-        os.makedirs(model_dir)
-    
-    try:
-        if not os.path.isfile(config_path) or not os.path.isfile(model_file_path):
-            if model_name == "VoiceCraft_830M_TTSEnhanced":
-                base_url = "https://huggingface.co/pyp1/VoiceCraft_830M_TTSEnhanced/resolve/main/"
-            elif model_name == "VoiceCraft_gigaHalfLibri330M_TTSEnhanced_max16s":
-                base_url = "https://huggingface.co/pyp1/VoiceCraft_gigaHalfLibri330M_TTSEnhanced_max16s/resolve/main/"
-            else:
-                raise ValueError(f"Unsupported model: {model_name}")
-
-            # Download config and model files
-            response = requests.get(f"{base_url}config.json")
-            response.raise_for_status()
-            with open(config_path, 'wb') as f:
-                f.write(response.content)
-
-            response = requests.get(f"{base_url}model.safetensors")
-            response.raise_for_status()
-            with open(model_file_path, 'wb') as f:
-                f.write(response.content)
-    except Exception as e:
-        logging.error(f"Failed to download model '{model_name}': {str(e)}")
-        raise
-
-    model = voicecraft.VoiceCraft.from_pretrained(model_dir)
-    if device is None:
-        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    model.to(device)
-    model.eval()
-    return model
-
 @app.post("/generate")
 async def generate_audio(
+    request: Request,
     time: float = Form(...),
     target_text: str = Form(""),
     audio: UploadFile = File(...),
@@ -123,9 +146,19 @@ async def generate_audio(
     kvcache: int = Form(1),
     sample_batch_size: int = Form(4),
     device: str = Form(None),
-    model_name: str = Form("")
+    model_name: str = Form(""),
+    compile_decode: int = Form(0),
+    draft_model_name: str = Form(""),
+    n_draft: int = Form(4),
+    long_form: int = Form(0),
+    rolling_prompt: int = Form(0),
+    seed: int = Form(-1),
+    use_cache: int = Form(1),
+    output_format: str = Form("wav"),
+    output_sr: int = Form(16000)
 ):
     logging.info("Received request to generate audio")
+    timer = request.state.timer
 
     # Get the current username
     username = getpass.getuser()
@@ -140,76 +173,10 @@ async def generate_audio(
         os.environ['PHONEMIZER_ESPEAK_LIBRARY'] = './espeak/libespeak-ng.dll'
         logging.debug("Set PHONEMIZER_ESPEAK_LIBRARY environment variable")
 
-    # Create the voice folder
+    # Read the uploads into memory, they are only written to the voice folder when the voice needs to be aligned
     voice_folder = f"./voices/{os.path.splitext(audio.filename)[0]}"
-    os.makedirs(voice_folder, exist_ok=True)
-    logging.debug(f"Created voice folder: {voice_folder}")
-
-    # Save the uploaded files
-    audio_fn = os.path.join(voice_folder, audio.filename)
-    transcript_fn = os.path.join(voice_folder, f"{os.path.splitext(audio.filename)[0]}.txt")
-    with open(audio_fn, "wb") as f:
-        shutil.copyfileobj(audio.file, f)
-    with open(transcript_fn, "wb") as f:
-        shutil.copyfileobj(transcript.file, f)
-    logging.debug(f"Saved uploaded files: {audio_fn}, {transcript_fn}")
-
-    # Prepare alignment if not already done
-    mfa_folder = os.path.join(voice_folder, "mfa")
-    os.makedirs(mfa_folder, exist_ok=True)
-    alignment_file = os.path.join(mfa_folder, f"{os.path.splitext(audio.filename)[0]}.csv")
-    if not os.path.isfile(alignment_file):
-        logging.info("Preparing alignment...")
-        subprocess.run(["mfa", "align", "-v", "--clean", "-j", "1", "--output_format", "csv",
-                        voice_folder, "english_us_arpa", "english_us_arpa", mfa_folder])
-        logging.info("Alignment completed")
-    else:
-        logging.info("Alignment file already exists. Skipping alignment.")
-
-    # Read the alignment file and find the closest end time
-    cut_off_sec = time
-    prompt_end_word = ""
-    closest_end = 0
-    with open(alignment_file, "r") as f:
-        lines = f.readlines()[1:]  # Skip header
-        for line in lines:
-            begin, end, label, type, *_ = line.strip().split(",")
-            end = float(end)
-            if end > cut_off_sec:
-                break
-            closest_end = end
-            prompt_end_word = label
-
-    logging.info(f"Identified end value closest to desired time: {closest_end} seconds")
-
-    if not prompt_end_word:
-        logging.error("No suitable word found within the desired time frame.")
-        return {"message": "No suitable word found within the desired time frame."}
-
-    # Read the transcript file and extract the prompt
-    with open(transcript_fn, "r") as f:
-        transcript_text = f.read().strip()
-
-    logging.debug(f"Reading transcript file: {transcript_fn}")
-
-    transcript_words = transcript_text.split()
-    prompt_end_idx = -1
-    for idx, word in enumerate(transcript_words):
-        if word.strip(".,!?;:") == prompt_end_word:
-            prompt_end_idx = idx
-            break
-
-    if prompt_end_idx == -1:
-        logging.error("Error: Prompt end word not found in the transcript.")
-        return {"message": "Error: Prompt end word not found in the transcript."}
-
-    prompt_transcript = " ".join(transcript_words[:prompt_end_idx+1])
-
-    logging.info(f"Prompt transcript up to closest end word: {prompt_transcript}")
-
-    # Prepend the extracted transcript to the user's prompt
-    final_prompt = prompt_transcript + " " + target_text
-    logging.info(f"Final prompt to be used: {final_prompt}")
+    audio_content = await audio.read()
+    transcript_content = await transcript.read()
 
     # Set the device
     if device is None:
@@ -220,6 +187,39 @@ async def generate_audio(
 
     logging.info(f"Using device: {device}")
 
+    if output_format not in AUDIO_FORMATS:
+        logging.error(f"Unsupported output format: {output_format}")
+        return {"message": f"Unsupported output format {output_format}, choose from {list(AUDIO_FORMATS)}."}
+
+    # Requests with a seed are deterministic, serve them from the result cache if they have been generated before
+    output_file = os.path.join(output_path, f"{os.path.splitext(audio.filename)[0]}_generated.{output_format}")
+    cache_key = None
+    if seed >= 0 and use_cache:
+        cache_key = ResultCache.make_key(
+            audio=audio_content, transcript=transcript_content, time=time, target_text=target_text, top_k=top_k, top_p=top_p,
+            temperature=temperature, stop_repetition=stop_repetition, kvcache=kvcache, sample_batch_size=sample_batch_size, device=device,
+            model_name=model_name, compile_decode=compile_decode, draft_model_name=draft_model_name, n_draft=n_draft, long_form=long_form,
+            rolling_prompt=rolling_prompt, seed=seed, output_format=output_format, output_sr=output_sr
+        )
+        cached = result_cache.get(cache_key)
+        if cached is not None:
+            logging.info(f"Serving result cache entry {cache_key}")
+            return serve_audio(cached["audio"], save_to_file, output_file, output_format)
+    # a changed upload under the same name replaces the voice (and its alignment and codes)
+    with timer.stage("upload_save"):
+        audio_fn, _ = save_voice(voice_folder, audio.filename, audio_content, transcript_content)
+    with timer.stage("alignment"):
+        alignment_file = align_voice(voice_folder, audio_fn)
+    try:
+        prompt_transcript, closest_end = find_prompt(alignment_file, transcript_content.decode("utf-8"), time)
+    except ValueError as e:
+        logging.error(str(e))
+        return {"message": str(e)}
+
+    # Prepend the extracted transcript to the user's prompt
+    final_prompt = prompt_transcript + " " + target_text
+    logging.info(f"Final prompt to be used: {final_prompt}")
+
     # If model_name is provided, use it; otherwise, raise an error
     if model_name is None:
         logging.error("No model name provided.")
@@ -227,9 +227,20 @@ async def generate_audio(
 
     logging.info(f"Loading model: {model_name}")
     model = get_model(model_name, device)
+    if compile_decode and kvcache:
+        if model.decode_step is None:
+            model.enable_compiled_decode(cache_dir="./pretrained_models/compile_cache")
+    else:
+        model.disable_compiled_decode()
+
+    # Optional draft model for speculative decoding, e.g. the 330M model for the 830M model
+    draft_model = None
+    if draft_model_name:
+        logging.info(f"Loading draft model: {draft_model_name}")
+        draft_model = get_model(draft_model_name, device)
 
     # Load tokenizers
-    text_tokenizer = TextTokenizer(backend="espeak")
+    text_tokenizer = TextTokenizer(backend="espeak", cache=phoneme_cache)
     audio_tokenizer = AudioTokenizer(signature=f"./pretrained_models/encodec_4cb2048_giga.th", device=device)
 
     additional_args = AdditionalArgs(
@@ -250,41 +261,230 @@ async def generate_audio(
         "codec_audio_sr": 16000,
         "codec_sr": 50,
         "silence_tokens": [1388, 1898, 131],
-        "sample_batch_size": additional_args.sample_batch_size
+        "sample_batch_size": additional_args.sample_batch_size,
+        "n_draft": n_draft
     }
 
+    generator = torch.Generator(device=device).manual_seed(seed) if seed >= 0 else None
+
+    profiler = get_profiler(request, model, os.path.splitext(audio.filename)[0])
+
     # Calculate prompt_end_frame based on the actual closest end time
-    prompt_end_frame = int(closest_end * 16000)
+    prompt_end_frame = int(closest_end * torchaudio.info(io.BytesIO(audio_content)).sample_rate)
     logging.info(f"Prompt end frame: {prompt_end_frame}")
 
-    logging.info("Calling inference_one_sample...")
+    if long_form:
+        logging.info("Calling synthesize_long_form...")
+        try:
+            with profiler:
+                gen_frames = synthesize_long_form(
+                    model, model.args, model.args.phn2num, batch_phonemizer, audio_tokenizer,
+                    audio_content, prompt_transcript, target_text, device, decode_config, prompt_end_frame,
+                    rolling_prompt=rolling_prompt, draft_model=draft_model, generator=generator, timer=timer
+                )
+            logging.info("Inference completed.")
+        except Exception as e:
+            logging.error(f"Error occurred during inference: {str(e)}")
+            return {"message": "An error occurred during audio generation."}
+        # decode window by window, so that the waveform of a long document never has to be in memory at once (when writing a 16 kHz wav)
+        chunks = audio_tokenizer.iter_decode(gen_frames)
+    else:
+        logging.info("Calling inference_one_sample...")
+        try:
+            # Generate the audio
+            with profiler:
+                concated_audio, gen_audio, gen_frames = inference_one_sample(
+                    model, model.args, model.args.phn2num, text_tokenizer, audio_tokenizer,
+                    audio_content, final_prompt, device, decode_config, prompt_end_frame, draft_model=draft_model,
+                    generator=generator, return_frames=True, output_mode="gen", timer=timer
+                )
+            logging.info("Inference completed.")
+            # Empty CUDA cache after inference
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+                logging.info("CUDA cache emptied.")
+        except Exception as e:
+            logging.error(f"Error occurred during inference: {str(e)}")
+            return {"message": "An error occurred during audio generation."}
+        chunks = [gen_audio[0].cpu()]
+
+    if isinstance(profiler, DecodeProfiler):
+        logging.info(f"Decode profile:\n{profiler.summary()}")
+        request.state.profile_trace = profiler.trace_path
+
+    # long documents that don't go into the result cache are written to the output file directly
+    write_to_file = long_form and save_to_file and cache_key is None
+    audio_bytes = io.BytesIO()
     try:
-        # Generate the audio
-        concated_audio, gen_audio = inference_one_sample(
-            model, model.args, model.args.phn2num, text_tokenizer, audio_tokenizer,
-            audio_fn, final_prompt, device, decode_config, prompt_end_frame
+        # for long form requests, this includes decoding the codes
+        with timer.stage("response_encode"):
+            await asyncio.get_running_loop().run_in_executor(
+                encode_pool, encode_audio, output_file if write_to_file else audio_bytes, chunks, 16000, output_format, output_sr
+            )
+    except Exception as e: # e.g. the audio backend can't encode this format
+        logging.error(f"Error occurred during encoding: {str(e)}")
+        return {"message": f"Could not encode the audio as {output_format}."}
+    timer.observe(audio_sec=gen_frames.shape[-1] / decode_config["codec_sr"])
+    if write_to_file:
+        logging.info(f"Generated audio saved as: {output_file}")
+        return {"message": "Audio generated successfully.", "output_file": output_file}
+
+    logging.info(f"Phoneme cache: {phoneme_cache.info()}")
+    if cache_key is not None:
+        result_cache.put(cache_key, gen_frames, audio_bytes.getvalue(), meta={"model_name": model_name, "target_text": target_text})
+    return serve_audio(audio_bytes.getvalue(), save_to_file, output_file, output_format)
+
+@app.post("/edit")
+async def edit_audio(
+    request: Request,
+    target_text: str = Form(...),
+    edit_type: str = Form("auto"),
+    voice_name: str = Form(""),
+    audio: UploadFile = File(None),
+    transcript: UploadFile = File(None),
+    left_margin: float = Form(0.08),
+    right_margin: float = Form(0.08),
+    save_to_file: bool = Form(True),
+    output_path: str = Form("."),
+    top_k: int = Form(0),
+    top_p: float = Form(0.8),
+    temperature: float = Form(1.0),
+    stop_repetition: int = Form(3),
+    kvcache: int = Form(1),
+    device: str = Form(None),
+    model_name: str = Form(""),
+    seed: int = Form(-1),
+    use_cache: int = Form(1),
+    output_format: str = Form("wav"),
+    output_sr: int = Form(16000)
+):
+    """
+    speech editing: change the recording (an upload, or a voice in ./voices given by voice_name) so that it says target_text instead of its transcript.
+    only the edited words are generated and decoded, the rest of the recording is kept as it is
+    """
+    logging.info("Received request to edit audio")
+    timer = request.state.timer
+    os.environ['USER'] = getpass.getuser()
+    if platform.system() == 'Windows':
+        os.environ['PHONEMIZER_ESPEAK_LIBRARY'] = './espeak/libespeak-ng.dll'
+
+    # Find the recording, the codec codes and alignment of a voice are computed once and reused by every edit of it
+    if audio is not None and transcript is not None:
+        voice_name = os.path.splitext(audio.filename)[0]
+        voice_folder = f"./voices/{voice_name}"
+        # saved every time, a changed upload under the same name replaces the voice (and its alignment and codes)
+        with timer.stage("upload_save"):
+            audio_fn, _ = save_voice(voice_folder, audio.filename, await audio.read(), await transcript.read())
+    elif voice_name:
+        voice_folder = f"./voices/{voice_name}"
+        audio_fn, _ = find_voice(voice_folder)
+        if audio_fn is None:
+            logging.error(f"Voice not found: {voice_name}")
+            return {"message": f"Voice {voice_name} not found, upload its audio and transcript."}
+    else:
+        return {"message": "Either upload audio and transcript, or give the voice_name of a saved voice."}
+    _, transcript_fn = find_voice(voice_folder)
+    with open(transcript_fn, "r") as f:
+        orig_transcript = f.read().strip()
+    with timer.stage("alignment"):
+        alignment_file = align_voice(voice_folder, audio_fn)
+
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    elif device.lower() not in ["cpu", "cuda"]:
+        logging.warning("Invalid device specified. Defaulting to CPU.")
+        device = "cpu"
+    logging.info(f"Using device: {device}")
+
+    if output_format not in AUDIO_FORMATS:
+        logging.error(f"Unsupported output format: {output_format}")
+        return {"message": f"Unsupported output format {output_format}, choose from {list(AUDIO_FORMATS)}."}
+
+    output_file = os.path.join(output_path, f"{voice_name}_edited.{output_format}")
+    cache_key = None
+    if seed >= 0 and use_cache:
+        with open(audio_fn, "rb") as f:
+            audio_content = f.read()
+        cache_key = ResultCache.make_key(
+            endpoint="edit", audio=audio_content, transcript=orig_transcript, target_text=target_text, edit_type=edit_type,
+            left_margin=left_margin, right_margin=right_margin, top_k=top_k, top_p=top_p, temperature=temperature,
+            stop_repetition=stop_repetition, kvcache=kvcache, device=device, model_name=model_name, seed=seed,
+            output_format=output_format, output_sr=output_sr
         )
+        cached = result_cache.get(cache_key)
+        if cached is not None:
+            logging.info(f"Serving result cache entry {cache_key}")
+            return serve_audio(cached["audio"], save_to_file, output_file, output_format)
+
+    logging.info(f"Loading model: {model_name}")
+    model = get_model(model_name, device)
+    text_tokenizer = TextTokenizer(backend="espeak", cache=phoneme_cache)
+    audio_tokenizer = AudioTokenizer(signature=f"./pretrained_models/encodec_4cb2048_giga.th", device=device)
+
+    with timer.stage("prompt_encode"):
+        codes, wav = encode_voice(voice_folder, audio_fn, audio_tokenizer)
+    try:
+        mask_interval = edit_mask_intervals(
+            alignment_file, orig_transcript, target_text, wav.shape[-1] / audio_tokenizer.sample_rate, edit_type=edit_type,
+            left_margin=left_margin, right_margin=right_margin, codec_sr=50, max_n_spans=model.args.max_n_spans
+        )
+    except Exception as e: # e.g. the transcripts don't differ by one edit of edit_type, or the alignment doesn't match the transcript
+        logging.error(f"Could not find the edited spans: {str(e)}")
+        return {"message": f"Could not find the words to edit: {str(e)}"}
+    logging.info(f"Mask intervals: {mask_interval.tolist()}")
+
+    decode_config = {
+        'top_k': top_k,
+        'top_p': top_p,
+        'temperature': temperature,
+        'stop_repetition': stop_repetition,
+        'kvcache': kvcache,
+        "codec_audio_sr": 16000,
+        "codec_sr": 50,
+        "silence_tokens": [1388, 1898, 131],
+    }
+    generator = torch.Generator(device=device).manual_seed(seed) if seed >= 0 else None
+    profiler = get_profiler(request, model, voice_name)
+    try:
+        with profiler:
+            edited_audio, edited_codes = edit_one_sample(
+                model, model.args, model.args.phn2num, text_tokenizer, audio_tokenizer, codes, wav, target_text,
+                mask_interval, device, decode_config, generator=generator, timer=timer
+            )
         logging.info("Inference completed.")
-        # Empty CUDA cache after inference
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-            logging.info("CUDA cache emptied.")
     except Exception as e:
         logging.error(f"Error occurred during inference: {str(e)}")
-        return {"message": "An error occurred during audio generation."}
+        return {"message": "An error occurred during audio editing."}
+    if isinstance(profiler, DecodeProfiler):
+        logging.info(f"Decode profile:\n{profiler.summary()}")
+        request.state.profile_trace = profiler.trace_path
+
+    audio_bytes = io.BytesIO()
+    try:
+        with timer.stage("response_encode"):
+            await asyncio.get_running_loop().run_in_executor(
+                encode_pool, encode_audio, audio_bytes, [edited_audio[0].cpu()], 16000, output_format, output_sr
+            )
+    except Exception as e:
+        logging.error(f"Error occurred during encoding: {str(e)}")
+        return {"message": f"Could not encode the audio as {output_format}."}
+    # only the edited spans are generated
+    timer.observe(audio_sec=sum(model.last_decode_stats["span_lens"]) / decode_config["codec_sr"])
+
+    if cache_key is not None:
+        result_cache.put(cache_key, edited_codes, audio_bytes.getvalue(), meta={"model_name": model_name, "target_text": target_text})
+    return serve_audio(audio_bytes.getvalue(), save_to_file, output_file, output_format)
 
+def serve_audio(audio_bytes, save_to_file, output_file, output_format="wav"):
     if save_to_file:
         # Save the generated audio to a file
-        output_file = os.path.join(output_path, f"{os.path.splitext(audio.filename)[0]}_generated.wav")
-        torchaudio.save(output_file, gen_audio[0].cpu(), 16000)
+        with open(output_file, "wb") as f:
+            f.write(audio_bytes)
         logging.info(f"Generated audio saved as: {output_file}")
         return {"message": "Audio generated successfully.", "output_file": output_file}
     else:
         # Serve the generated audio as bytes
-        audio_bytes = io.BytesIO()
-        torchaudio.save(audio_bytes, gen_audio[0].cpu(), 16000, format="wav")
-        audio_bytes.seek(0)
-        return StreamingResponse(audio_bytes, media_type="audio/wav")
+        return StreamingResponse(io.BytesIO(audio_bytes), media_type=AUDIO_FORMATS[output_format])
 
 if __name__ == "__main__":
     import uvicorn
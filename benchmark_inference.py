@@ -0,0 +1,247 @@
+import argparse
+import itertools
+import json
+import logging
+import os
+import platform
+import resource
+import statistics
+import sys
+import time
+
+import torch
+import torch.nn as nn
+
+from config import MyParser
+from models import voicecraft
+
+# offline benchmark of inference_tts, inference_tts_batch and (speech editing) inference, on models with random weights, so it runs anywhere without downloads.
+# the end of generation tokens are suppressed, so every run generates until the length limit of the model (10 frames per text token, prompt included),
+# i.e. the number of generated frames is set by text_len and prompt_frames. results are written as json, which can be used as the baseline of a later run:
+#   python benchmark_inference.py --output_fn before.json
+#   python benchmark_inference.py --output_fn after.json --baseline_fn before.json
+# the compiled single-step decoder (see models/modules/decode_step.py) is compared against the eager one with
+#   python benchmark_inference.py --modes tts --kvcache 1 --compile_decode 0,1
+
+# synthetic model configs, overrides of the defaults in config.py. 330M and 830M have the shapes of the released models
+CONFIGS = {
+    "tiny": dict(d_model=64, audio_embedding_dim=64, nhead=4, num_decoder_layers=2),
+    "small": dict(d_model=256, audio_embedding_dim=256, nhead=8, num_decoder_layers=4),
+    "330M": dict(d_model=1024, audio_embedding_dim=1024, nhead=16, num_decoder_layers=16),
+    "830M": dict(d_model=2048, audio_embedding_dim=2048, nhead=16, num_decoder_layers=16),
+}
+
+# lower is better for these metrics, higher is better for frames_per_sec
+LOWER_IS_BETTER = ["prefill_ms", "per_frame_ms", "rtf", "peak_mem_mb"]
+
+
+def get_args():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--configs", type=str, default="tiny,small", help=f"comma separated synthetic configs, from {list(CONFIGS)}")
+    parser.add_argument("--real_models", type=str, default="", help="comma separated folders in ./pretrained_models whose config.json is benchmarked (with random weights), skipped if not present")
+    parser.add_argument("--modes", type=str, default="tts,edit", help="tts (inference_tts, or inference_tts_batch if sample_batch_size > 1) and/or edit (inference)")
+    parser.add_argument("--text_lens", type=str, default="20,40", help="number of text tokens")
+    parser.add_argument("--prompt_frames", type=str, default="75,150", help="number of codec frames of the prompt")
+    parser.add_argument("--sample_batch_sizes", type=str, default="1,4", help="only used in tts mode")
+    parser.add_argument("--kvcache", type=str, default="1,0")
+    parser.add_argument("--compile_decode", type=str, default="0", help="0 (eager) and/or 1 (torch.compile'd decode step), only used in tts mode with kvcache")
+    parser.add_argument("--decode_bucket_size", type=int, default=256, help="kv length bucket of the compiled decode step")
+    parser.add_argument("--threads", type=str, default=str(torch.get_num_threads()), help="values for torch.set_num_threads")
+    parser.add_argument("--warmup", type=int, default=1, help="untimed runs before each setting")
+    parser.add_argument("--repeats", type=int, default=3, help="timed runs of each setting, the median is reported")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output_fn", type=str, default="benchmark.json")
+    parser.add_argument("--baseline_fn", type=str, default=None, help="results of an earlier run, settings that got slower by more than tolerance are reported as regressions")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="relative change that counts as a regression")
+    return parser.parse_args()
+
+
+def int_list(s):
+    return [int(item) for item in s.split(",") if item != ""]
+
+
+class StubCodec(nn.Module):
+    """stands in for the encodec decoder, codes [B,K,T] -> waveform [B,1,T*hop], with a similar per frame cost as a small conv decoder"""
+    def __init__(self, n_codebooks, card=2048, dim=128, hop=320):
+        super().__init__()
+        self.embeddings = nn.ModuleList([nn.Embedding(card, dim) for _ in range(n_codebooks)])
+        self.conv = nn.Conv1d(dim, dim, 7, padding=3)
+        self.upsample = nn.ConvTranspose1d(dim, 1, hop, stride=hop)
+
+    def decode(self, codes):
+        x = sum(emb(codes[:, k].clamp(max=emb.num_embeddings - 1)) for k, emb in enumerate(self.embeddings)) # [B,T,D]
+        return self.upsample(torch.tanh(self.conv(x.transpose(1, 2))))
+
+
+def build_model(name, device):
+    if name in CONFIGS:
+        args = MyParser().parse_args([])
+        for key, value in CONFIGS[name].items():
+            setattr(args, key, value)
+        model = voicecraft.VoiceCraft(args)
+    else:
+        with open(os.path.join("./pretrained_models", name, "config.json"), "r") as f:
+            model = voicecraft.VoiceCraft(config=json.load(f))
+    # random weights never stop on their own, suppress the end of generation tokens so that the length limit decides the number of frames
+    for token in [model.args.eog, getattr(model.args, "eos", -1)]:
+        if token > 0:
+            model.predict_layer[0][-1].bias.data[token] = -1e4
+    model.to(device)
+    model.eval()
+    return model
+
+
+def peak_mem_mb(device):
+    if str(device).startswith("cuda"):
+        return torch.cuda.max_memory_allocated(device) / 1024**2
+    # peak resident memory of the whole process, it never goes down, so on cpu only the first setting that needs more memory shows up
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+@torch.no_grad()
+def run_once(model, codec, mode, text_len, prompt_frames, sample_batch_size, kvcache, device, generator):
+    x = torch.randint(0, model.args.text_vocab_size, (1, text_len), device=device)
+    x_lens = torch.LongTensor([text_len]).to(device)
+    y = torch.randint(0, model.args.audio_vocab_size, (1, prompt_frames, model.args.n_codebooks), device=device)
+    common = dict(top_k=0, top_p=0.8, temperature=1.0, stop_repetition=3, kvcache=kvcache, silence_tokens=[1388, 1898, 131], generator=generator)
+    if str(device).startswith("cuda"):
+        torch.cuda.reset_peak_memory_stats(device)
+    stime = time.perf_counter()
+    if mode == "edit":
+        mask_interval = torch.LongTensor([[[prompt_frames // 3, 2 * prompt_frames // 3]]]).to(device)
+        gen_frames = model.inference(x, x_lens, y, mask_interval=mask_interval, **common)
+    elif sample_batch_size > 1:
+        gen_frames = model.inference_tts_batch(x, x_lens, y, batch_size=sample_batch_size, **common)[1]
+    else:
+        gen_frames = model.inference_tts(x, x_lens, y, **common)[1]
+    model_sec = time.perf_counter() - stime
+    codec_stime = time.perf_counter()
+    codec.decode(gen_frames.clamp(min=0))
+    codec_sec = time.perf_counter() - codec_stime
+    if str(device).startswith("cuda"):
+        torch.cuda.synchronize(device)
+    stats = model.last_decode_stats
+    n_frames = gen_frames.shape[-1]
+    return {
+        "gen_frames": n_frames,
+        "prefill_ms": stats["prefill_sec"] * 1000,
+        "per_frame_ms": stats["decode_sec"] / max(1, stats["n_steps"] - 1) * 1000,
+        "frames_per_sec": stats["n_steps"] / model_sec,
+        "rtf": (model_sec + codec_sec) / max(n_frames / model.args.encodec_sr, 1e-9),
+        "codec_ms": codec_sec * 1000,
+        "peak_mem_mb": peak_mem_mb(device),
+    }
+
+
+def settings(args):
+    for config, mode, text_len, prompt_frames, sample_batch_size, kvcache, compile_decode, threads in itertools.product(
+        [c for c in args.configs.split(",") if c] + [m for m in args.real_models.split(",") if m],
+        args.modes.split(","), int_list(args.text_lens), int_list(args.prompt_frames),
+        int_list(args.sample_batch_sizes), int_list(args.kvcache), int_list(args.compile_decode), int_list(args.threads)
+    ):
+        if mode == "edit" and sample_batch_size > 1:
+            continue
+        if compile_decode and (mode == "edit" or not kvcache): # the decode step only replaces the kv-cached tts loops
+            continue
+        if text_len * 10 <= prompt_frames + 4:
+            logging.warning(f"skipping text_len {text_len} with prompt_frames {prompt_frames}, the prompt alone is already at the length limit")
+            continue
+        yield dict(config=config, mode=mode, text_len=text_len, prompt_frames=prompt_frames, sample_batch_size=sample_batch_size, kvcache=kvcache, compile_decode=compile_decode, threads=threads)
+
+
+def setting_key(setting):
+    # results of runs from before compile_decode was an option are eager
+    return tuple(setting.get(k, 0) for k in ["config", "mode", "text_len", "prompt_frames", "sample_batch_size", "kvcache", "compile_decode", "threads"])
+
+
+def run_benchmark(args):
+    results = []
+    model_name, model = None, None
+    for setting in settings(args):
+        if setting["config"] != model_name: # one model in memory at a time, settings of the same model come one after another
+            model_name, model = setting["config"], None
+            if model_name not in CONFIGS and not os.path.isfile(os.path.join("./pretrained_models", model_name, "config.json")):
+                logging.warning(f"no config.json for {model_name}, skipping it")
+            else:
+                torch.manual_seed(args.seed)
+                model = build_model(model_name, args.device)
+        if model is None:
+            continue
+        if setting["compile_decode"]:
+            # compiled once per bucket in the warmup runs, use --warmup large enough to fill the buckets the timed runs reach
+            model.enable_compiled_decode(bucket_size=args.decode_bucket_size)
+        else:
+            model.disable_compiled_decode()
+        codec = StubCodec(model.args.n_codebooks).to(args.device).eval()
+        torch.set_num_threads(setting["threads"])
+        runs = []
+        for i in range(args.warmup + args.repeats):
+            generator = torch.Generator(device=args.device).manual_seed(args.seed + i)
+            run = run_once(model, codec, setting["mode"], setting["text_len"], setting["prompt_frames"], setting["sample_batch_size"], setting["kvcache"], args.device, generator)
+            if i >= args.warmup:
+                runs.append(run)
+        result = dict(setting, **{k: statistics.median(run[k] for run in runs) for k in runs[0]})
+        logging.info(f"{setting}: prefill {result['prefill_ms']:.1f} ms, {result['per_frame_ms']:.2f} ms/frame, {result['frames_per_sec']:.1f} frames/sec, rtf {result['rtf']:.3f}, peak mem {result['peak_mem_mb']:.0f} MB")
+        results.append(result)
+    return results
+
+
+def compile_speedups(results):
+    """frames/sec of the compiled decode step against the eager one in the same setting, as readable strings"""
+    eager = {setting_key(dict(item, compile_decode=0)): item for item in results if not item["compile_decode"]}
+    speedups = []
+    for result in results:
+        base = eager.get(setting_key(dict(result, compile_decode=0)))
+        if result["compile_decode"] and base is not None:
+            speedups.append(f"{setting_key(base)}: {base['frames_per_sec']:.1f} -> {result['frames_per_sec']:.1f} frames/sec ({result['frames_per_sec'] / base['frames_per_sec']:.2f}x)")
+    return speedups
+
+
+def compare(results, baseline, tolerance):
+    """returns the regressions of results against baseline, as readable strings"""
+    baseline = {setting_key(item): item for item in baseline}
+    regressions = []
+    for result in results:
+        base = baseline.get(setting_key(result))
+        if base is None:
+            continue
+        for metric in LOWER_IS_BETTER + ["frames_per_sec"]:
+            if metric not in base or base[metric] <= 0:
+                continue
+            change = result[metric] / base[metric] - 1
+            if metric == "frames_per_sec":
+                change = -change
+            if change > tolerance:
+                regressions.append(f"{setting_key(result)} {metric}: {base[metric]:.3f} -> {result[metric]:.3f} ({100 * change:.1f}% worse)")
+    return regressions
+
+
+if __name__ == "__main__":
+    formatter = (
+        "%(asctime)s [%(levelname)s] %(filename)s:%(lineno)d || %(message)s"
+    )
+    logging.basicConfig(format=formatter, level=logging.INFO)
+    args = get_args()
+
+    results = run_benchmark(args)
+    meta = {
+        "torch": torch.__version__, "device": args.device, "platform": platform.platform(), "cpu_count": os.cpu_count(),
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"), "args": vars(args),
+    }
+    with open(args.output_fn, "w") as f:
+        json.dump({"meta": meta, "results": results}, f, indent=2)
+    logging.info(f"saved {len(results)} results to {args.output_fn}")
+    for speedup in compile_speedups(results):
+        logging.info(f"compiled decode step: {speedup}")
+
+    if args.baseline_fn is not None:
+        with open(args.baseline_fn, "r") as f:
+            baseline = json.load(f)
+        if baseline["meta"]["platform"] != meta["platform"] or baseline["meta"]["device"] != meta["device"]:
+            logging.warning(f"the baseline was run on {baseline['meta']['platform']} ({baseline['meta']['device']}), the timings might not be comparable")
+        regressions = compare(results, baseline["results"], args.tolerance)
+        for regression in regressions:
+            logging.warning(f"regression: {regression}")
+        logging.info(f"{len(regressions)} regressions against {args.baseline_fn}")
+        sys.exit(1 if regressions else 0)
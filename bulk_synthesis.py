@@ -0,0 +1,167 @@
+import argparse
+import json
+import logging
+import multiprocessing as mp
+import os
+import time
+
+import torch
+import torchaudio
+
+from data.tokenizer import AudioTokenizer, PhonemeCache, TextTokenizer, tokenize_audio
+from inference_tts_scale import generate_codes
+from long_form import phonemize, split_text, write_wav
+from pretrained import get_model
+from voice import prepare_prompt
+
+# synthesize a whole document (e.g. an audiobook) with one voice, sentences are sharded across a pool of worker processes,
+# each pinned to a subset of the cpu cores and/or a device. finished segments are recorded in output_dir/manifest.jsonl,
+# so a crashed or interrupted run picks up where it stopped when it is started again with the same arguments
+
+# set in each worker process by init_worker
+worker = {}
+
+
+def get_args():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--text_fn", type=str, default="path/to/document.txt", help="the text to synthesize")
+    parser.add_argument("--audio_fn", type=str, default="path/to/voices/name/name.wav", help="the voice, its transcript is expected next to it as name.txt")
+    parser.add_argument("--time", type=float, default=3.0, help="use the voice up to the last word that ends before this many seconds as the prompt")
+    parser.add_argument("--model_name", type=str, default="VoiceCraft_gigaHalfLibri330M_TTSEnhanced_max16s")
+    parser.add_argument("--signature", type=str, default="./pretrained_models/encodec_4cb2048_giga.th", help="path to the encodec model")
+    parser.add_argument("--output_dir", type=str, default="./bulk_output")
+    parser.add_argument("--combined_fn", type=str, default=None, help="if set, all segments are also written to this wav file in order once the run is complete")
+    parser.add_argument("--max_words", type=int, default=30, help="max number of words per segment")
+    parser.add_argument("--num_workers", type=int, default=2)
+    parser.add_argument("--devices", type=str, default="cpu", help="comma separated devices that workers are assigned to round robin, e.g. cuda:0,cuda:1")
+    parser.add_argument("--pin_cores", type=int, default=1, help="if true, split the cpu cores evenly among the workers and pin each worker to its share")
+    parser.add_argument("--phoneme_cache", type=str, default="./pretrained_models/phoneme_cache.sqlite", help="sqlite file of phonemized texts, shared by the workers")
+    parser.add_argument("--seed", type=int, default=1, help="segment i is generated with seed + i, so that resumed runs are reproducible")
+    parser.add_argument("--codec_audio_sr", type=int, default=16000)
+    parser.add_argument("--codec_sr", type=int, default=50)
+    parser.add_argument("--top_k", type=int, default=0)
+    parser.add_argument("--top_p", type=float, default=0.8)
+    parser.add_argument("--temperature", type=float, default=1.0)
+    parser.add_argument("--stop_repetition", type=int, default=3)
+    parser.add_argument("--kvcache", type=int, default=1)
+    parser.add_argument("--sample_batch_size", type=int, default=1)
+    parser.add_argument("--silence_tokens", type=str, default="[1388,1898,131]")
+    return parser.parse_args()
+
+
+def take_slot(slots, num_workers, devices, pin_cores):
+    """
+    called first in a worker process: take one slot from the queue, which decides the device (round robin over the comma separated devices)
+    and, if pin_cores, the share of the cpu cores the worker is pinned to. returns (slot, device)
+    """
+    slot = slots.get()
+    devices = devices.split(",")
+    device = devices[slot % len(devices)]
+    if pin_cores and hasattr(os, "sched_setaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+        n = max(1, len(cores) // num_workers)
+        my_cores = cores[slot * n: (slot + 1) * n] or cores
+        os.sched_setaffinity(0, my_cores)
+        torch.set_num_threads(len(my_cores))
+    logging.basicConfig(format=f"%(asctime)s [%(levelname)s] worker {slot} || %(message)s", level=logging.INFO)
+    logging.info(f"worker {slot} on {device}, {torch.get_num_threads()} threads")
+    return slot, device
+
+
+def init_worker(slots, args, prompt_transcript, prompt_end_frame):
+    # every worker takes one slot, which decides its cpu cores and device
+    slot, device = take_slot(slots, args.num_workers, args.devices, args.pin_cores)
+
+    model = get_model(args.model_name, device)
+    text_tokenizer = TextTokenizer(backend="espeak", cache=PhonemeCache(args.phoneme_cache))
+    audio_tokenizer = AudioTokenizer(signature=args.signature, device=device)
+    # the prompt is the same for all segments, encode and phonemize it once per worker
+    encoded_frames = tokenize_audio(audio_tokenizer, args.audio_fn, offset=0, num_frames=prompt_end_frame)
+    worker.update(
+        slot=slot,
+        device=device,
+        model=model,
+        text_tokenizer=text_tokenizer,
+        audio_tokenizer=audio_tokenizer,
+        prompt=encoded_frames[0][0].transpose(2,1).cpu(), # [1,T,K]
+        prompt_phn=phonemize(text_tokenizer, model.args.phn2num, prompt_transcript),
+        decode_config=vars(args),
+        args=args,
+    )
+
+
+@torch.no_grad()
+def synthesize_segment(task):
+    idx, text = task
+    args, model = worker["args"], worker["model"]
+    phn2num = model.args.phn2num
+    word_sep = [phn2num["_"]] if "_" in phn2num else []
+    text_tokens = torch.LongTensor(worker["prompt_phn"] + word_sep + phonemize(worker["text_tokenizer"], phn2num, text)).unsqueeze(0)
+    text_tokens_lens = torch.LongTensor([text_tokens.shape[-1]])
+    generator = torch.Generator(device=worker["device"]).manual_seed(args.seed + idx)
+    stime = time.time()
+    _, gen_frames = generate_codes(model, model.args, text_tokens, text_tokens_lens, worker["prompt"], worker["device"], worker["decode_config"], generator=generator)
+    gen_audio = worker["audio_tokenizer"].decode([(gen_frames, None)])[0].cpu()
+    fn = os.path.join(args.output_dir, f"{idx:06d}.wav")
+    torchaudio.save(fn, gen_audio, args.codec_audio_sr)
+    return {"idx": idx, "text": text, "fn": fn, "sec": gen_audio.shape[-1] / args.codec_audio_sr, "time": time.time() - stime, "worker": worker["slot"]}
+
+
+def load_manifest(manifest_fn):
+    done = {}
+    if os.path.isfile(manifest_fn):
+        with open(manifest_fn, "r") as f:
+            for line in f:
+                try:
+                    item = json.loads(line)
+                except json.JSONDecodeError: # the last line might be cut off if the run crashed while writing it
+                    continue
+                if os.path.isfile(item["fn"]):
+                    done[item["idx"]] = item
+    return done
+
+
+if __name__ == "__main__":
+    formatter = (
+        "%(asctime)s [%(levelname)s] %(filename)s:%(lineno)d || %(message)s"
+    )
+    logging.basicConfig(format=formatter, level=logging.INFO)
+    args = get_args()
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    # the voice is aligned once, in the main process
+    voice_folder = os.path.dirname(args.audio_fn)
+    transcript_fn = os.path.join(voice_folder, f"{os.path.splitext(os.path.basename(args.audio_fn))[0]}.txt")
+    prompt_transcript, closest_end = prepare_prompt(voice_folder, args.audio_fn, transcript_fn, args.time)
+    prompt_end_frame = int(closest_end * torchaudio.info(args.audio_fn).sample_rate)
+
+    with open(args.text_fn, "r") as f:
+        segments = split_text(f.read(), max_words=args.max_words)
+    manifest_fn = os.path.join(args.output_dir, "manifest.jsonl")
+    done = load_manifest(manifest_fn)
+    done = {i: item for i, item in done.items() if i < len(segments) and item["text"] == segments[i]} # in case the document was edited since
+    tasks = [(i, text) for i, text in enumerate(segments) if i not in done]
+    logging.info(f"{len(segments)} segments, {len(done)} already done, {len(tasks)} to go")
+
+    if len(tasks) > 0:
+        ctx = mp.get_context("spawn") # cuda can't be used in forked processes
+        slots = ctx.Queue()
+        for slot in range(args.num_workers):
+            slots.put(slot)
+        stime = time.time()
+        total_sec = 0.
+        with ctx.Pool(args.num_workers, initializer=init_worker, initargs=(slots, args, prompt_transcript, prompt_end_frame)) as pool, open(manifest_fn, "a") as manifest:
+            for n_finished, item in enumerate(pool.imap_unordered(synthesize_segment, tasks), start=1):
+                manifest.write(json.dumps(item) + "\n")
+                manifest.flush()
+                os.fsync(manifest.fileno())
+                done[item["idx"]] = item
+                total_sec += item["sec"]
+                elapsed = time.time() - stime
+                eta = elapsed / n_finished * (len(tasks) - n_finished)
+                logging.info(f"{len(done)}/{len(segments)} segments, {n_finished/elapsed:.2f} segments/sec, {total_sec/elapsed:.2f} sec. of audio per sec., eta {eta/60:.1f} min")
+
+    if args.combined_fn is not None:
+        chunks = (torchaudio.load(done[i]["fn"])[0] for i in range(len(segments)))
+        n_samples = write_wav(args.combined_fn, chunks, args.codec_audio_sr)
+        logging.info(f"saved {n_samples/args.codec_audio_sr/60:.1f} min of audio to {args.combined_fn}")
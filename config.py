@@ -41,6 +41,7 @@ def MyParser():
     parser.add_argument("--phn_folder_name", type=str, default="phonemes", help="for libritts I also have arpa phns, in which case should be phonemes_arpa")
     parser.add_argument("--encodec_folder_name", type=str, default="encodec_16khz_4codebooks", help="folder where encodec codes are stored")
     parser.add_argument("--manifest_name", type=str, default="manifest", help="metadata filename")
+    parser.add_argument("--token_store_name", type=str, default="token_store", help="if this folder exists in dataset_dir, phonemes and encodec codes are read from it instead of the text folders, see data/token_store.py")
 
     # data focused
     parser.add_argument("--pad_x", type=int, default=1, help="whether or not always pad x to have text_max_length. select 1 to get the maximal memory consumption, but the actual case should be smaller, better to have it being 0")
@@ -4,6 +4,23 @@ import random
 import copy
 import logging
 import shutil
+import multiprocessing as mp
+
+import numpy as np
+
+from data.token_store import TokenStore
+from models.span_masking import build_masked_sequences, mask_embedding_ids, sample_mask_intervals
+
+def text_lengths(task):
+    # phoneme and encodec lengths of a segment stored as text files, (0, 0) if they can't be read
+    pf, ef, symbol_set = task
+    try:
+        with open(pf, "r") as p, open(ef, "r") as e:
+            x_len = sum(item not in symbol_set for item in p.readline().strip().split(" "))
+            y_len = len(e.readline().strip().split())
+    except Exception:
+        return 0, 0
+    return x_len, y_len
 
 class dataset(torch.utils.data.Dataset):
     def __init__(self, args, split):
@@ -11,20 +28,6 @@ class dataset(torch.utils.data.Dataset):
         self.args = args
         self.split = split
         assert self.split in ['train', 'validation', 'test']
-        manifest_fn = os.path.join(self.args.dataset_dir, self.args.manifest_name, self.split+".txt")
-
-        with open(manifest_fn, "r") as rf:
-            data = [l.strip().split("\t") for l in rf.readlines()]
-        lengths_list = [int(item[-1]) for item in data]
-        self.data = []
-        self.lengths_list = []
-        for d, l in zip(data, lengths_list):
-            if l >= self.args.encodec_sr*self.args.audio_min_length:
-                if self.args.drop_long and l > self.args.encodec_sr*self.args.audio_max_length:
-                    continue
-                self.data.append(d)
-                self.lengths_list.append(l)
-        logging.info(f"number of data points for {self.split} split: {len(self.lengths_list)}")
 
         # phoneme vocabulary
         vocab_fn = os.path.join(self.args.dataset_dir,"vocab.txt")
@@ -34,11 +37,107 @@ class dataset(torch.utils.data.Dataset):
             self.phn2num = {item[1]:int(item[0]) for item in temp}
         
         self.symbol_set = set(["<SIL>", "<MUSIC>", "<NOISE>", "<OTHER>"])
+
+        # read from the binary token store if the dataset has one, see data/token_store.py
+        store_dir = os.path.join(self.args.dataset_dir, getattr(self.args, "token_store_name", "token_store"))
+        self.store = TokenStore(store_dir, self.args.n_codebooks) if os.path.isdir(store_dir) else None
+        if self.store is not None:
+            logging.info(f"reading phonemes and encodec codes from {store_dir}")
+            self.symbol_ids = set(self.phn2num[item] for item in self.symbol_set if item in self.phn2num)
+
+        manifest_fn = os.path.join(self.args.dataset_dir, self.args.manifest_name, self.split+".txt")
+        with open(manifest_fn, "r") as rf:
+            data = [l.strip().split("\t") for l in rf.readlines() if l.strip()]
+        # the manifest only has the audio length, the phoneme and encodec lengths are looked up in the index,
+        # so that samples that are too short or too long are dropped here rather than found (and replaced) in __getitem__
+        lengths = self._length_index(manifest_fn, [item[1] for item in data])
+        min_len, max_len = self.args.encodec_sr*self.args.audio_min_length, self.args.encodec_sr*self.args.audio_max_length
+        self.data = []
+        self.lengths_list = []
+        for d in data:
+            x_len, y_len = lengths[d[1]]
+            if x_len == 0 or y_len < max(min_len, 1): # also drops segments whose files are missing or broken
+                continue
+            if self.args.drop_long and (y_len > max_len or x_len > self.args.text_max_length):
+                continue
+            self.data.append(d)
+            self.lengths_list.append(y_len)
+        logging.info(f"number of data points for {self.split} split: {len(self.lengths_list)} (dropped {len(data) - len(self.lengths_list)})")
+        # the random cropping and the mask spans of a sample depend on (seed, epoch, index) only, not on the worker that loads it.
+        # shared with the workers, as they are persistent and keep their copy of the dataset
+        self.epoch = mp.Value('i', 0)
+
+    def set_epoch(self, epoch):
+        self.epoch.value = epoch
+
+    def _length_index(self, manifest_fn, segment_ids):
+        """
+        {segment_id: (phoneme length without the symbol_set, encodec length)} for the segments of a split, (0, 0) for segments that can't be read.
+        computed once and cached as {split}_lengths.tsv next to the manifest. the first line of the cache names what the lengths were read from
+        (the token store, or the phoneme and encodec folders), it is recomputed if that changed, or if the index of the token store is newer than the cache.
+        with the folders, only the segments that are new in the manifest, or whose files were added, removed or modified since the cache was written are recomputed
+        """
+        index_fn = os.path.join(os.path.dirname(manifest_fn), self.split+"_lengths.tsv")
+        if self.store is not None:
+            header = f"#\t{os.path.basename(os.path.normpath(self.store.codes.store_dir))}"
+        else:
+            header = f"#\t{self.args.phn_folder_name}\t{self.args.encodec_folder_name}"
+        lengths = {}
+        if os.path.isfile(index_fn):
+            index_mtime = os.path.getmtime(index_fn)
+            with open(index_fn, "r") as f:
+                if f.readline().rstrip("\n") == header:
+                    lengths = {item[0]: (int(item[1]), int(item[2])) for item in (l.rstrip("\n").split("\t") for l in f)}
+            if self.store is not None and os.path.getmtime(os.path.join(self.store.codes.store_dir, "codes_index.tsv")) > index_mtime:
+                lengths = {}
+            if self.store is None:
+                lengths = {segment_id: lens for segment_id, lens in lengths.items() if not self._text_changed(segment_id, lens, index_mtime)}
+        missing = [segment_id for segment_id in segment_ids if segment_id not in lengths]
+        if len(missing) == 0:
+            return lengths
+        logging.info(f"building the length index of {len(missing)} segments for {self.split} split...")
+        if self.store is not None:
+            for segment_id in missing:
+                if segment_id in self.store.codes and segment_id in self.store.phonemes:
+                    phns = self.store.phonemes.get(segment_id)[:, 0]
+                    lengths[segment_id] = (len(phns) - int(np.isin(phns, list(self.symbol_ids)).sum()), self.store.codes.length(segment_id))
+                else:
+                    lengths[segment_id] = (0, 0)
+        else:
+            tasks = [(*self._text_files(segment_id), self.symbol_set) for segment_id in missing]
+            with mp.Pool(max(1, self.args.num_workers)) as pool:
+                lengths.update(zip(missing, pool.imap(text_lengths, tasks, chunksize=256)))
+        # written to a temporary file first, as every rank builds the index when there is none
+        with open(index_fn + f".{os.getpid()}", "w") as f:
+            f.write(header + "\n")
+            for segment_id, (x_len, y_len) in lengths.items():
+                f.write(f"{segment_id}\t{x_len}\t{y_len}\n")
+        os.replace(index_fn + f".{os.getpid()}", index_fn)
+        return lengths
+
+    def _text_files(self, segment_id):
+        return (os.path.join(self.args.dataset_dir, self.args.phn_folder_name, segment_id+".txt"),
+                os.path.join(self.args.dataset_dir, self.args.encodec_folder_name, segment_id+".txt"))
+
+    def _text_changed(self, segment_id, lens, index_mtime):
+        # whether the cached lengths of a segment in the text folders are out of date. files that are copied with their mtime
+        # (e.g. rsync -a) can be older than the cache, so segments that couldn't be read are recomputed once both of their files are there
+        try:
+            mtimes = [os.path.getmtime(fn) for fn in self._text_files(segment_id)]
+        except OSError:
+            return lens != (0, 0)
+        return lens == (0, 0) or max(mtimes) > index_mtime
     
     def __len__(self):
         return len(self.lengths_list)
     
-    def _load_phn_enc(self, index):
+    def _load_phn_enc(self, index, rng):
+        """
+        returns x, y, y_len, audio_start. y_len is the full length of the codes, y holds the codes from audio_start on.
+        the token store only reads a random window of audio_max_length, the text files are read in full (audio_start is 0)
+        """
+        if self.store is not None:
+            return self._load_phn_enc_store(index, rng)
         item = self.data[index]
         pf = os.path.join(self.args.dataset_dir, self.args.phn_folder_name, item[1]+".txt")
         ef = os.path.join(self.args.dataset_dir, self.args.encodec_folder_name, item[1]+".txt")
@@ -57,13 +156,32 @@ class dataset(torch.utils.data.Dataset):
         except Exception as e:
             logging.info(f"loading failed for {pf} and {ef}, maybe files don't exist or are corrupted")
             logging.info(f"error message: {e}")
-            return [], [[]]
+            return [], [[]], 0, 0
+
+        return x, y, len(y[0]), 0
+
+    def _load_phn_enc_store(self, index, rng):
+        segment_id = self.data[index][1]
+        try:
+            x = [n for n in self.store.phonemes.get(segment_id)[:, 0].tolist() if n not in self.symbol_ids]
+            y_len = self.store.codes.length(segment_id)
+            max_len = int(self.args.audio_max_length * self.args.encodec_sr)
+            audio_start = rng.choice(range(0, y_len-max_len)) if y_len > max_len else 0
+            y = self.store.codes.get(segment_id, audio_start, audio_start+max_len).T.astype("int64") # [K, T]
+            if self.args.special_first:
+                y = y + self.args.n_special
+            y = y.tolist()
+        except Exception as e:
+            logging.info(f"loading failed for {segment_id} from the token store")
+            logging.info(f"error message: {e}")
+            return [], [[]], 0, 0
 
-        return x, y
+        return x, y, y_len, audio_start
 
     def __getitem__(self, index):
-        x, y = self._load_phn_enc(index)
-        x_len, y_len = len(x), len(y[0])
+        rng = random.Random(f"{self.args.seed}_{self.epoch.value}_{index}")
+        x, y, y_len, audio_start = self._load_phn_enc(index, rng)
+        x_len = len(x)
 
         if x_len == 0 or y_len == 0:
             return {
@@ -72,31 +190,25 @@ class dataset(torch.utils.data.Dataset):
             "y": None, 
             "y_len": None, 
             "y_mask_interval": None, # index y_mask_interval[1] is the position of start_of_continue token
-            "extra_mask_start": None # this is only used in VE1
+            "extra_mask_start": None, # this is only used in VE1
+            "y_seq": None,
+            "y_seq_len": None,
+            "frame_pos": None,
+            "mask_position": None,
+            "mask_value": None
             }
-        while y_len < self.args.encodec_sr*self.args.audio_min_length:
-            assert not self.args.dynamic_batching
-            index = random.choice(range(len(self))) # regenerate an index
-            x, y = self._load_phn_enc(index)
-            x_len, y_len = len(x), len(y[0])
-        if self.args.drop_long:
-            while x_len > self.args.text_max_length or y_len > self.args.encodec_sr*self.args.audio_max_length:
-                index = random.choice(range(len(self))) # regenerate an index
-                x, y = self._load_phn_enc(index)
-                x_len, y_len = len(x), len(y[0])
-
         ### padding and cropping below ###
         ### padding and cropping below ###
         # adjust the length of encodec codes, pad to max_len or randomly crop
         orig_y_len = copy.copy(y_len)
         max_len = int(self.args.audio_max_length * self.args.encodec_sr)
         if y_len > max_len:
-            audio_start = random.choice(range(0, y_len-max_len))
-            for i in range(len(y)):
-                y[i] = y[i][audio_start:(audio_start+max_len)]
+            if len(y[0]) > max_len: # text files are read in full, the token store only reads the window
+                audio_start = rng.choice(range(0, y_len-max_len))
+                for i in range(len(y)):
+                    y[i] = y[i][audio_start:(audio_start+max_len)]
             y_len = max_len
         else:
-            audio_start = 0
             if not self.args.dynamic_batching:
                 pad = [0] * (max_len - y_len) if self.args.sep_special_token else [self.args.audio_pad_token] * (max_len - y_len)
                 for i in range(len(y)):
@@ -111,7 +223,7 @@ class dataset(torch.utils.data.Dataset):
         
         x_len = len(x)
         if x_len > self.args.text_max_length:
-            text_start = random.choice(range(0, x_len - self.args.text_max_length))
+            text_start = rng.choice(range(0, x_len - self.args.text_max_length))
             x = x[text_start:text_start+self.args.text_max_length]
             x_len = self.args.text_max_length
         elif self.args.pad_x and x_len <= self.args.text_max_length:
@@ -120,11 +232,21 @@ class dataset(torch.utils.data.Dataset):
         ### padding and cropping above ###
         ### padding and cropping above ###
 
+        # the training sequence of the model (see models/span_masking.py), built here so that it runs in the dataloader workers
+        y = torch.LongTensor(y)
+        mask_intervals, non_mask_intervals = sample_mask_intervals(y_len, self.args, rng, torch.Generator().manual_seed(rng.getrandbits(62)))
+        y_seq, y_seq_len, _, frame_pos, _, mask_position = build_masked_sequences(y[None, :, :y_len], [mask_intervals], [non_mask_intervals], self.args)
+
         return {
             "x": torch.LongTensor(x), 
             "x_len": x_len, 
-            "y": torch.LongTensor(y), 
-            "y_len": y_len
+            "y": y, 
+            "y_len": y_len,
+            "y_seq": y_seq[0],
+            "y_seq_len": y_seq_len[0].item(),
+            "frame_pos": frame_pos,
+            "mask_position": mask_position,
+            "mask_value": torch.LongTensor(mask_embedding_ids(len(mask_intervals), self.args, rng))
             }
             
 
@@ -153,4 +275,10 @@ class dataset(torch.utils.data.Dataset):
         res["y_lens"] = torch.LongTensor(out["y_len"])
         res["text_padding_mask"] = torch.arange(res['x'][0].shape[-1]).unsqueeze(0) >= res['x_lens'].unsqueeze(1)
         res["audio_padding_mask"] = torch.arange(res['y'][0].shape[-1]).unsqueeze(0) >= res['y_lens'].unsqueeze(1)
+        # training sequences [B K S], the frame and mask positions are padded with -1
+        res["y_seq"] = torch.nn.utils.rnn.pad_sequence([item.transpose(1,0) for item in out['y_seq']], batch_first=True, padding_value=self.args.audio_pad_token).transpose(2,1)
+        res["y_seq_lens"] = torch.LongTensor(out["y_seq_len"])
+        res["frame_pos"] = torch.nn.utils.rnn.pad_sequence(out["frame_pos"], batch_first=True, padding_value=-1)
+        res["mask_position"] = torch.nn.utils.rnn.pad_sequence(out["mask_position"], batch_first=True, padding_value=-1)
+        res["mask_value"] = torch.nn.utils.rnn.pad_sequence(out["mask_value"], batch_first=True, padding_value=0)
         return res
\ No newline at end of file
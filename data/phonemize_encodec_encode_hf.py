@@ -1,19 +1,78 @@
 import argparse
+
+import torch
+import torchaudio
+
+from tokenizer import convert_audio
+
 def parse_args():
-    parser = argparse.ArgumentParser(description="encode the librilight dataset using encodec model")
+    parser = argparse.ArgumentParser(description="phonemize and encode the gigaspeech dataset (or a local dataset) using encodec model")
     parser.add_argument("--dataset_size", type=str, default='xs', help='sizes of gigaspeech, xs, s, m, l, xl. we use xl for VoiceCraft training, xs is good for debugging')
     parser.add_argument('--download_to', type=str, default="/data/scratch/pyp/datasets/gigaspeech_debug", help="dir where you want the huggingface gigaspeech dataset to be downloaded to")
+    parser.add_argument('--local_dir', type=str, default=None, help="if set, read the dataset from this folder instead of huggingface: {validation,test,train}/<segment_id>.wav, each with its transcript in <segment_id>.txt next to it")
     parser.add_argument('--save_dir', type=str, default="/data/scratch/pyp/datasets/gigaspeech_phn_enc_manifest_debug", help="path to the manifest, phonemes, and encodec codes dirs")
     parser.add_argument('--encodec_model_path', type=str, default="/data/scratch/pyp/exp_pyp/audiocraft/encodec/xps/6f79c6a8/checkpoint.th")
+    parser.add_argument('--device', type=str, default="cuda", help="device for encodec encoding")
     parser.add_argument('--n_workers', type=int, default=4, help="Number of parallel worker processes")
+    parser.add_argument('--phonemize_workers', type=int, default=8, help="Number of processes for phonemization")
+    parser.add_argument('--phonemize_batch_size', type=int, default=1000, help="Number of transcripts that are sent to the phonemization processes at a time, also the unit of work that is handed on to encoding")
     parser.add_argument('--mega_batch_size', type=int, default=100, help="Number of samples in each mega batch for multiprocess dataloading")
-    parser.add_argument('--batch_size', type=int, default=4, help="batch size for encodec encoding, decrease it if OOM. This is the sum of batch size *over each gpu*, so increase it if you are using more gpus")
+    parser.add_argument('--batch_size', type=int, default=64, help="max number of clips in a batch for encodec encoding, batches are mostly limited by max_batch_samples")
+    parser.add_argument('--max_batch_samples', type=int, default=4000000, help="max number of (padded) audio samples in a batch for encodec encoding. on OOM the batch is split in halves and retried, and the budget is halved for the following batches")
+    parser.add_argument('--n_writers', type=int, default=4, help="threads that write the codes (one thread for the token store, which is written in order)")
     parser.add_argument('--model_sr', type=int, default=16000, help='encodec input audio sample rate')
     parser.add_argument('--downsample_rate', type=int, default=320, help='encodec downsample rate')
     parser.add_argument('--model_code_sr', type=int, default=50, help='encodec model code sample rate')
     parser.add_argument('--len_cap', type=float, default=35.0, help='will drop audios that are longer than this number')
-    parser.add_argument('--max_len', type=int, default=30000, help='max length of audio in samples, if exceed, will cut a batch into half to process, decrease this number if OOM on your machine')
+    parser.add_argument('--save_format', type=str, default="store", choices=["store", "txt"], help="store: binary sharded token store (see token_store.py), txt: one text file per segment for phonemes and for codes")
     return parser.parse_args()
+
+class mydataset(torch.utils.data.Dataset):
+    """
+    the clips of a split: rows of the huggingface dataset, or {"segment_id", "text", "audio_fn"} of the local_dir.
+    at the top level of the script, so that the (spawned) dataloader workers can unpickle it
+    """
+    def __init__(self, data, args):
+        super().__init__()
+        self.data = data
+        self.args = args
+    def __len__(self):
+        return len(self.data)
+    def __getitem__(self, ind):
+        args = self.args
+        try:
+            if args.local_dir is None:
+                segment_id, audio, sr, text, begin_time, end_time = self.data[ind]['segment_id'], torch.from_numpy(self.data[ind]['audio']['array']).float(), self.data[ind]['audio']['sampling_rate'], self.data[ind]['text'], self.data[ind]['begin_time'], self.data[ind]['end_time']
+            else:
+                item = self.data[ind]
+                audio, sr = torchaudio.load(item['audio_fn'])
+                audio, sr = convert_audio(audio, sr, args.model_sr, 1)[0], args.model_sr
+                segment_id, text, begin_time, end_time = item['segment_id'], item['text'], 0., audio.shape[-1] / sr
+        except:
+            return None, None, None, None, None, None
+
+        return segment_id, audio, sr, text, begin_time, end_time
+    def collate(self, batch):
+        res = {'segment_id': [], "audio": [], "sr": [], "text": [], "begin_time": [], "end_time": []}
+        for item in batch:
+            if item[0] != None:
+                res['segment_id'].append(item[0])
+                res['audio'].append(item[1])
+                res['sr'].append(item[2])
+                res['text'].append(item[3])
+                res['begin_time'].append(item[4])
+                res['end_time'].append(item[5])
+        return res
+
+class ListBatchSampler:
+    """yields the batches in self.batches, which are set before every pass over a loader, so that one loader (and its workers) is used for all the passes"""
+    def __init__(self):
+        self.batches = []
+    def __iter__(self):
+        return iter(self.batches)
+    def __len__(self):
+        return len(self.batches)
+
 if __name__ == "__main__":
     import logging
     formatter = (
@@ -22,22 +81,57 @@ if __name__ == "__main__":
     logging.basicConfig(format=formatter, level=logging.INFO)
     args = parse_args()
 
+    import math
     import os
+    import queue
     import numpy as np
-    import torch
     import tqdm
     import time
-    from datasets import load_dataset, DownloadConfig
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+
+    from tokenizer import BatchPhonemizer
+    from token_store import ShardedArrayWriter, open_for_append
+
+    # the run has two stages that overlap: phonemization (on a pool of processes, driven by a background thread) hands batches of segments
+    # to encodec encoding (main thread). each stage appends the segments it finished to its journal in journal/, and segments in a journal
+    # are skipped when the script is started again, so an interrupted run continues where it stopped.
+    # vocab.txt and manifest/{split}.txt grow as the run goes, so both can be used for the segments finished so far
 
-    from tokenizer import TextTokenizer, tokenize_text
-    
     # get the path
-    phn_save_root = os.path.join(args.save_dir, args.dataset_size, "phonemes")
-    codes_save_root = os.path.join(args.save_dir, args.dataset_size, "encodec_16khz_4codebooks")
-    vocab_fn = os.path.join(args.save_dir, args.dataset_size, "vocab.txt")
-    os.makedirs(phn_save_root, exist_ok=True)
-    os.makedirs(codes_save_root, exist_ok=True)
+    out_root = os.path.join(args.save_dir, args.dataset_size)
+    phn_save_root = os.path.join(out_root, "phonemes")
+    codes_save_root = os.path.join(out_root, "encodec_16khz_4codebooks")
+    store_root = os.path.join(out_root, "token_store")
+    manifest_root = os.path.join(out_root, "manifest")
+    journal_root = os.path.join(out_root, "journal")
+    vocab_fn = os.path.join(out_root, "vocab.txt")
+    for d in [manifest_root, journal_root] + ([phn_save_root, codes_save_root] if args.save_format == "txt" else []):
+        os.makedirs(d, exist_ok=True)
+
+
+    class Journal:
+        """segments finished by a stage, one line "split\tsegment_id\tvalue" each. add() buffers, flush() makes the lines durable"""
+        def __init__(self, fn):
+            self.done = {}
+            if os.path.isfile(fn):
+                with open(fn, "r") as f:
+                    for line in f:
+                        item = line.rstrip("\n").split("\t")
+                        if line.endswith("\n") and len(item) == 3:
+                            self.done[(item[0], item[1])] = item[2]
+            self.f = open_for_append(fn)
+
+        def __contains__(self, key):
+            return key in self.done
 
+        def add(self, split, segment_id, value):
+            self.f.write(f"{split}\t{segment_id}\t{value}\n")
+            self.done[(split, segment_id)] = str(value)
+
+        def flush(self):
+            self.f.flush()
+            os.fsync(self.f.fileno())
 
     def sort_by_audio_len(lens):
         inds = np.argsort(lens).tolist()
@@ -46,22 +140,22 @@ if __name__ == "__main__":
         logging.info(f"median: {lens[inds[len(inds)//2]]*args.model_code_sr} encodec codes, {lens[inds[len(inds)//2]]:.2f} sec.")
         logging.info(f"95 percentile longest: {lens[inds[int(len(inds)*0.95)]]*args.model_code_sr} encodec codes, {lens[inds[int(len(inds)*0.95)]]:.2f} sec.")
         return inds[::-1]
-    
+
     def write_array_to_txt_file(array, filename):
         with open(filename, 'w') as f:
             for a in array[:-1]:
                 f.write(' '.join(map(str, a))+'\n')
             f.write(' '.join(map(str, array[-1])))
-    
+
 
     ### phonemization
     # load tokenizer
     # load the encodec model
     from audiocraft.solvers import CompressionSolver
     model = CompressionSolver.model_from_checkpoint(args.encodec_model_path)
-    model = model.cuda()
+    model = model.to(args.device)
     model = model.eval()
-    text_tokenizer = TextTokenizer()
+    text_tokenizer = BatchPhonemizer(n_workers=args.phonemize_workers)
 
 
     # https://github.com/SpeechColab/GigaSpeech
@@ -74,133 +168,238 @@ if __name__ == "__main__":
     word2sym = { "h æ ʃ h ɐ ʃ p ɚ s ɛ n t": "<MUSIC>", "h æ ʃ p ɚ s ɛ n t h æ ʃ": "<SIL>", "p ɚ s ɛ n t h ɐ ʃ p ɚ s ɛ n t": "<OTHER>", "p ɚ s ɛ n t p ɚ s ɛ n t h æ ʃ": "<NOISE>"}
     forbidden_words = set(['#%#', '##%', '%%#', '%#%'])
 
-    dc = DownloadConfig(cache_dir=args.download_to)
+    splits = ['validation', 'test', 'train']
     stime = time.time()
     logging.info("loading the dataset...")
-    gs = load_dataset("speechcolab/gigaspeech", args.dataset_size, use_auth_token=True, cache_dir = args.download_to, download_config=dc)
+    if args.local_dir is None:
+        from datasets import load_dataset, DownloadConfig
+        dc = DownloadConfig(cache_dir=args.download_to)
+        gs = load_dataset("speechcolab/gigaspeech", args.dataset_size, use_auth_token=True, cache_dir = args.download_to, download_config=dc)
+        logging.info(f"gigaspeech dataset {args.dataset_size} info: {gs}")
+    else:
+        # rows with the segment_id and text columns of the huggingface dataset, the audio is loaded in mydataset
+        gs = {}
+        for split in splits:
+            split_dir = os.path.join(args.local_dir, split)
+            if not os.path.isdir(split_dir):
+                continue
+            gs[split] = []
+            for fn in sorted(os.listdir(split_dir)):
+                if fn.endswith(".wav") and os.path.isfile(os.path.join(split_dir, fn[:-4]+".txt")):
+                    with open(os.path.join(split_dir, fn[:-4]+".txt"), "r") as f:
+                        gs[split].append({"segment_id": fn[:-4], "text": f.read().strip(), "audio_fn": os.path.join(split_dir, fn)})
+            logging.info(f"local dataset split {split}: {len(gs[split])} segments")
+        splits = [split for split in splits if split in gs]
     logging.info(f"time spend on loading the dataset: {time.time() - stime:.2f} seconds")
 
-    splits = ['validation', 'test', 'train']
-    
-    logging.info(f"gigaspeech dataset {args.dataset_size} info: {gs}")
-    logging.info(f"phonemizing...")
-    phn_vocab = set()
-    all_lens = []
-    
-    # you will see a ton of [WARNING] words_mismatch.py:88......, it's not a issue
-    for split in tqdm.tqdm(splits):
-        skip = 0
-        logging.info(f"now processing split {split}...")
-        for item in tqdm.tqdm(gs[split]):
-            save_fn = os.path.join(phn_save_root, item['segment_id']+".txt")
-            text = item['text']
-            if sum(word in forbidden_words for word in text.split(" ")):
-                logging.info(f"skip {item['segment_id']}, because it contains forbiden words. It's transcript: {text}")
-                skip += 1
-                continue
-            for k, v in punc2sym.items():
-                text = text.replace(k, v)
-            phn = tokenize_text(text_tokenizer, text)
-            phn_seq = " ".join(phn)
-            for k, v in word2sym.items():
-                phn_seq = phn_seq.replace(k, v)
-            phn_vocab.update(phn_seq.split(" "))
-            all_lens.append(len(phn_seq.split(" ")))
-            with open(save_fn, "w") as f:
-                f.write(phn_seq)
-        logging.info(f"split {split} has {len(gs[split])} samples in total, skipped {skip} due to forbiden words")
-
-    print(f"phn vocab size: {len(list(phn_vocab))}")
-    print("phn sequence stats: ")
-    print(f"longest: {max(all_lens)}")
-    print(f"shortest: {min(all_lens)}")
-    print(f"median: {np.quantile(all_lens, 0.5)}")
-    print(f"95 percentile longest: {np.quantile(all_lens, 0.95)}")
-    print("write vocabulary to ", vocab_fn)
-    with open(vocab_fn, "w") as f:
-        for i, phn in enumerate(list(phn_vocab)):
-            if i < len(list(phn_vocab)) - 1:
-                f.write(f"{str(i)} {phn}\n")
+    phn_journal = Journal(os.path.join(journal_root, "phonemize.txt")) # value: ok, or skip for transcripts with forbidden words
+    enc_journal = Journal(os.path.join(journal_root, "encode.txt")) # value: number of encodec frames, or skip for too short or too long audio
+    # the manifest is rebuilt from the journal, as an interrupted run might have journaled segments without adding them to the manifest
+    manifests = {}
+    for split in splits:
+        with open(os.path.join(manifest_root, split+".txt"), "w") as f:
+            for (s, segment_id), n_frames in enc_journal.done.items():
+                if s == split and n_frames != "skip":
+                    f.write(f"0\t{segment_id}\t{n_frames}\n")
+        manifests[split] = open(os.path.join(manifest_root, split+".txt"), "a")
+
+    # ids are given in order of appearance and kept across runs, so that phonemes can be written to the store before the vocabulary is complete
+    phn2num = {}
+    if os.path.isfile(vocab_fn):
+        with open(vocab_fn, "r") as f:
+            temp = [l.rstrip("\n").split(" ") for l in f.readlines() if l.endswith("\n")]
+            phn2num = {item[1]:int(item[0]) for item in temp if len(item) == 2}
+    vocab_f = open_for_append(vocab_fn)
+    if args.save_format == "store":
+        phn_writer = ShardedArrayWriter(store_root, "phonemes", 1)
+        codes_writer = ShardedArrayWriter(store_root, "codes", model.num_codebooks)
+
+    # (split, [index in gs[split]]) of segments that are phonemized and ready to be encoded, None once phonemization is done
+    to_encode = queue.Queue()
+
+    def phonemize_stage():
+        try:
+            # you will see a ton of [WARNING] words_mismatch.py:88......, it's not a issue
+            for split in splits:
+                skip = 0
+                logging.info(f"phonemizing split {split}...")
+                to_phonemize, ready = [], []
+                for ind, item in enumerate(tqdm.tqdm(gs[split].select_columns(['segment_id', 'text']) if args.local_dir is None else gs[split])): # no need to load the audio here
+                    key = (split, item['segment_id'])
+                    if key in phn_journal:
+                        if phn_journal.done[key] == "ok" and key not in enc_journal:
+                            ready.append(ind)
+                        continue
+                    text = item['text']
+                    if sum(word in forbidden_words for word in text.split(" ")):
+                        logging.info(f"skip {item['segment_id']}, because it contains forbiden words. It's transcript: {text}")
+                        phn_journal.add(split, item['segment_id'], "skip")
+                        skip += 1
+                        continue
+                    for k, v in punc2sym.items():
+                        text = text.replace(k, v)
+                    to_phonemize.append((ind, item['segment_id'], text.strip()))
+                phn_journal.flush()
+                logging.info(f"split {split}: {len(ready)} segments phonemized by an earlier run are waiting to be encoded, {len(to_phonemize)} to phonemize, skipped {skip} due to forbiden words")
+                for start in range(0, len(ready), args.phonemize_batch_size):
+                    to_encode.put((split, ready[start:start+args.phonemize_batch_size]))
+                # phonemize in batches on the worker processes, the output is in the same order as the input
+                for start in tqdm.tqdm(range(0, len(to_phonemize), args.phonemize_batch_size)):
+                    batch = to_phonemize[start:start+args.phonemize_batch_size]
+                    for (_, segment_id, _), phn in zip(batch, text_tokenizer([text for _, _, text in batch])):
+                        phn_seq = " ".join(phn)
+                        for k, v in word2sym.items():
+                            phn_seq = phn_seq.replace(k, v)
+                        phn_ids = []
+                        for p in phn_seq.split(" "):
+                            if p not in phn2num:
+                                phn2num[p] = len(phn2num)
+                                vocab_f.write(f"{phn2num[p]} {p}\n")
+                            phn_ids.append(phn2num[p])
+                        if args.save_format == "store":
+                            phn_writer.add(segment_id, phn_ids)
+                        else:
+                            with open(os.path.join(phn_save_root, segment_id+".txt"), "w") as f:
+                                f.write(phn_seq)
+                        phn_journal.add(split, segment_id, "ok")
+                    # the vocabulary and the phonemes are on disk before the journal says they are done
+                    vocab_f.flush()
+                    os.fsync(vocab_f.fileno())
+                    if args.save_format == "store":
+                        phn_writer.flush()
+                    phn_journal.flush()
+                    to_encode.put((split, [ind for ind, _, _ in batch]))
+            logging.info(f"phonemization done, phn vocab size: {len(phn2num)}")
+        finally:
+            to_encode.put(None)
+
+    def make_batches(audios, sorted_inds):
+        # sorted_inds is longest first, so the first clip of a batch decides its padded length
+        batches, cur = [], []
+        for ind in sorted_inds:
+            if len(cur) > 0 and (len(cur) >= args.batch_size or (len(cur)+1) * audios[cur[0]].shape[-1] > budget["max_batch_samples"]):
+                batches.append(cur)
+                cur = []
+            cur.append(ind)
+        if len(cur) > 0:
+            batches.append(cur)
+        return batches
+
+    def pad_batch(audio_batch):
+        padded_wav = torch.nn.utils.rnn.pad_sequence(audio_batch, batch_first=True).unsqueeze(1) # [B, T] -> [B, 1, T]
+        return padded_wav.pin_memory() if "cuda" in args.device else padded_wav
+
+    @torch.no_grad()
+    def encode(padded_wav, n_frames):
+        """
+        encode a padded batch [B, 1, T], returns a list of codes [K, n_frames[i]]. on OOM the batch is split in halves, recursively.
+        the halves keep the padded length of the batch, so every clip is encoded from the same input (and gets the same codes) whether the batch is split or not
+        """
+        try:
+            codes = model.encode(padded_wav.to(args.device, non_blocking=True))[0].cpu()
+            assert codes.shape[-1] >= max(n_frames), (codes.shape, max(n_frames))
+            return [codes[i, :, :n] for i, n in enumerate(n_frames)]
+        except torch.cuda.OutOfMemoryError:
+            if len(padded_wav) == 1:
+                raise
+            torch.cuda.empty_cache()
+            if budget["max_batch_samples"] >= padded_wav.shape[0] * padded_wav.shape[-1]:
+                budget["max_batch_samples"] = padded_wav.shape[0] * padded_wav.shape[-1] // 2
+                logging.info(f"OOM for a batch of {padded_wav.shape[0]} x {padded_wav.shape[-1]} samples, max_batch_samples is now {budget['max_batch_samples']}")
+            half = len(padded_wav) // 2
+            return encode(padded_wav[:half], n_frames[:half]) + encode(padded_wav[half:], n_frames[half:])
+
+    def write_codes(segment_ids, codes):
+        for segment_id, cur_code in zip(segment_ids, codes):
+            if args.save_format == "store":
+                codes_writer.add(segment_id, cur_code.numpy().T) # [T, K]
             else:
-                f.write(f"{str(i)} {phn}")
-
-    class mydataset(torch.utils.data.Dataset):
-        def __init__(self, split):
-            super().__init__()
-            self.data = gs[split]
-        def __len__(self):
-            return len(self.data)
-        def __getitem__(self, ind):
-            try:
-                segment_id, audio, sr, text, begin_time, end_time = self.data[ind]['segment_id'], torch.from_numpy(self.data[ind]['audio']['array']).float(), self.data[ind]['audio']['sampling_rate'], self.data[ind]['text'], self.data[ind]['begin_time'], self.data[ind]['end_time']
-            except:
-                return None, None, None, None, None, None
-            
-            return segment_id, audio, sr, text, begin_time, end_time
-        def collate(self, batch):
-            res = {'segment_id': [], "audio": [], "sr": [], "text": [], "begin_time": [], "end_time": []}
-            for item in batch:
-                if item[0] != None:
-                    res['segment_id'].append(item[0])
-                    res['audio'].append(item[1])
-                    res['sr'].append(item[2])
-                    res['text'].append(item[3])
-                    res['begin_time'].append(item[4])
-                    res['end_time'].append(item[5])
-            return res
-
-
-    ## encodec codes extraction
+                write_array_to_txt_file(cur_code.tolist(), os.path.join(codes_save_root, segment_id+".txt"))
+        if args.save_format == "store":
+            codes_writer.flush()
+        return segment_ids, [cur_code.shape[-1] for cur_code in codes]
+
+    def finish_write(split, future):
+        # codes, then journal, then manifest (which is rebuilt from the journal on restart)
+        segment_ids, n_frames = future.result()
+        for segment_id, n in zip(segment_ids, n_frames):
+            enc_journal.add(split, segment_id, n)
+        enc_journal.flush()
+        for segment_id, n in zip(segment_ids, n_frames):
+            manifests[split].write(f"0\t{segment_id}\t{n}\n")
+        manifests[split].flush()
+
+
+    ## encodec codes extraction, while the next segments are phonemized
     logging.info("encodec encoding...")
-    train_dataset = mydataset('train')
-    train_loader = torch.torch.utils.data.DataLoader(train_dataset, batch_size=args.mega_batch_size, shuffle=False, drop_last=False, num_workers=args.n_workers, collate_fn=train_dataset.collate)
-    validation_dataset = mydataset('validation')
-    validation_loader = torch.torch.utils.data.DataLoader(validation_dataset, batch_size=args.mega_batch_size, shuffle=False, drop_last=False, num_workers=args.n_workers, collate_fn=validation_dataset.collate)
-    test_dataset = mydataset('test')
-    test_loader = torch.torch.utils.data.DataLoader(test_dataset, batch_size=args.mega_batch_size, shuffle=False, drop_last=False, num_workers=args.n_workers, collate_fn=test_dataset.collate)
-    splits = ['validation', 'test', 'train']
-    loaders = [validation_loader, test_loader, train_loader]
-    # splits = ['validation'] # for debug
-    # loaders = [validation_loader]
-    for split, loader in zip(splits, loaders):
-        skip = 0
-        logging.info(f"now processing split {split}...")
-        mega_n_steps = int(np.ceil(len(gs[split]) / args.mega_batch_size))
-        logging.info(f"partition the split {split} into {mega_n_steps} parts, each has {args.mega_batch_size} samples")
-        for m, mega_batch in enumerate(loader):
-            logging.info(f"====================================")
+    datasets = {split: mydataset(gs[split], args) for split in splits}
+    # one loader per split, whose workers are kept for all the batches of the split. the workers are spawned rather than forked,
+    # as forking while the phonemize, pad and writer threads are running can deadlock
+    loaders, batch_samplers = {}, {}
+    budget = {"max_batch_samples": args.max_batch_samples}
+    # codes are written by background threads, and the next batch is padded (into pinned memory) while the current one is encoded
+    writer_pool = ThreadPoolExecutor(max_workers=1 if args.save_format == "store" else args.n_writers)
+    pad_pool = ThreadPoolExecutor(max_workers=1)
+    phonemize_pool = ThreadPoolExecutor(max_workers=1)
+    phonemize_future = phonemize_pool.submit(phonemize_stage)
+    pending_writes = deque()
+    n_encoded = 0
+    while True:
+        work = to_encode.get()
+        if work is None:
+            break
+        split, inds = work
+        if split not in loaders:
+            batch_samplers[split] = ListBatchSampler()
+            loaders[split] = torch.utils.data.DataLoader(datasets[split], batch_sampler=batch_samplers[split], num_workers=args.n_workers, collate_fn=datasets[split].collate,
+                                                         persistent_workers=args.n_workers > 0, multiprocessing_context="spawn" if args.n_workers > 0 else None)
+        batch_samplers[split].batches = [inds[i:i+args.mega_batch_size] for i in range(0, len(inds), args.mega_batch_size)]
+        for mega_batch in loaders[split]:
+            if len(mega_batch['segment_id']) == 0:
+                continue
             logging.info(f"====================================")
-            logging.info(f"now processing mega step {m+1}/{mega_n_steps}")
+            logging.info(f"now encoding {len(mega_batch['segment_id'])} segments of split {split}, {n_encoded} encoded so far")
             lengths = np.array(mega_batch['end_time']) - np.array(mega_batch['begin_time'])
             sorted_inds = sort_by_audio_len(lengths)
             for j in range(len(sorted_inds))[::-1]:
                 if lengths[sorted_inds[j]] < 0.2 or lengths[sorted_inds[j]] > args.len_cap: # skip samples that are too short (shorter than 0.2s), or too big (bigger than 80s)
-                    skip += 1
+                    enc_journal.add(split, mega_batch['segment_id'][sorted_inds[j]], "skip")
                     del sorted_inds[j]
-            
-            n_steps = int(np.ceil(len(sorted_inds) / args.batch_size))
-            for n in tqdm.tqdm(range(n_steps), disable=True):
-                inds_used = sorted_inds[n*args.batch_size:(n+1)*args.batch_size]
-                audio_batch = [mega_batch['audio'][id] for id in inds_used]
-                sr_batch = [mega_batch['sr'][id] for id in inds_used]
+
+            batches = deque(make_batches(mega_batch['audio'], sorted_inds))
+            batches_budget = budget["max_batch_samples"]
+            next_padded = pad_pool.submit(pad_batch, [mega_batch['audio'][id] for id in batches[0]]) if len(batches) > 0 else None
+            while len(batches) > 0:
+                inds_used = batches.popleft()
+                padded_wav = next_padded.result()
+                if len(batches) > 0:
+                    next_padded = pad_pool.submit(pad_batch, [mega_batch['audio'][id] for id in batches[0]])
                 segment_id_batch = [mega_batch['segment_id'][id] for id in inds_used]
-                text_batch = [mega_batch['text'][id] for id in inds_used]
-                padded_wav = torch.nn.utils.rnn.pad_sequence(audio_batch, batch_first=True).unsqueeze(1) # [B, T] -> [B, 1, T]
-                all_lens = [lengths[id] for id in inds_used]
-                with torch.no_grad():
-                    if max(all_lens) > args.max_len and len(all_lens) > 1: # NOTE decrease args.max_len if OOM, or chunk it into more than 2 forward passes
-                        codes = []
-                        inwav = padded_wav.cuda()
-                        codes.append(model.encode(inwav[:len(inwav)//2])[0].cpu())
-                        codes.append(model.encode(inwav[len(inwav)//2:])[0].cpu())
-                        codes = torch.cat(codes, dim=0)
-                    else:
-                        encoded_frames = model.encode(padded_wav.cuda())
-                        # logging.info(f"encoded_frames: {encoded_frames[0].shape}")
-                        codes = encoded_frames[0].cpu()
-
-                for i, length in enumerate(all_lens):
-                    save_fn = os.path.join(codes_save_root, segment_id_batch[i]+".txt")
-                    actual_len = round(length * args.model_code_sr) # 320 is downsample rate for this model
-                    cur_code = codes[i].tolist() if type(codes) == list else codes[i, :, :actual_len].tolist()
-                    write_array_to_txt_file(cur_code, save_fn)
+                # the length from the metadata, but never more than the frames the codec makes from the audio itself, which would be codes of the padding
+                n_frames = [min(round(lengths[id] * args.model_code_sr), math.ceil(mega_batch['audio'][id].shape[-1] / args.downsample_rate)) for id in inds_used]
+                codes = encode(padded_wav, n_frames)
+                if budget["max_batch_samples"] < batches_budget and len(batches) > 0:
+                    # an OOM lowered the budget, so the batches that are still queued are made again with it (they stay longest first)
+                    batches = deque(make_batches(mega_batch['audio'], [id for batch in batches for id in batch]))
+                    batches_budget = budget["max_batch_samples"]
+                    next_padded.cancel()
+                    next_padded = pad_pool.submit(pad_batch, [mega_batch['audio'][id] for id in batches[0]])
+                pending_writes.append((split, writer_pool.submit(write_codes, segment_id_batch, codes)))
+                n_encoded += len(segment_id_batch)
+                # journal what is written, and don't let the writers fall too far behind
+                while len(pending_writes) > 0 and (pending_writes[0][1].done() or len(pending_writes) > 4 * args.n_writers):
+                    finish_write(*pending_writes.popleft())
+    while len(pending_writes) > 0:
+        finish_write(*pending_writes.popleft())
+    enc_journal.flush()
+    phonemize_future.result() # raises if phonemization failed
+    text_tokenizer.close()
+    for pool in [writer_pool, pad_pool, phonemize_pool]:
+        pool.shutdown()
+    if args.save_format == "store":
+        phn_writer.close()
+        codes_writer.close()
+    vocab_f.close()
+    for f in manifests.values():
+        f.close()
+    logging.info(f"done, encoded {n_encoded} segments in {time.time() - stime:.2f} seconds, the manifest is in {manifest_root}")
@@ -0,0 +1,28 @@
+import multiprocessing as mp
+
+from phonemizer.backend import EspeakBackend
+
+# the worker processes of BatchPhonemizer (data/tokenizer.py). this module only imports the phonemizer, as the workers import it to unpickle
+# their initializer: importing data/tokenizer.py there would also load torch and torchaudio in every worker
+
+# the backend of a worker process
+_backend = None
+_separator = None
+
+def init_worker(backend_kwargs, separator):
+    global _backend, _separator
+    _backend = EspeakBackend(**backend_kwargs)
+    _separator = separator
+
+def phonemize_chunk(args):
+    text, strip = args
+    return _backend.phonemize(text, separator=_separator, strip=strip, njobs=1)
+
+def start_pool(n_workers, backend_kwargs, separator):
+    """
+    a pool of n_workers phonemizer processes. they are forked from a forkserver, a fresh single threaded process, so the pool can be started while
+    the caller runs threads (spawn where there is no forkserver, e.g. windows). as with spawn, the workers import the main module of the caller
+    as __mp_main__, which has to keep its work under `if __name__ == "__main__":`, so the pool is best started once, e.g. at the startup of the app
+    """
+    method = "forkserver" if "forkserver" in mp.get_all_start_methods() else "spawn"
+    return mp.get_context(method).Pool(n_workers, initializer=init_worker, initargs=(backend_kwargs, separator))
@@ -0,0 +1,195 @@
+import argparse
+import logging
+import os
+
+import numpy as np
+
+# packed on-disk storage of token sequences (encodec codes and phoneme ids), instead of one text file per segment.
+# the sequences of a kind are appended to large binary shards of uint16 ([T, width] row major, i.e. time major, so a window of frames is contiguous),
+# and an index (segment_id, shard, offset, length) is kept next to them. the shards are read through np.memmap, so only the slices that are used are read from disk.
+# a store folder has two kinds: "codes" (width n_codebooks) and "phonemes" (width 1, ids of the vocab.txt of the dataset)
+#   store/codes_00000.bin, store/codes_00001.bin, ..., store/codes_index.tsv
+#   store/phonemes_00000.bin, ..., store/phonemes_index.tsv
+# existing text trees (phonemes/*.txt and encodec_16khz_4codebooks/*.txt) are converted with
+#   python data/token_store.py --dataset_dir path/to/gigaspeech_phn_enc_manifest/xl
+
+
+def open_for_append(fn):
+    """open a line based file (index, journal, ...) for appending, a cut off last line left by a crash is dropped first"""
+    if os.path.isfile(fn):
+        with open(fn, "rb+") as f:
+            data = f.read()
+            if len(data) > 0 and not data.endswith(b"\n"):
+                f.truncate(data.rfind(b"\n") + 1)
+    return open(fn, "a")
+
+
+class ShardedArrayWriter:
+    """
+    appends sequences [T, width] of one kind to the shards of a store, a new shard is started once the current one is larger than shard_bytes.
+    writing to an existing store continues it, a segment that is added again replaces the earlier one (the last entry in the index wins)
+    """
+    def __init__(self, store_dir, kind, width, shard_bytes=2 * 1024**3):
+        self.store_dir, self.kind, self.width, self.shard_bytes = store_dir, kind, width, shard_bytes
+        os.makedirs(store_dir, exist_ok=True)
+        shards = sorted(fn for fn in os.listdir(store_dir) if fn.startswith(f"{kind}_") and fn.endswith(".bin"))
+        self.shard = len(shards) - 1 if shards else 0
+        self._index = open_for_append(os.path.join(store_dir, f"{kind}_index.tsv"))
+        self._truncate_shard()
+        self._size = os.path.getsize(self._shard_path()) if os.path.isfile(self._shard_path()) else 0 # in bytes, the offsets are taken from this rather than tell()
+        self._data = open(self._shard_path(), "ab")
+
+    def _shard_path(self):
+        return os.path.join(self.store_dir, f"{self.kind}_{self.shard:05d}.bin")
+
+    def _truncate_shard(self):
+        # a crash can leave rows at the end of the last shard that are not in the index (or half a row), they are cut off so that new rows stay aligned
+        end = 0
+        with open(os.path.join(self.store_dir, f"{self.kind}_index.tsv"), "r") as f:
+            for line in f:
+                item = line.rstrip("\n").split("\t")
+                if len(item) == 4 and int(item[1]) == self.shard:
+                    end = max(end, (int(item[2]) + int(item[3])) * 2 * self.width)
+        if os.path.isfile(self._shard_path()) and os.path.getsize(self._shard_path()) > end:
+            logging.warning(f"cutting {self._shard_path()} from {os.path.getsize(self._shard_path())} to {end} bytes, the rest is not in the index")
+            with open(self._shard_path(), "rb+") as f:
+                f.truncate(end)
+
+    def add(self, segment_id, array):
+        array = np.asarray(array)
+        if array.ndim == 1:
+            array = array[:, None]
+        assert array.shape[1] == self.width, f"{segment_id}: expected width {self.width}, got {array.shape}"
+        assert array.size == 0 or (array.min() >= 0 and array.max() < 2**16), f"{segment_id}: tokens don't fit in uint16"
+        if self._size > self.shard_bytes:
+            self._data.close()
+            self.shard += 1
+            self._size = 0
+            self._data = open(self._shard_path(), "ab")
+        offset = self._size // (2 * self.width) # in rows
+        data = np.ascontiguousarray(array, dtype=np.uint16).tobytes()
+        self._data.write(data)
+        self._size += len(data)
+        self._index.write(f"{segment_id}\t{self.shard}\t{offset}\t{array.shape[0]}\n")
+
+    def flush(self):
+        # the data is flushed before the index, so that the index never points past the end of a shard
+        for f in [self._data, self._index]:
+            f.flush()
+            os.fsync(f.fileno())
+
+    def close(self):
+        self.flush()
+        self._data.close()
+        self._index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+class ShardedArray:
+    """read side of ShardedArrayWriter, the shards are memory mapped on first use (in each dataloader worker, they are not pickled)"""
+    def __init__(self, store_dir, kind, width):
+        self.store_dir, self.kind, self.width = store_dir, kind, width
+        self.index = {}
+        with open(os.path.join(store_dir, f"{kind}_index.tsv"), "r") as f:
+            for line in f:
+                item = line.rstrip("\n").split("\t")
+                if len(item) == 4: # the last line might be cut off if the writer crashed
+                    self.index[item[0]] = (int(item[1]), int(item[2]), int(item[3]))
+        self._maps = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_maps"] = {}
+        return state
+
+    def __contains__(self, segment_id):
+        return segment_id in self.index
+
+    def length(self, segment_id):
+        return self.index[segment_id][2]
+
+    def get(self, segment_id, start=0, end=None):
+        """rows [start, end) of a segment as a [T, width] uint16 array, only these rows are read"""
+        shard, offset, length = self.index[segment_id]
+        end = length if end is None else min(end, length)
+        if shard not in self._maps:
+            data = np.memmap(os.path.join(self.store_dir, f"{self.kind}_{shard:05d}.bin"), dtype=np.uint16, mode="r")
+            self._maps[shard] = data.reshape(-1, self.width)
+        return self._maps[shard][offset + start:offset + end]
+
+
+class TokenStore:
+    """the codes and phonemes of a dataset, see the top of this file"""
+    def __init__(self, store_dir, n_codebooks=4):
+        self.codes = ShardedArray(store_dir, "codes", n_codebooks)
+        self.phonemes = ShardedArray(store_dir, "phonemes", 1)
+
+
+def read_txt_pair(task):
+    # one segment of a text tree, as arrays for the store, None for a missing or broken file
+    segment_id, phn_fn, enc_fn, phn2num, n_codebooks = task
+    try:
+        with open(phn_fn, "r") as f:
+            phns = f.read().strip().split(" ")
+        phn_ids = np.array([phn2num[phn] for phn in phns], dtype=np.int64)
+        with open(enc_fn, "r") as f:
+            codes = np.array([[int(n) for n in l.strip().split()] for k, l in enumerate(f.readlines()) if k < n_codebooks], dtype=np.int64) # [K, T]
+        assert codes.shape[0] == n_codebooks, enc_fn
+    except Exception as e:
+        logging.warning(f"skipping {segment_id}: {e}")
+        return segment_id, None, None
+    return segment_id, phn_ids, codes.T
+
+
+if __name__ == "__main__":
+    import multiprocessing as mp
+
+    import tqdm
+    formatter = (
+        "%(asctime)s [%(levelname)s] %(filename)s:%(lineno)d || %(message)s"
+    )
+    logging.basicConfig(format=formatter, level=logging.INFO)
+    parser = argparse.ArgumentParser(description="convert the phoneme and encodec text files of a dataset into a token store", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--dataset_dir", type=str, required=True, help="the folder with vocab.txt, the manifest folder and the phoneme and encodec folders")
+    parser.add_argument("--phn_folder_name", type=str, default="phonemes")
+    parser.add_argument("--encodec_folder_name", type=str, default="encodec_16khz_4codebooks")
+    parser.add_argument("--manifest_name", type=str, default="manifest", help="every segment in the .txt files of this folder is converted")
+    parser.add_argument("--store_name", type=str, default="token_store", help="created in dataset_dir")
+    parser.add_argument("--n_codebooks", type=int, default=4)
+    parser.add_argument("--shard_gb", type=float, default=2.0)
+    parser.add_argument("--n_workers", type=int, default=8, help="processes that parse the text files")
+    args = parser.parse_args()
+
+    with open(os.path.join(args.dataset_dir, "vocab.txt"), "r") as f:
+        temp = [l.strip().split(" ") for l in f.readlines() if len(l) != 0]
+        phn2num = {item[1]:int(item[0]) for item in temp}
+    manifest_dir = os.path.join(args.dataset_dir, args.manifest_name)
+    segment_ids = []
+    for fn in sorted(os.listdir(manifest_dir)):
+        if fn.endswith(".txt"):
+            with open(os.path.join(manifest_dir, fn), "r") as f:
+                segment_ids += [l.strip().split("\t")[1] for l in f.readlines() if l.strip()]
+    store_dir = os.path.join(args.dataset_dir, args.store_name)
+    if os.path.isfile(os.path.join(store_dir, "codes_index.tsv")):
+        done = ShardedArray(store_dir, "codes", args.n_codebooks).index
+        segment_ids = [segment_id for segment_id in segment_ids if segment_id not in done]
+    logging.info(f"converting {len(segment_ids)} segments into {store_dir}")
+
+    tasks = ((segment_id, os.path.join(args.dataset_dir, args.phn_folder_name, segment_id+".txt"), os.path.join(args.dataset_dir, args.encodec_folder_name, segment_id+".txt"), phn2num, args.n_codebooks) for segment_id in segment_ids)
+    shard_bytes = int(args.shard_gb * 1024**3)
+    skip = 0
+    with mp.Pool(args.n_workers) as pool, ShardedArrayWriter(store_dir, "phonemes", 1, shard_bytes) as phn_writer, ShardedArrayWriter(store_dir, "codes", args.n_codebooks, shard_bytes) as codes_writer:
+        for segment_id, phn_ids, codes in tqdm.tqdm(pool.imap(read_txt_pair, tasks, chunksize=64), total=len(segment_ids)):
+            if phn_ids is None:
+                skip += 1
+                continue
+            # phonemes first, a segment counts as converted once its codes are in the index
+            phn_writer.add(segment_id, phn_ids)
+            codes_writer.add(segment_id, codes)
+    logging.info(f"done, skipped {skip} segments")
@@ -13,7 +13,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import io
+import itertools
+import logging
+import math
+import os
 import re
+import sqlite3
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import asdict, dataclass
 from typing import Any, Dict, List, Optional, Pattern, Union
 
@@ -28,6 +37,69 @@ from phonemizer.backend.espeak.words_mismatch import WordMismatch
 from phonemizer.punctuation import Punctuation
 from phonemizer.separator import Separator
 
+try:
+    from .phonemize_worker import phonemize_chunk, start_pool
+except ImportError: # imported as a top level module, e.g. by data/phonemize_encodec_encode_hf.py
+    from phonemize_worker import phonemize_chunk, start_pool
+
+
+
+class PhonemeCache:
+    """
+    LRU of phonemized strings in memory, optionally backed by a sqlite file (path) so that it survives restarts and can be shared between processes.
+    keys have to include everything that changes the output of the phonemizer
+    """
+    def __init__(self, path=None, max_size=100000):
+        self.max_size = max_size
+        self.memory = OrderedDict()
+        self.hits, self.misses = 0, 0
+        self.lock = threading.Lock() # the tokenizer is also used from background threads (e.g. in long form synthesis)
+        self.db = None
+        if path is not None:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS phonemes (key TEXT PRIMARY KEY, value TEXT)")
+            self.db.commit()
+
+    def _remember(self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.max_size:
+            self.memory.popitem(last=False)
+
+    def get_many(self, keys):
+        """returns a list with the cached value of each key, or None"""
+        with self.lock:
+            values = []
+            for key in keys:
+                value = self.memory.get(key)
+                if value is None and self.db is not None:
+                    row = self.db.execute("SELECT value FROM phonemes WHERE key = ?", (key,)).fetchone()
+                    value = row[0] if row is not None else None
+                if value is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+                    self._remember(key, value)
+                values.append(value)
+            return values
+
+    def put_many(self, items):
+        with self.lock:
+            for key, value in items:
+                self._remember(key, value)
+            if self.db is not None and len(items) > 0:
+                self.db.executemany("INSERT OR REPLACE INTO phonemes (key, value) VALUES (?, ?)", items)
+                self.db.commit()
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.
+
+    def info(self):
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hit_rate, "size": len(self.memory)}
 
 
 class TextTokenizer:
@@ -44,9 +116,12 @@ class TextTokenizer:
         tie: Union[bool, str] = False,
         language_switch: LanguageSwitch = "keep-flags",
         words_mismatch: WordMismatch = "ignore",
+        cache: Optional[PhonemeCache] = None,
+        word_level_cache: bool = False,
     ) -> None:
-        phonemizer = EspeakBackend(
-            language,
+        # also used to build the backends of the BatchPhonemizer workers
+        self.backend_kwargs = dict(
+            language=language,
             punctuation_marks=punctuation_marks,
             preserve_punctuation=preserve_punctuation,
             with_stress=with_stress,
@@ -54,10 +129,21 @@ class TextTokenizer:
             language_switch=language_switch,
             words_mismatch=words_mismatch,
         )
+        phonemizer = EspeakBackend(**self.backend_kwargs)
         
         self.backend = phonemizer
         self.separator = separator
 
+        # utterances are phonemized independently of each other, so caching them gives exactly the same output.
+        # words are not (espeak looks at the neighbouring words in a few cases), so the word level cache is opt-in
+        self.cache = cache
+        self.word_level_cache = word_level_cache
+        punctuation = punctuation_marks if isinstance(punctuation_marks, str) else punctuation_marks.pattern
+        self.cache_prefix = "|".join(str(item) for item in [
+            EspeakBackend.version(), language, separator.word, separator.syllable, separator.phone, preserve_punctuation,
+            punctuation, with_stress, tie, language_switch, words_mismatch
+        ])
+
     def to_list(self, phonemized: str) -> List[str]:
         fields = []
         for word in phonemized.split(self.separator.word):
@@ -72,20 +158,89 @@ class TextTokenizer:
         )
         return fields[:-1]
 
+    def _phonemize_cached(self, text, strip, level):
+        # phonemize a list of strings, only cache misses go to espeak
+        keys = [f"{self.cache_prefix}|{strip}|{level}|{t}" for t in text]
+        phonemized = self.cache.get_many(keys)
+        missing = list(OrderedDict.fromkeys(t for t, p in zip(text, phonemized) if p is None)) # unique, in order
+        if len(missing) > 0:
+            if level == "word":
+                new = self._backend_phonemize(missing, strip)
+            else:
+                new = self._phonemize_utterances(missing, strip)
+            new = dict(zip(missing, new))
+            self.cache.put_many([(f"{self.cache_prefix}|{strip}|{level}|{t}", new[t]) for t in missing])
+            phonemized = [p if p is not None else new[t] for t, p in zip(text, phonemized)]
+        return phonemized
+
+    def _phonemize_utterances(self, text, strip):
+        if not (self.word_level_cache and strip):
+            return self._backend_phonemize(text, strip)
+        # phonemize word by word, and join the words with the word separator
+        words = [t.split() for t in text]
+        word_phonemes = self._phonemize_cached([w for ws in words for w in ws], strip, "word")
+        phonemized, i = [], 0
+        for ws in words:
+            phonemized.append(self.separator.word.join(word_phonemes[i:i+len(ws)]))
+            i += len(ws)
+        return phonemized
+
     def __call__(self, text, strip=True) -> List[List[str]]:
         if isinstance(text, str):
             text = [text]
 
-        phonemized = self.backend.phonemize(
+        if self.cache is not None:
+            phonemized = self._phonemize_cached(text, strip, "utterance")
+        else:
+            phonemized = self._backend_phonemize(text, strip)
+        return [self.to_list(p) for p in phonemized]
+
+    def _backend_phonemize(self, text, strip):
+        return self.backend.phonemize(
             text, separator=self.separator, strip=strip, njobs=1
         )
-        return [self.to_list(p) for p in phonemized]
+
+
+class BatchPhonemizer(TextTokenizer):
+    """
+    TextTokenizer for lists of texts, cache misses are split into chunks of chunk_size and phonemized on a pool of n_workers processes,
+    each with its own espeak backend. espeak phonemizes every text independently, so the output (and its order) is the same as TextTokenizer's.
+    takes the same arguments as TextTokenizer, call close() when done
+    """
+    def __init__(self, n_workers: int = 4, chunk_size: int = 64, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.chunk_size = chunk_size
+        self.pool = None
+        if n_workers > 1:
+            # the workers only need data/phonemize_worker.py, see start_pool for how they are started
+            self.pool = start_pool(n_workers, self.backend_kwargs, self.separator)
+
+    def _backend_phonemize(self, text, strip):
+        if self.pool is None or len(text) <= self.chunk_size:
+            return super()._backend_phonemize(text, strip)
+        chunks = [(text[i:i+self.chunk_size], strip) for i in range(0, len(text), self.chunk_size)]
+        return [p for chunk in self.pool.map(phonemize_chunk, chunks) for p in chunk]
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
 
 
 def tokenize_text(tokenizer: TextTokenizer, text: str) -> List[str]:
     phonemes = tokenizer([text.strip()])
     return phonemes[0]  # k2symbols
 
+# resampling kernels are computed when the transform is built, so they are kept around, keyed by (orig_sr, target_sr, device)
+_resamplers = {}
+
+def get_resampler(orig_sr: int, target_sr: int, device: Any = "cpu"):
+    key = (orig_sr, target_sr, str(device))
+    if key not in _resamplers:
+        _resamplers[key] = torchaudio.transforms.Resample(orig_sr, target_sr).to(device)
+    return _resamplers[key]
+
 def convert_audio(wav: torch.Tensor, sr: int, target_sr: int, target_channels: int):
     assert wav.shape[0] in [1, 2], "Audio must be mono or stereo."
     if target_channels == 1:
@@ -95,9 +250,30 @@ def convert_audio(wav: torch.Tensor, sr: int, target_sr: int, target_channels: i
         wav = wav.expand(*shape, target_channels, length)
     elif wav.shape[0] == 1:
         wav = wav.expand(target_channels, -1)
-    wav = torchaudio.transforms.Resample(sr, target_sr)(wav)
+    if sr != target_sr:
+        wav = get_resampler(sr, target_sr, wav.device)(wav)
     return wav
 
+def crossfade(a: torch.Tensor, b: torch.Tensor, n: int):
+    """join two waveforms [C,T], the last n samples of a are faded out while the first n samples of b are faded in"""
+    n = min(n, a.shape[-1], b.shape[-1])
+    if n == 0:
+        return torch.cat([a, b], dim=-1)
+    fade_in = torch.linspace(0., 1., n, device=b.device, dtype=b.dtype)
+    mixed = a[..., -n:] * (1 - fade_in) + b[..., :n] * fade_in
+    return torch.cat([a[..., :-n], mixed, b[..., n:]], dim=-1)
+
+def load_audio(audio: Union[str, bytes, io.IOBase], offset: int = -1, num_frames: int = -1):
+    """
+    load audio from a path, from bytes (e.g. an upload that is already in memory), or from a file object.
+    if num_frames is given, only the frames [offset, offset+num_frames) are read (offset -1 means 0)
+    """
+    if isinstance(audio, (bytes, bytearray)):
+        audio = io.BytesIO(audio)
+    if num_frames != -1:
+        return torchaudio.load(audio, frame_offset=max(offset, 0), num_frames=num_frames)
+    return torchaudio.load(audio)
+
 class AudioTokenizer:
     """EnCodec audio."""
 
@@ -110,6 +286,8 @@ class AudioTokenizer:
         model = CompressionSolver.model_from_checkpoint(signature)
         self.sample_rate = model.sample_rate
         self.channels = model.channels
+        self.frame_rate = model.frame_rate
+        self.hop_length = int(round(self.sample_rate / self.frame_rate)) # waveform samples per code frame
         
         if not device:
             device = torch.device("cpu")
@@ -131,19 +309,97 @@ class AudioTokenizer:
     def decode(self, frames: torch.Tensor) -> torch.Tensor:
         frames = frames[0][0] # [1,4,T]
         return self.codec.decode(frames)
+
+    def encode_batch(self, wavs: List[torch.Tensor]) -> List[torch.Tensor]:
+        """
+        encode waveforms of different lengths ([C,T_i], already at the codec sample rate and channels) with one zero padded forward pass.
+        returns the codes [K,ceil(T_i/hop)] of each waveform.
+        the encoder isn't causal, so the last few codes of the shorter waveforms can differ from encoding them alone (e.g. with tokenize_audio),
+        waveforms of the same length need no padding
+        """
+        lens = [wav.shape[-1] for wav in wavs]
+        padded = torch.nn.utils.rnn.pad_sequence([wav.transpose(0,1) for wav in wavs], batch_first=True).transpose(1,2) # [B,C,T]
+        codes = self.codec.encode(padded.to(self.device))[0] # [B,K,T']
+        return [codes[i, :, :math.ceil(l / self.hop_length)] for i, l in enumerate(lens)]
+
+    def decode_batch(self, codes: List[torch.Tensor]) -> List[torch.Tensor]:
+        """
+        decode code sequences of different lengths ([K,T_i]) with one forward pass, returns the waveforms [C,T_i*hop].
+        shorter sequences are padded by repeating their last frame, the decoder isn't causal, so their last few samples can differ slightly from decoding them alone
+        """
+        lens = [c.shape[-1] for c in codes]
+        max_len = max(lens)
+        padded = torch.stack([torch.cat([c, c[:, -1:].expand(-1, max_len - c.shape[-1])], dim=-1) for c in codes], dim=0) # [B,K,T]
+        wav = self.codec.decode(padded.to(self.device)) # [B,C,T*hop]
+        return [wav[i, :, :l * self.hop_length] for i, l in enumerate(lens)]
+
+    def iter_decode(self, codes: torch.Tensor, window: int = 500, context: int = 50):
+        """
+        decode long code sequences [1,K,T] window by window, so that memory is bounded by the window size instead of the length of the sequence.
+        each window is decoded with `context` extra frames on both sides, which are cut off from the waveform, yields [1,C,window*hop] waveforms
+        """
+        hop = self.hop_length
+        T = codes.shape[-1]
+        for start in range(0, T, window):
+            end = min(T, start + window)
+            lo, hi = max(0, start - context), min(T, end + context)
+            with torch.no_grad():
+                wav = self.codec.decode(codes[..., lo:hi].to(self.device))
+            yield wav[..., (start - lo) * hop: (end - lo) * hop]
+
+    def decode_chunked(self, codes: torch.Tensor, window: int = 500, context: int = 50, overlap: int = 5, num_workers: Optional[int] = None):
+        """
+        decode codes [1,K,T] in overlapping windows on a pool of threads, returns the waveform [1,C,T*hop].
+        like iter_decode, each window is decoded with `context` extra frames on both sides (the decoder has no strict receptive field because of its lstm, 1 sec. of context
+        is enough to match the full decode closely), on top of that neighbouring windows share `overlap` frames, which are crossfaded (see crossfade) into a preallocated output.
+        at most 2 * num_workers windows are in flight, so peak memory of the decoder is bounded by num_workers windows, sequences that fit into one window are decoded in one pass.
+        on cpu, each thread also uses torch's intra-op threads, so num_workers * torch.get_num_threads() should not exceed the number of cores
+        """
+        hop = self.hop_length
+        T = codes.shape[-1]
+        if T <= window:
+            with torch.no_grad():
+                return self.codec.decode(codes.to(self.device))
+        if num_workers is None:
+            num_workers = max(1, min(4, (os.cpu_count() or 1) // torch.get_num_threads()))
+
+        def decode_window(start):
+            end = min(T, start + window + overlap)
+            lo, hi = max(0, start - context), min(T, end + context)
+            with torch.no_grad():
+                wav = self.codec.decode(codes[..., lo:hi].to(self.device))
+            return wav[..., (start - lo) * hop: (end - lo) * hop]
+
+        out = None
+        starts = iter(range(0, T, window))
+        with ThreadPoolExecutor(num_workers) as pool:
+            pending = deque(pool.submit(decode_window, start) for start in itertools.islice(starts, 2 * num_workers))
+            for n, start in enumerate(range(0, T, window)):
+                wav = pending.popleft().result()
+                next_start = next(starts, None)
+                if next_start is not None:
+                    pending.append(pool.submit(decode_window, next_start))
+                if out is None:
+                    out = wav.new_empty((*wav.shape[:-1], T * hop))
+                # the first samples of the window are shared with the previous one, which is already in out
+                n_fade = 0 if n == 0 else min(overlap * hop, wav.shape[-1])
+                cur = out[..., start * hop: start * hop + wav.shape[-1]]
+                if n_fade > 0:
+                    fade_in = torch.linspace(0., 1., n_fade, device=wav.device, dtype=wav.dtype)
+                    cur[..., :n_fade] = cur[..., :n_fade] * (1 - fade_in) + wav[..., :n_fade] * fade_in
+                cur[..., n_fade:] = wav[..., n_fade:]
+        return out
     
 
 
-def tokenize_audio(tokenizer: AudioTokenizer, audio_path: str, offset = -1, num_frames=-1):
-    # Load and pre-process the audio waveform
-    if offset != -1 and num_frames!=-1:
-        wav, sr = torchaudio.load(audio_path, frame_offset=offset, num_frames=num_frames)
-    else:
-        wav, sr = torchaudio.load(audio_path)
+def tokenize_audio(tokenizer: AudioTokenizer, audio_path: Union[str, bytes, io.IOBase], offset = -1, num_frames=-1, return_wav=False):
+    # Load and pre-process the audio waveform, audio_path can also be the content of the file
+    wav, sr = load_audio(audio_path, offset=offset, num_frames=num_frames)
     wav = convert_audio(wav, sr, tokenizer.sample_rate, tokenizer.channels)
-    wav = wav.unsqueeze(0)
 
     # Extract discrete codes from EnCodec
     with torch.no_grad():
-        encoded_frames = tokenizer.encode(wav)
+        encoded_frames = tokenizer.encode(wav.unsqueeze(0))
+    if return_wav: # the waveform at the codec sample rate, [C,T]
+        return encoded_frames, wav
     return encoded_frames
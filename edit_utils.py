@@ -1,3 +1,6 @@
+import difflib
+
+
 def get_span(orig, new, editType):
     orig_list = orig.split(" ")
     new_list = new.split(" ")
@@ -46,4 +49,27 @@ def get_span(orig, new, editType):
     if not flag:
         raise RuntimeError(f"wrong editing with the specified edit type:\n original: {orig}\n new: {new}\n, editType: {editType}")
 
-    return orig_span, new_span    
\ No newline at end of file
+    return orig_span, new_span
+
+
+def normalize_word(word):
+    return word.lower().strip(".,!?;:\"'")
+
+def get_spans(orig, new):
+    """
+    all edits between the transcripts orig and new, from a word level alignment (difflib), so that any number of separate changes can be found.
+    returns a list of (editType, orig_span, new_span), with the spans as in get_span: for a deletion new_span is the two words around the deleted part,
+    for an insertion orig_span is the two words around the insertion point (-1 or len(orig words) at the ends). punctuation and case are ignored
+    """
+    orig_list = orig.split()
+    new_list = new.split()
+    matcher = difflib.SequenceMatcher(a=[normalize_word(w) for w in orig_list], b=[normalize_word(w) for w in new_list], autojunk=False)
+    edits = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "replace":
+            edits.append(("substitution", [i1, i2 - 1], [j1, j2 - 1]))
+        elif tag == "delete":
+            edits.append(("deletion", [i1, i2 - 1], [j1 - 1, j1]))
+        elif tag == "insert":
+            edits.append(("insertion", [i1 - 1, i1], [j1, j2 - 1]))
+    return edits
@@ -0,0 +1,232 @@
+import argparse
+import hashlib
+import json
+import logging
+import multiprocessing as mp
+import os
+import time
+from collections import defaultdict
+
+import numpy as np
+import torch
+import torchaudio
+
+from bulk_synthesis import take_slot
+from data.tokenizer import AudioTokenizer, PhonemeCache, TextTokenizer, convert_audio, crossfade, load_audio
+from inference_tts_scale import generate_codes, get_model as get_exp_model
+from long_form import phonemize
+from pretrained import get_model
+from speech_edit import generate_edit_codes, word_span_interval, word_times
+
+# evaluation on a whole manifest, either tts (the format of inference_tts_scale.py) or speech editing (RealEdit.txt, the format of inference_speech_editing_scale.py),
+# with the same output files as those scripts. the manifest is read once in the main process (one torchaudio.info and one alignment read per audio file),
+# rows are grouped into batches of similar length and the batches are sharded across a pool of worker processes, each with its own device and share of the cpu cores.
+# in a batch, the prompts are encoded in one codec pass (and cached in cache_dir) and the outputs are decoded in one codec pass.
+# rows whose outputs exist are skipped, so a rerun only does what is missing. per row timings are appended to output_dir/eval_runner.jsonl
+#   python eval_runner.py --task edit --manifest_fn RealEdit.txt --audio_root path/to/RealEdit --output_dir ./realedit_out --num_workers 2 --devices cuda:0,cuda:1
+
+# set in each worker process by init_worker
+worker = {}
+
+
+def get_args():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--task", type=str, default="edit", choices=["tts", "edit"])
+    parser.add_argument("--manifest_fn", type=str, default="RealEdit.txt")
+    parser.add_argument("--audio_root", type=str, default="path/to/audio_folder", help="for editing, the alignments are expected in audio_root/aligned (or aligned_csv)")
+    parser.add_argument("--exp_dir", type=str, default=None, help="a training experiment folder (args.pkl and best_bundle.pth), if not set model_name is used")
+    parser.add_argument("--model_name", type=str, default="VoiceCraft_gigaHalfLibri330M_TTSEnhanced_max16s", help="a model in ./pretrained_models")
+    parser.add_argument("--signature", type=str, default="./pretrained_models/encodec_4cb2048_giga.th", help="path to the encodec model")
+    parser.add_argument("--output_dir", type=str, default="./eval_output")
+    parser.add_argument("--cache_dir", type=str, default=None, help="where the codes of the prompts are cached, output_dir/codes by default")
+    parser.add_argument("--batch_size", type=int, default=8, help="rows per batch, their prompts are encoded and their outputs decoded together")
+    parser.add_argument("--num_workers", type=int, default=1)
+    parser.add_argument("--devices", type=str, default="cuda" if torch.cuda.is_available() else "cpu", help="comma separated devices that workers are assigned to round robin, e.g. cuda:0,cuda:1")
+    parser.add_argument("--pin_cores", type=int, default=1, help="if true, split the cpu cores evenly among the workers and pin each worker to its share")
+    parser.add_argument("--phoneme_cache", type=str, default="./pretrained_models/phoneme_cache.sqlite", help="sqlite file of phonemized texts, shared by the workers")
+    parser.add_argument("--seed", type=int, default=1, help="every row is generated with this seed, so that the outputs don't depend on the sharding")
+    parser.add_argument("--codec_audio_sr", type=int, default=16000, help='the sample rate of audio that the codec is trained for')
+    parser.add_argument("--codec_sr", type=int, default=50, help='the sample rate of the codec codes')
+    parser.add_argument("--top_k", type=int, default=0, help="sampling param")
+    parser.add_argument("--top_p", type=float, default=0.8, help="sampling param")
+    parser.add_argument("--temperature", type=float, default=1.0, help="sampling param")
+    parser.add_argument("--stop_repetition", type=int, default=3, help="used for inference, when the number of consecutive repetition of a token is bigger than this, stop it")
+    parser.add_argument("--kvcache", type=int, default=1, help='if true, use kv cache, which is 4-8x faster than without')
+    parser.add_argument("--sample_batch_size", type=int, default=1, help="tts only, generate this many samples of each row and keep the shortest")
+    parser.add_argument("--silence_tokens", type=str, default="[1388,1898,131]", help="note that if you are not using the pretrained encodec 6f79c6a8, make sure you specified it yourself, rather than using the default")
+    parser.add_argument("--left_margin", type=float, default=0.08, help="editing only, extra space on the left to the word boundary")
+    parser.add_argument("--right_margin", type=float, default=0.08, help="editing only, extra space on the right to the word boundary")
+    parser.add_argument("--output_mode", type=str, default="both", choices=["gen", "concat", "both"], help="tts only, which audio to save: the generated continuation, the prompt followed by the continuation, or both")
+    parser.add_argument("--crossfade_sec", type=float, default=0.02, help="tts only, length of the crossfade between the prompt audio and the generated audio in concatenated outputs")
+    return parser.parse_args()
+
+
+def read_manifest(args):
+    """the rows of the manifest, with what the workers need to generate them (prompt range, text, mask intervals) and their output files"""
+    with open(args.manifest_fn, "r") as f:
+        manifest = [l.rstrip("\n").split("\t") for l in f.readlines()[1:] if l.strip()]
+    infos, alignments = {}, {} # one torchaudio.info and one alignment read per audio file
+    rows = []
+    for i, item in enumerate(manifest):
+        audio_fn = os.path.join(args.audio_root, item[0])
+        if audio_fn not in infos:
+            infos[audio_fn] = torchaudio.info(audio_fn)
+        info = infos[audio_fn]
+        if args.task == "tts":
+            # wav_fn, new_audio_fn, text, prompt end (sec), ..., word span of the text after the prompt
+            num_frames = round(float(item[3]) * info.sample_rate)
+            name = os.path.splitext(item[1])[0]
+            outputs = {mode: f"{args.output_dir}/{mode}_{name}_{i}_seed{args.seed}.wav" for mode in ["gen", "concat"] if args.output_mode in [mode, "both"]}
+            rows.append(dict(idx=i, audio_fn=audio_fn, num_frames=num_frames, n_samples=num_frames, text=item[2], outputs=outputs))
+        else:
+            # wav_fn, orig_transcript, new_transcript, orig_masked_span, new_masked_span, type, several edits of a row are separated by |
+            alignment_fn = os.path.join(args.audio_root, "aligned", os.path.splitext(item[0])[0] + ".csv")
+            if not os.path.isfile(alignment_fn):
+                alignment_fn = alignment_fn.replace("/aligned/", "/aligned_csv/")
+            if alignment_fn not in alignments:
+                alignments[alignment_fn] = word_times(alignment_fn)
+            words = alignments[alignment_fn]
+            audio_dur = info.num_frames / info.sample_rate
+            mask_interval = sorted(
+                word_span_interval(words, int(span.split(",")[0]), int(span.split(",")[-1]), editType, audio_dur, args.left_margin, args.right_margin, args.codec_sr)
+                for span, editType in zip(item[3].split("|"), item[5].split("|"))
+            )
+            name = os.path.splitext(os.path.basename(item[0]))[0]
+            outputs = {"new": f"{args.output_dir}/{name}_new_seed{args.seed}.wav"}
+            rows.append(dict(idx=i, audio_fn=audio_fn, num_frames=-1, n_samples=info.num_frames, text=item[2].split("|")[-1], mask_interval=mask_interval, outputs=outputs))
+    return rows
+
+
+def codes_path(cache_dir, row):
+    # the codes depend on the audio file (and its version) and the part of it that is encoded
+    key = f"{os.path.abspath(row['audio_fn'])}:{os.path.getmtime(row['audio_fn'])}:{row['num_frames']}"
+    return os.path.join(cache_dir, f"{hashlib.sha1(key.encode()).hexdigest()}.pt")
+
+
+def init_worker(slots, args):
+    slot, device = take_slot(slots, args.num_workers, args.devices, args.pin_cores)
+    if args.exp_dir is not None:
+        model, model_args, phn2num = get_exp_model(args.exp_dir, device)
+    else:
+        model = get_model(args.model_name, device)
+        model_args, phn2num = model.args, model.args.phn2num
+    worker.update(
+        slot=slot,
+        device=device,
+        model=model,
+        model_args=model_args,
+        phn2num=phn2num,
+        text_tokenizer=TextTokenizer(backend="espeak", cache=PhonemeCache(args.phoneme_cache)),
+        audio_tokenizer=AudioTokenizer(signature=args.signature, device=device),
+        decode_config=vars(args),
+        args=args,
+    )
+
+
+@torch.no_grad()
+def run_batch(rows):
+    """generate a batch of rows in a worker, returns a record with the timings of each row"""
+    args, model, audio_tokenizer = worker["args"], worker["model"], worker["audio_tokenizer"]
+    stime = time.time()
+    wavs = []
+    for row in rows:
+        wav, sr = load_audio(row["audio_fn"], offset=0, num_frames=row["num_frames"])
+        wavs.append(convert_audio(wav, sr, audio_tokenizer.sample_rate, audio_tokenizer.channels))
+    # encode the prompts that are not cached yet, one pass per length: padding would change the last codes of the shorter prompts,
+    # and the prompts have to be the same as tokenize_audio's
+    paths = [codes_path(args.cache_dir, row) for row in rows]
+    missing = defaultdict(list)
+    for i, path in enumerate(paths):
+        if not os.path.isfile(path):
+            missing[wavs[i].shape[-1]].append(i)
+    codes = {}
+    for group in missing.values():
+        for i, c in zip(group, audio_tokenizer.encode_batch([wavs[i] for i in group])):
+            codes[i] = c.unsqueeze(0).cpu() # [1,K,T]
+            tmp_path = f"{paths[i]}.{os.getpid()}.tmp"
+            torch.save(codes[i], tmp_path)
+            os.replace(tmp_path, paths[i])
+    for i, path in enumerate(paths):
+        if i not in codes:
+            codes[i] = torch.load(path, map_location="cpu")
+    encode_sec = time.time() - stime
+
+    frames, model_sec = [], []
+    for i, row in enumerate(rows):
+        text_tokens = torch.LongTensor(phonemize(worker["text_tokenizer"], worker["phn2num"], row["text"])).unsqueeze(0)
+        text_tokens_lens = torch.LongTensor([text_tokens.shape[-1]])
+        generator = torch.Generator(device=worker["device"]).manual_seed(args.seed)
+        row_stime = time.time()
+        if args.task == "tts":
+            _, gen_frames = generate_codes(model, worker["model_args"], text_tokens, text_tokens_lens, codes[i].transpose(2,1), worker["device"], worker["decode_config"], generator=generator)
+        else:
+            gen_frames = generate_edit_codes(model, worker["model_args"], text_tokens, text_tokens_lens, codes[i], torch.LongTensor(row["mask_interval"]), worker["device"], worker["decode_config"], generator=generator)
+        frames.append(gen_frames[0])
+        model_sec.append(time.time() - row_stime)
+
+    # decode all outputs in one pass
+    decode_stime = time.time()
+    audios = [audio.cpu() for audio in audio_tokenizer.decode_batch(frames)]
+    decode_sec = time.time() - decode_stime
+
+    records = []
+    for i, row in enumerate(rows):
+        audio = audios[i]
+        if args.task == "tts":
+            saved = {"gen": audio, "concat": crossfade(wavs[i], audio, int(args.crossfade_sec * args.codec_audio_sr)) if "concat" in row["outputs"] else None}
+        else:
+            saved = {"new": audio}
+        for mode, fn in row["outputs"].items():
+            torchaudio.save(fn, saved[mode], args.codec_audio_sr)
+        records.append({
+            "idx": row["idx"], "outputs": list(row["outputs"].values()), "sec": audio.shape[-1] / args.codec_audio_sr,
+            "model_time": model_sec[i], "latency": model_sec[i] + (encode_sec + decode_sec) / len(rows), # the codec passes are shared by the batch
+            "n_encoded": len(missing), "worker": worker["slot"],
+        })
+    return records
+
+
+def make_batches(rows, batch_size):
+    # rows of similar length go into the same batch, so that the codec passes waste little on padding
+    rows = sorted(rows, key=lambda row: row["n_samples"])
+    return [rows[i:i + batch_size] for i in range(0, len(rows), batch_size)]
+
+
+if __name__ == "__main__":
+    formatter = (
+        "%(asctime)s [%(levelname)s] %(filename)s:%(lineno)d || %(message)s"
+    )
+    logging.basicConfig(format=formatter, level=logging.INFO)
+    args = get_args()
+    if args.cache_dir is None:
+        args.cache_dir = os.path.join(args.output_dir, "codes")
+    os.makedirs(args.output_dir, exist_ok=True)
+    os.makedirs(args.cache_dir, exist_ok=True)
+
+    stime = time.time()
+    rows = read_manifest(args)
+    todo = [row for row in rows if not all(os.path.isfile(fn) for fn in row["outputs"].values())]
+    logging.info(f"{len(rows)} rows, {len(rows) - len(todo)} already done, {len(todo)} to go, reading the manifest took {time.time() - stime:.2f} sec")
+
+    if len(todo) > 0:
+        batches = make_batches(todo, args.batch_size)
+        ctx = mp.get_context("spawn") # cuda can't be used in forked processes
+        slots = ctx.Queue()
+        for slot in range(args.num_workers):
+            slots.put(slot)
+        stime = time.time()
+        latencies, total_sec, n_done = [], 0., 0
+        with ctx.Pool(args.num_workers, initializer=init_worker, initargs=(slots, args)) as pool, open(os.path.join(args.output_dir, "eval_runner.jsonl"), "a") as log_f:
+            for records in pool.imap_unordered(run_batch, batches):
+                for record in records:
+                    log_f.write(json.dumps(record) + "\n")
+                log_f.flush()
+                latencies += [record["latency"] for record in records]
+                total_sec += sum(record["sec"] for record in records)
+                n_done += len(records)
+                elapsed = time.time() - stime
+                logging.info(f"{n_done}/{len(todo)} rows, {n_done/elapsed:.2f} rows/sec, {total_sec/elapsed:.2f} sec. of audio per sec., eta {elapsed / n_done * (len(todo) - n_done) / 60:.1f} min")
+        elapsed = time.time() - stime
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+        logging.info(f"done {n_done} rows in {elapsed:.1f} sec with {args.num_workers} workers: {n_done/elapsed:.2f} rows/sec, {total_sec/elapsed:.2f} sec. of audio per sec.")
+        logging.info(f"latency per row: p50 {p50:.2f} sec, p90 {p90:.2f} sec, p99 {p99:.2f} sec, mean {np.mean(latencies):.2f} sec")
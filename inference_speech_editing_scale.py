@@ -9,6 +9,7 @@ from data.tokenizer import (
     AudioTokenizer,
     TextTokenizer,
     tokenize_audio,
+    get_resampler,
     tokenize_text
 )
 
@@ -38,7 +39,7 @@ def get_args():
     return parser.parse_args()
 
 @torch.no_grad()
-def inference_one_sample(model, model_args, phn2num, text_tokenizer, audio_tokenizer, audio_fn, target_text, mask_interval, device, decode_config):
+def inference_one_sample(model, model_args, phn2num, text_tokenizer, audio_tokenizer, audio_fn, target_text, mask_interval, device, decode_config, generator=None):
     # phonemize
     text_tokens = [phn2num[phn] for phn in
             tokenize_text(
@@ -66,6 +67,7 @@ def inference_one_sample(model, model_args, phn2num, text_tokenizer, audio_token
         stop_repetition=decode_config['stop_repetition'],
         kvcache=decode_config['kvcache'],
         silence_tokens=eval(decode_config['silence_tokens']) if type(decode_config['silence_tokens']) == str else decode_config['silence_tokens'],
+        generator=generator,
     ) # output is [1,K,T]
     logging.info(f"inference on one sample take: {time.time() - stime:.4f} sec.")
     if type(encoded_frames) == tuple:
@@ -74,12 +76,8 @@ def inference_one_sample(model, model_args, phn2num, text_tokenizer, audio_token
     
 
     # decode (both original and generated)
-    original_sample = audio_tokenizer.decode(
-        [(original_audio.transpose(2,1), None)] # [1,T,8] -> [1,8,T]
-    )
-    generated_sample = audio_tokenizer.decode(
-        [(encoded_frames, None)]
-    )
+    original_sample, generated_sample = audio_tokenizer.decode_batch([original_audio[0].transpose(1,0), encoded_frames[0]]) # [T,8] -> [8,T], one forward pass for both
+    original_sample, generated_sample = original_sample.unsqueeze(0), generated_sample.unsqueeze(0) # [1,C,T]
 
     return original_sample, generated_sample
 
@@ -221,6 +219,6 @@ if __name__ == "__main__":
         if not os.path.isfile(save_fn_orig):
             orig_audio, orig_sr = torchaudio.load(audio_fn)
             if orig_sr != args.codec_audio_sr:
-                orig_audio = torchaudio.transforms.Resample(orig_sr, args.codec_audio_sr)(orig_audio)
+                orig_audio = get_resampler(orig_sr, args.codec_audio_sr)(orig_audio)
             torchaudio.save(save_fn_orig, orig_audio, args.codec_audio_sr)
 
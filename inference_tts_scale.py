@@ -1,4 +1,5 @@
 import argparse, pickle
+import contextlib
 import logging
 import os, random
 import numpy as np
@@ -8,11 +9,14 @@ import torchaudio
 from data.tokenizer import (
     AudioTokenizer,
     TextTokenizer,
+    crossfade,
     tokenize_audio,
     tokenize_text
 )
 
 from models import voicecraft
+from models.modules.profiler import DecodeProfiler
+from models.speculative import inference_tts_speculative
 import argparse, time, tqdm
 
 
@@ -36,29 +40,43 @@ def get_args():
     parser.add_argument("--kvcache", type=int, default=1, help='if true, use kv cache, which is 4-8x faster than without')
     parser.add_argument("--sample_batch_size", type=int, default=1, help="batch size for sampling, NOTE that it's not running inference for several samples, but duplicate one input sample batch_size times, and during inference, we only return the shortest generation")
     parser.add_argument("--silence_tokens", type=str, default="[1388,1898,131]", help="note that if you are not using the pretrained encodec 6f79c6a8, make sure you specified it yourself, rather than using the default")
+    parser.add_argument("--compile_decode", type=int, default=0, help="if true, use a torch.compile'd per-frame decoding step (only used together with kvcache)")
+    parser.add_argument("--decode_bucket_size", type=int, default=256, help="the kv cache length is rounded up to a multiple of this for the compiled decoding step, a new bucket means a recompile")
+    parser.add_argument("--compile_cache_dir", type=str, default="./pretrained_models/compile_cache", help="where compiled kernels are cached across runs")
+    parser.add_argument("--draft_exp_dir", type=str, default=None, help="if set, use the (smaller) model in this folder as the draft model for speculative decoding, e.g. the 330M model for the 830M model. only used with sample_batch_size 1")
+    parser.add_argument("--n_draft", type=int, default=4, help="number of frames the draft model proposes per round in speculative decoding")
+    parser.add_argument("--output_mode", type=str, default="both", choices=["gen", "concat", "both"], help="which audio to save: the generated continuation, the prompt followed by the continuation, or both")
+    parser.add_argument("--profile_dir", type=str, default=None, help="if set, the decoding of every sample is profiled, a per step table and a chrome trace are saved here")
+    parser.add_argument("--crossfade_sec", type=float, default=0.02, help="length of the crossfade between the original prompt audio and the generated audio in concatenated outputs")
     return parser.parse_args()
 
 
 @torch.no_grad()
-def inference_one_sample(model, model_args, phn2num, text_tokenizer, audio_tokenizer, audio_fn, target_text, device, decode_config, prompt_end_frame):
-    # phonemize
-    text_tokens = [phn2num[phn] for phn in
-            tokenize_text(
-                text_tokenizer, text=target_text.strip()
-            ) if phn in phn2num
-        ]
-    text_tokens = torch.LongTensor(text_tokens).unsqueeze(0)
-    text_tokens_lens = torch.LongTensor([text_tokens.shape[-1]])
-
-    # encode audio
-    encoded_frames = tokenize_audio(audio_tokenizer, audio_fn, offset=0, num_frames=prompt_end_frame)
-    original_audio = encoded_frames[0][0].transpose(2,1) # [1,T,K]
-    assert original_audio.ndim==3 and original_audio.shape[0] == 1 and original_audio.shape[2] == model_args.n_codebooks, original_audio.shape
-    logging.info(f"original audio length: {original_audio.shape[1]} codec frames, which is {original_audio.shape[1]/decode_config['codec_sr']:.2f} sec.")
-
-    # forward
+def generate_codes(model, model_args, text_tokens, text_tokens_lens, original_audio, device, decode_config, draft_model=None, generator=None, timer=None):
+    """
+    run tts on already phonemized text and encoded prompt, original_audio is [1,T,K]. returns (concat_frames, gen_frames), both [1,K,T].
+    if timer (a metrics.StageTimer) is given, the prefill and decoding time of the model are added to it
+    """
     stime = time.time()
-    if decode_config['sample_batch_size'] <= 1:
+    model.last_decode_stats = None
+    silence_tokens = eval(decode_config['silence_tokens']) if type(decode_config['silence_tokens'])==str else decode_config['silence_tokens']
+    if draft_model is not None and decode_config['sample_batch_size'] <= 1:
+        logging.info(f"running speculative decoding with a draft model, {decode_config.get('n_draft', 4)} draft frames per round")
+        concat_frames, gen_frames = inference_tts_speculative(
+            model,
+            draft_model,
+            text_tokens.to(device),
+            text_tokens_lens.to(device),
+            original_audio[...,:model_args.n_codebooks].to(device), # [1,T,8]
+            top_k=decode_config['top_k'],
+            top_p=decode_config['top_p'],
+            temperature=decode_config['temperature'],
+            stop_repetition=decode_config['stop_repetition'],
+            silence_tokens=silence_tokens,
+            n_draft=decode_config.get('n_draft', 4),
+            generator=generator
+        ) # output is [1,K,T]
+    elif decode_config['sample_batch_size'] <= 1:
         logging.info(f"running inference with batch size 1")
         concat_frames, gen_frames = model.inference_tts(
             text_tokens.to(device),
@@ -69,7 +87,8 @@ def inference_one_sample(model, model_args, phn2num, text_tokenizer, audio_token
             temperature=decode_config['temperature'],
             stop_repetition=decode_config['stop_repetition'],
             kvcache=decode_config['kvcache'],
-            silence_tokens=eval(decode_config['silence_tokens']) if type(decode_config['silence_tokens'])==str else decode_config['silence_tokens']
+            silence_tokens=silence_tokens,
+            generator=generator
         ) # output is [1,K,T]
     else:
         logging.info(f"running inference with batch size {decode_config['sample_batch_size']}, i.e. return the shortest among {decode_config['sample_batch_size']} generations.")
@@ -83,25 +102,63 @@ def inference_one_sample(model, model_args, phn2num, text_tokenizer, audio_token
             stop_repetition=decode_config['stop_repetition'],
             kvcache=decode_config['kvcache'],
             batch_size = decode_config['sample_batch_size'],
-            silence_tokens=eval(decode_config['silence_tokens']) if type(decode_config['silence_tokens'])==str else decode_config['silence_tokens']
+            silence_tokens=silence_tokens,
+            generator=generator
         ) # output is [1,K,T]
     logging.info(f"inference on one sample take: {time.time() - stime:.4f} sec.")
-
     logging.info(f"generated encoded_frames.shape: {gen_frames.shape}, which is {gen_frames.shape[-1]/decode_config['codec_sr']} sec.")
+    if timer is not None and model.last_decode_stats is not None: # speculative decoding doesn't report them
+        timer.add_decode_stats(model.last_decode_stats)
+    return concat_frames, gen_frames
+
+def timed(timer, stage):
+    """timer.stage(stage), or nothing if there is no timer"""
+    return timer.stage(stage) if timer is not None else contextlib.nullcontext()
+
+@torch.no_grad()
+def inference_one_sample(model, model_args, phn2num, text_tokenizer, audio_tokenizer, audio_fn, target_text, device, decode_config, prompt_end_frame, draft_model=None, generator=None, return_frames=False, output_mode="both", crossfade_sec=0.02, timer=None):
+    """
+    returns (concat_sample, gen_sample), each [1,C,T] or None if not requested by output_mode (gen, concat or both).
+    only the generated codes are decoded, the concatenated audio is the original prompt audio crossfaded into the generated audio.
+    timer is an optional metrics.StageTimer that the time of each stage is added to
+    """
+    assert output_mode in ["gen", "concat", "both"], output_mode
+    # phonemize
+    with timed(timer, "phonemize"):
+        text_tokens = [phn2num[phn] for phn in
+                tokenize_text(
+                    text_tokenizer, text=target_text.strip()
+                ) if phn in phn2num
+            ]
+    text_tokens = torch.LongTensor(text_tokens).unsqueeze(0)
+    text_tokens_lens = torch.LongTensor([text_tokens.shape[-1]])
+
+    # encode audio
+    with timed(timer, "prompt_encode"):
+        encoded_frames, prompt_wav = tokenize_audio(audio_tokenizer, audio_fn, offset=0, num_frames=prompt_end_frame, return_wav=True)
+    original_audio = encoded_frames[0][0].transpose(2,1) # [1,T,K]
+    assert original_audio.ndim==3 and original_audio.shape[0] == 1 and original_audio.shape[2] == model_args.n_codebooks, original_audio.shape
+    logging.info(f"original audio length: {original_audio.shape[1]} codec frames, which is {original_audio.shape[1]/decode_config['codec_sr']:.2f} sec.")
+
+    # forward
+    concat_frames, gen_frames = generate_codes(model, model_args, text_tokens, text_tokens_lens, original_audio, device, decode_config, draft_model=draft_model, generator=generator, timer=timer)
     
     # for timestamp, codes in enumerate(gen_frames[0].transpose(1,0)):
     #     logging.info(f"{timestamp}: {codes.tolist()}")
-    # decode (both original and generated)
-    concat_sample = audio_tokenizer.decode(
-        [(concat_frames, None)] # [1,T,8] -> [1,8,T]
-    )
-    gen_sample = audio_tokenizer.decode(
-        [(gen_frames, None)]
-    )
+    # decode the generated codes only, the prompt is taken from the original audio rather than decoded again
+    with timed(timer, "codec_decode"):
+        gen_sample = audio_tokenizer.decode_chunked(gen_frames) # [1,C,T], long generations are decoded in parallel windows
+    concat_sample = None
+    if output_mode != "gen":
+        concat_sample = crossfade(prompt_wav.to(gen_sample.device), gen_sample[0], int(crossfade_sec * audio_tokenizer.sample_rate)).unsqueeze(0)
+    if output_mode == "concat":
+        gen_sample = None
     #Empty cuda cache between runs
     if torch.cuda.is_available():
         torch.cuda.empty_cache()
     # return
+    if return_frames:
+        return concat_sample, gen_sample, gen_frames
     return concat_sample, gen_sample
 
 def get_model(exp_dir, device=None):
@@ -153,6 +210,12 @@ if __name__ == "__main__":
     logging.info(f"loading model from {args.exp_dir}")
     model, model_args, phn2num = get_model(args.exp_dir)
     logging.info(f"loading model done, took {time.time() - stime:.4f} sec")
+    if args.compile_decode:
+        model.enable_compiled_decode(bucket_size=args.decode_bucket_size, cache_dir=args.compile_cache_dir)
+    draft_model = None
+    if args.draft_exp_dir is not None:
+        logging.info(f"loading draft model from {args.draft_exp_dir}")
+        draft_model, _, _ = get_model(args.draft_exp_dir)
 
     # setup text and audio tokenizer
     text_tokenizer = TextTokenizer(backend="espeak")
@@ -177,16 +240,25 @@ if __name__ == "__main__":
 
     for i, (audio_fn, text, prompt_end_frame, new_audio_fn, to_syn) in enumerate(tqdm.tqdm((zip(audio_fns, texts, prompt_end_frames, new_audio_fns, text_to_syn)))):
         output_expected_sr = args.codec_audio_sr
-        concated_audio, gen_audio = inference_one_sample(model, model_args, phn2num, text_tokenizer, audio_tokenizer, audio_fn, text, args.device, vars(args), prompt_end_frame)
+        profiler = contextlib.nullcontext()
+        if args.profile_dir is not None:
+            os.makedirs(args.profile_dir, exist_ok=True)
+            profiler = DecodeProfiler(model, trace_path=f"{args.profile_dir}/{new_audio_fn[:-4]}_{i}_trace.json")
+        with profiler:
+            concated_audio, gen_audio = inference_one_sample(model, model_args, phn2num, text_tokenizer, audio_tokenizer, audio_fn, text, args.device, vars(args), prompt_end_frame, draft_model=draft_model, output_mode=args.output_mode, crossfade_sec=args.crossfade_sec)
+        if args.profile_dir is not None:
+            logging.info(f"decode profile:\n{profiler.summary()}")
+            with open(f"{args.profile_dir}/{new_audio_fn[:-4]}_{i}_profile.txt", "w") as f:
+                f.write(profiler.summary())
     
         # save segments for comparison
-        concated_audio, gen_audio = concated_audio[0].cpu(), gen_audio[0].cpu()
-        if output_expected_sr != args.codec_audio_sr:
-            gen_audio = torchaudio.transforms.Resample(output_expected_sr, args.codec_audio_sr)(gen_audio)
-            concated_audio = torchaudio.transforms.Resample(output_expected_sr, args.codec_audio_sr)(concated_audio)
-
         seg_save_fn_gen = f"{args.output_dir}/gen_{new_audio_fn[:-4]}_{i}_seed{args.seed}.wav"
         seg_save_fn_concat = f"{args.output_dir}/concat_{new_audio_fn[:-4]}_{i}_seed{args.seed}.wav"        
 
-        torchaudio.save(seg_save_fn_gen, gen_audio, args.codec_audio_sr)
-        torchaudio.save(seg_save_fn_concat, concated_audio, args.codec_audio_sr)
+        for audio, save_fn in [(gen_audio, seg_save_fn_gen), (concated_audio, seg_save_fn_concat)]:
+            if audio is None:
+                continue
+            audio = audio[0].cpu()
+            if output_expected_sr != args.codec_audio_sr:
+                audio = torchaudio.transforms.Resample(output_expected_sr, args.codec_audio_sr)(audio)
+            torchaudio.save(save_fn, audio, args.codec_audio_sr)
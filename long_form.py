@@ -0,0 +1,193 @@
+import argparse
+import logging
+import re
+import time
+import wave
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+import torchaudio
+
+from data.tokenizer import get_resampler, tokenize_audio, tokenize_text
+from inference_tts_scale import generate_codes, timed
+
+
+def split_text(text, max_words=30):
+    """
+    split text into segments that are short enough for the model (which is trained on utterances of up to ~16-20 sec).
+    sentences are merged up to max_words words, sentences that are longer than that are split at commas and then at max_words
+    """
+    sentences = [s.strip() for s in re.split(r"(?<=[.!?;:])\s+", text.strip()) if s.strip()]
+    pieces = []
+    for sentence in sentences:
+        if len(sentence.split()) <= max_words:
+            pieces.append(sentence)
+            continue
+        cur = []
+        for clause in re.split(r"(?<=,)\s+", sentence):
+            words = clause.split()
+            if cur and len(cur) + len(words) > max_words:
+                pieces.append(" ".join(cur))
+                cur = []
+            cur.extend(words)
+            while len(cur) > max_words:
+                pieces.append(" ".join(cur[:max_words]))
+                cur = cur[max_words:]
+        if cur:
+            pieces.append(" ".join(cur))
+    segments = []
+    for piece in pieces:
+        if segments and len(segments[-1].split()) + len(piece.split()) <= max_words:
+            segments[-1] = segments[-1] + " " + piece
+        else:
+            segments.append(piece)
+    return segments
+
+
+def phonemize(text_tokenizer, phn2num, text):
+    return [phn2num[phn] for phn in tokenize_text(text_tokenizer, text=text.strip()) if phn in phn2num]
+
+
+def phonemize_batch(text_tokenizer, phn2num, texts):
+    # one call for many texts, which a BatchPhonemizer spreads over its worker processes
+    return [[phn2num[phn] for phn in phns if phn in phn2num] for phns in text_tokenizer([text.strip() for text in texts])]
+
+
+@torch.no_grad()
+def synthesize_long_form(model, model_args, phn2num, text_tokenizer, audio_tokenizer, audio_fn, prompt_transcript, target_text, device, decode_config, prompt_end_frame, max_words=30, rolling_prompt=False, max_prompt_frames=250, draft_model=None, generator=None, phonemize_chunk=16, timer=None):
+    """
+    tts for text of any length. the text is split into segments, each segment is generated with its own call to the model.
+    segments are phonemized in batches of phonemize_chunk in a background thread, ahead of the segment that is being decoded
+    (text_tokenizer can be a BatchPhonemizer to spread the batches over several processes).
+    if rolling_prompt, the codes and text of the previous segment are the prompt of the next one (to keep prosody continuous),
+    as long as it is not longer than max_prompt_frames, otherwise (and for the first segment) the original voice prompt is used.
+    audio_fn can also be the content of the audio file. returns the generated codes of all segments stitched together, [1,K,T] on cpu, decode them with audio_tokenizer.iter_decode.
+    timer is an optional metrics.StageTimer, phonemization only counts the time spent waiting for the background thread
+    """
+    segments = split_text(target_text, max_words=max_words)
+    logging.info(f"long form synthesis of {len(segments)} segments")
+    word_sep = [phn2num[text_tokenizer.separator.word]] if text_tokenizer.separator.word in phn2num else []
+
+    # the original prompt, encoded and phonemized once, together with the first segment
+    with timed(timer, "prompt_encode"):
+        encoded_frames = tokenize_audio(audio_tokenizer, audio_fn, offset=0, num_frames=prompt_end_frame)
+    voice_prompt = encoded_frames[0][0].transpose(2,1).cpu() # [1,T,K]
+    with timed(timer, "phonemize"):
+        voice_prompt_phn, first_phn = phonemize_batch(text_tokenizer, phn2num, [prompt_transcript, segments[0]])
+
+    gen_codes = []
+    prompt, prompt_phn = voice_prompt, voice_prompt_phn
+    stime = time.time()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # all batches are queued right away, the single thread works through them in order
+        futures = [executor.submit(phonemize_batch, text_tokenizer, phn2num, segments[j:j+phonemize_chunk]) for j in range(1, len(segments), phonemize_chunk)]
+        for i, segment in enumerate(segments):
+            with timed(timer, "phonemize"):
+                segment_phn = first_phn if i == 0 else futures[(i-1) // phonemize_chunk].result()[(i-1) % phonemize_chunk]
+            logging.info(f"segment {i+1}/{len(segments)}: {segment}")
+            text_tokens = torch.LongTensor(prompt_phn + word_sep + segment_phn).unsqueeze(0)
+            text_tokens_lens = torch.LongTensor([text_tokens.shape[-1]])
+            _, gen_frames = generate_codes(model, model_args, text_tokens, text_tokens_lens, prompt, device, decode_config, draft_model=draft_model, generator=generator, timer=timer)
+            gen_frames = gen_frames.cpu() # [1,K,T]
+            gen_codes.append(gen_frames)
+            # special tokens (which a well trained model shouldn't produce in the middle of a generation) can't be fed back as a prompt
+            if rolling_prompt and 0 < gen_frames.shape[-1] <= max_prompt_frames and (gen_frames < model.args.audio_vocab_size).all():
+                prompt, prompt_phn = gen_frames.transpose(2,1), segment_phn
+            else:
+                prompt, prompt_phn = voice_prompt, voice_prompt_phn
+    codes = torch.cat(gen_codes, dim=-1)
+    logging.info(f"long form synthesis took {time.time() - stime:.2f} sec. for {codes.shape[-1]/decode_config['codec_sr']:.2f} sec. of audio")
+    return codes
+
+
+def write_wav(f, chunks, sample_rate):
+    """
+    write waveform chunks ([1,1,T] or [1,T] float tensors in [-1,1]) to a 16 bit wav file as they come, f is a path or a file object.
+    returns the number of samples written
+    """
+    n_samples = 0
+    with wave.open(f, "wb") as wf:
+        wf.setnchannels(1)
+        wf.setsampwidth(2)
+        wf.setframerate(sample_rate)
+        for chunk in chunks:
+            chunk = chunk.reshape(-1).float().clamp(-1, 1).cpu().numpy()
+            wf.writeframes((chunk * 32767).astype(np.int16).tobytes())
+            n_samples += len(chunk)
+    return n_samples
+
+
+# output formats and their media types, the compressed ones are encoded by torchaudio's backend, which might not support all of them
+AUDIO_FORMATS = {"wav": "audio/wav", "flac": "audio/flac", "ogg": "audio/ogg", "mp3": "audio/mpeg"}
+
+
+def encode_audio(f, chunks, sample_rate, format="wav", target_sr=None, compression=None):
+    """
+    write waveform chunks (as in write_wav) to f as one of AUDIO_FORMATS, resampled to target_sr (default: sample_rate).
+    wav at the original sample rate is written as the chunks come, anything else needs the whole waveform in memory.
+    compression is passed to torchaudio.save (e.g. the bitrate in kbps for mp3, the quality for ogg vorbis). returns the number of samples written
+    """
+    assert format in AUDIO_FORMATS, f"unsupported audio format {format}, choose from {list(AUDIO_FORMATS)}"
+    target_sr = target_sr or sample_rate
+    if format == "wav" and target_sr == sample_rate:
+        return write_wav(f, chunks, sample_rate)
+    wav = torch.cat([chunk.reshape(1, -1).float().cpu() for chunk in chunks], dim=-1) # [1,T]
+    if target_sr != sample_rate:
+        wav = get_resampler(sample_rate, target_sr)(wav)
+    if format == "wav":
+        return write_wav(f, [wav], target_sr)
+    torchaudio.save(f, wav.clamp(-1, 1), target_sr, format=format, compression=compression)
+    return wav.shape[-1]
+
+
+if __name__ == "__main__":
+    from data.tokenizer import AudioTokenizer, BatchPhonemizer
+    from inference_tts_scale import get_model
+    formatter = (
+        "%(asctime)s [%(levelname)s] %(filename)s:%(lineno)d || %(message)s"
+    )
+    logging.basicConfig(format=formatter, level=logging.INFO)
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--exp_dir", type=str, default="path/to/model_folder")
+    parser.add_argument("--draft_exp_dir", type=str, default=None, help="optional draft model for speculative decoding")
+    parser.add_argument("--signature", type=str, default=None, help="path to the encodec model")
+    parser.add_argument("--audio_fn", type=str, default="path/to/voice_prompt.wav")
+    parser.add_argument("--prompt_transcript", type=str, default="", help="transcript of the voice prompt, up to prompt_end_sec")
+    parser.add_argument("--prompt_end_sec", type=float, default=3.0)
+    parser.add_argument("--text_fn", type=str, default="path/to/text.txt", help="the text to synthesize")
+    parser.add_argument("--output_fn", type=str, default="long_form.wav")
+    parser.add_argument("--output_format", type=str, default="wav", choices=list(AUDIO_FORMATS))
+    parser.add_argument("--output_sr", type=int, default=None, help="sample rate of the output, defaults to the codec sample rate")
+    parser.add_argument("--max_words", type=int, default=30, help="max number of words per segment")
+    parser.add_argument("--rolling_prompt", type=int, default=0, help="if true, the previous segment is used as the prompt of the next one")
+    parser.add_argument("--max_prompt_frames", type=int, default=250, help="the previous segment is only used as prompt if it is not longer than this")
+    parser.add_argument("--phonemize_workers", type=int, default=4, help="number of processes for phonemization")
+    parser.add_argument("--decode_window", type=int, default=500, help="number of codec frames decoded at a time")
+    parser.add_argument("--codec_audio_sr", type=int, default=16000)
+    parser.add_argument("--codec_sr", type=int, default=50)
+    parser.add_argument("--top_k", type=int, default=0)
+    parser.add_argument("--top_p", type=float, default=0.8)
+    parser.add_argument("--temperature", type=float, default=1.0)
+    parser.add_argument("--stop_repetition", type=int, default=3)
+    parser.add_argument("--kvcache", type=int, default=1)
+    parser.add_argument("--sample_batch_size", type=int, default=1)
+    parser.add_argument("--n_draft", type=int, default=4)
+    parser.add_argument("--silence_tokens", type=str, default="[1388,1898,131]")
+    parser.add_argument("--device", type=str, default="cuda")
+    args = parser.parse_args()
+
+    model, model_args, phn2num = get_model(args.exp_dir, args.device)
+    draft_model = get_model(args.draft_exp_dir, args.device)[0] if args.draft_exp_dir is not None else None
+    text_tokenizer = BatchPhonemizer(n_workers=args.phonemize_workers, backend="espeak")
+    audio_tokenizer = AudioTokenizer(signature=args.signature)
+    with open(args.text_fn, "r") as f:
+        target_text = f.read()
+    codes = synthesize_long_form(
+        model, model_args, phn2num, text_tokenizer, audio_tokenizer, args.audio_fn, args.prompt_transcript, target_text, args.device, vars(args),
+        prompt_end_frame=int(args.prompt_end_sec * torchaudio.info(args.audio_fn).sample_rate), max_words=args.max_words, rolling_prompt=args.rolling_prompt,
+        max_prompt_frames=args.max_prompt_frames, draft_model=draft_model
+    )
+    text_tokenizer.close()
+    n_samples = encode_audio(args.output_fn, audio_tokenizer.iter_decode(codes, window=args.decode_window), audio_tokenizer.sample_rate, args.output_format, args.output_sr)
+    logging.info(f"saved {n_samples/(args.output_sr or audio_tokenizer.sample_rate):.2f} sec. of audio to {args.output_fn}")
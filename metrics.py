@@ -0,0 +1,79 @@
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Gauge, Histogram, generate_latest
+
+# prometheus metrics of the api, served in the text format by /metrics
+registry = CollectorRegistry()
+
+_latency_buckets = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 25, 60, 120, 300)
+stage_seconds = Histogram(
+    "voicecraft_stage_seconds", "time spent in each stage of a request (upload_save, alignment, phonemize, prompt_encode, prefill, decode, codec_decode, response_encode)",
+    ["stage"], buckets=_latency_buckets, registry=registry
+)
+frame_seconds = Histogram(
+    "voicecraft_decode_frame_seconds", "average time per decoded frame (one step of the model) of a request",
+    buckets=(.001, .0025, .005, .01, .02, .03, .05, .075, .1, .25, .5), registry=registry
+)
+frames_per_second = Histogram(
+    "voicecraft_generated_frames_per_second", "codec frames generated per second of model time",
+    buckets=(5, 10, 25, 50, 75, 100, 150, 200, 300, 500), registry=registry
+)
+real_time_factor = Histogram(
+    "voicecraft_real_time_factor", "request time divided by the duration of the generated audio",
+    buckets=(.05, .1, .25, .5, .75, 1, 1.5, 2, 3, 5, 10), registry=registry
+)
+queue_depth = Gauge("voicecraft_queue_depth", "requests that are in progress", registry=registry)
+kv_cache_bytes = Gauge("voicecraft_kv_cache_bytes", "size of the kv cache at the end of the last generation", registry=registry)
+cache_hit_rate = Gauge("voicecraft_cache_hit_rate", "hit rate of the model, phoneme and result caches since startup", ["cache"], registry=registry)
+
+
+class StageTimer:
+    """
+    per request timings of the stages, they are recorded in the prometheus histograms and sent back to the client in a Server-Timing header.
+    a stage that happens several times in a request (e.g. phonemize in long form synthesis) is summed up
+    """
+    def __init__(self):
+        self.stime = time.perf_counter()
+        self.timings = OrderedDict()
+        self.n_frames = 0
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, sec):
+        self.timings[name] = self.timings.get(name, 0.) + sec
+
+    def add_decode_stats(self, stats):
+        """stats of one generation, i.e. VoiceCraft.last_decode_stats"""
+        self.add("prefill", stats["prefill_sec"])
+        self.add("decode", stats["decode_sec"])
+        self.n_frames += stats["n_steps"]
+        kv_cache_bytes.set(stats["kv_cache_bytes"])
+
+    def server_timing(self):
+        return ", ".join(f"{name};dur={sec * 1000:.1f}" for name, sec in self.timings.items())
+
+    def observe(self, audio_sec=None):
+        """record the request in the histograms, audio_sec is the duration of the generated audio"""
+        for name, sec in self.timings.items():
+            stage_seconds.labels(name).observe(sec)
+        model_sec = self.timings.get("prefill", 0.) + self.timings.get("decode", 0.)
+        if self.n_frames > 0 and model_sec > 0:
+            frame_seconds.observe(self.timings.get("decode", 0.) / max(1, self.n_frames - 1)) # the first frame belongs to prefill
+            frames_per_second.observe(self.n_frames / model_sec)
+        if audio_sec:
+            real_time_factor.observe((time.perf_counter() - self.stime) / audio_sec)
+
+
+def render(hit_rates):
+    """the metrics in the prometheus text format, and its content type. hit_rates maps cache names to their current hit rate"""
+    for name, rate in hit_rates.items():
+        cache_hit_rate.labels(name).set(rate)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,97 @@
+import logging
+import math
+import os
+
+import torch
+
+
+def enable_compile_cache(cache_dir):
+    """
+    point inductor to a persistent cache dir and turn on the fx graph cache, so that the kernels compiled for the decode step are reused across restarts
+    """
+    cache_dir = os.path.abspath(cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = cache_dir
+    os.environ["TORCHINDUCTOR_FX_GRAPH_CACHE"] = "1"
+    try:
+        import torch._inductor.config as inductor_config
+        inductor_config.fx_graph_cache = True
+    except (ImportError, AttributeError):
+        logging.warning("this version of torch has no inductor fx graph cache, compiled decode steps will be recompiled after a restart")
+
+
+class BucketedDecodeStep:
+    """
+    single token decoding step (decoder + prediction heads) over a kv cache that lives in a preallocated buffer.
+    the length of the buffer is rounded up to a multiple of bucket_size, slots that are not written yet are masked out with -inf,
+    so within a bucket every step sees exactly the same shapes, and torch.compile only needs to compile once per bucket.
+    the output is the same as the eager path where the cache grows by torch.cat every step
+
+    usage, after the first (prefill) pass of dec_forward:
+        decode_step.start(past) # past: [n_layers, 2, B, num_heads, src_len, head_dim]
+        logits = decode_step(y_input[:, -1:]) # [B, K, 1, card], and the kv of this token is written to the buffer
+    """
+    def __init__(self, model, bucket_size=256, compile=True, cache_dir=None, mode=None, max_buckets=32):
+        self.model = model
+        self.bucket_size = bucket_size
+        self.n_codebooks = model.args.n_codebooks
+        self.nhead = model.args.nhead
+        self.buf = None
+        self.attn_mask = None
+        self.cur_len = 0
+        if compile:
+            if cache_dir is not None:
+                enable_compile_cache(cache_dir)
+            # every bucket is a new static shape, make sure dynamo doesn't give up on recompiling before we run out of buckets
+            dynamo_config = torch._dynamo.config
+            for name in ["cache_size_limit", "recompile_limit"]:
+                if hasattr(dynamo_config, name):
+                    setattr(dynamo_config, name, max(getattr(dynamo_config, name), max_buckets))
+            self._step = torch.compile(self._forward, dynamic=False, mode=mode)
+        else:
+            self._step = self._forward
+
+    @property
+    def started(self):
+        return self.buf is not None
+
+    def _forward(self, y_input, attn_mask, past):
+        out, present = self.model.decoder((y_input, None), mask=attn_mask, past=past)
+        if isinstance(out, tuple): # get rid of stage_embedding
+            out = out[0]
+        logits = torch.stack([self.model.predict_layer[i](out) for i in range(self.n_codebooks)], dim=1) # [B K 1 card]
+        return logits, present
+
+    def _bucket_len(self, src_len):
+        # always leave room for at least one more token
+        return int(math.ceil((src_len + 1) / self.bucket_size)) * self.bucket_size
+
+    def _allocate(self, past, bucket_len):
+        n_layers, _, bsz, num_heads, src_len, head_dim = past.shape
+        buf = torch.zeros((n_layers, 2, bsz, num_heads, bucket_len, head_dim), dtype=past.dtype, device=past.device)
+        buf[..., :src_len, :] = past
+        # the last column is the token that is being decoded, it always attends to itself
+        attn_mask = torch.full((bsz * num_heads, 1, bucket_len + 1), float("-inf"), dtype=past.dtype, device=past.device)
+        attn_mask[..., :src_len] = 0.
+        attn_mask[..., -1] = 0.
+        self.buf, self.attn_mask, self.cur_len = buf, attn_mask, src_len
+
+    def start(self, past):
+        assert past.ndim == 6, past.shape
+        self._allocate(past, self._bucket_len(past.shape[-2]))
+
+    def reset(self):
+        self.buf, self.attn_mask, self.cur_len = None, None, 0
+
+    def __call__(self, y_input):
+        assert self.started, "call start() with the kv cache of the first pass before stepping"
+        assert y_input.shape[1] == 1, y_input.shape
+        # y_input is usually a slice of the full sequence, copy it so that its strides don't change from step to step (which would trigger recompiles)
+        y_input = y_input.clone(memory_format=torch.contiguous_format)
+        logits, present = self._step(y_input, self.attn_mask.to(y_input.dtype), self.buf)
+        self.buf[..., self.cur_len:self.cur_len+1, :] = present.to(self.buf.dtype)
+        self.attn_mask[..., self.cur_len] = 0.
+        self.cur_len += 1
+        if self.cur_len == self.buf.shape[-2]: # bucket is full, move to the next one
+            self._allocate(self.buf, self.buf.shape[-2] + self.bucket_size)
+        return logits
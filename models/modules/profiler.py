@@ -0,0 +1,120 @@
+import functools
+import time
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+
+import torch
+
+# the DecodeProfiler that is recording, profile_section does nothing while this is None
+_active = None
+
+
+@contextmanager
+def profile_section(name):
+    """time a section of the decoding loop if a DecodeProfiler is active, e.g. with profile_section("mask"): ..."""
+    profiler = _active
+    if profiler is None:
+        yield
+        return
+    with torch.profiler.record_function(name):
+        profiler._sync()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            profiler._sync()
+            profiler.add(name, time.perf_counter() - start)
+
+
+class DecodeProfiler:
+    """
+    per step timing of the inference loops of VoiceCraft (inference, inference_tts, inference_tts_batch), use as a context manager around the call:
+        with DecodeProfiler(model, trace_path="trace.json") as profiler:
+            model.inference_tts(...)
+        logging.info(profiler.summary())
+    sections are the self attention (sa_block) and feed forward (ff_block) blocks of every decoder layer, the attention mask construction in dec_forward (mask),
+    the prediction heads (heads) and sampling (sample). a step ends with its sampling, step 0 is the prefill.
+    the compiled decode step (enable_compiled_decode) is opaque, only sampling is timed while it is used.
+    on cuda every section is synchronized, so the timings are exact but the decoding is slower than without the profiler.
+    if trace_path is given, a torch.profiler trace of the same run is exported there, it can be opened in chrome://tracing or perfetto
+    """
+    def __init__(self, model, trace_path=None):
+        self.model = model
+        self.trace_path = trace_path
+        self.cuda = next(model.parameters()).is_cuda
+        self.steps = [defaultdict(float)] # seconds per section, one dict per step
+        self.wall_sec = 0.
+        self._patched = []
+        self._torch_profiler = None
+
+    def _sync(self):
+        if self.cuda:
+            torch.cuda.synchronize()
+
+    def add(self, name, sec):
+        self.steps[-1][name] += sec
+        if name == "sample":
+            self.steps.append(defaultdict(float))
+
+    def _patch(self, obj, attr, name):
+        # replace a bound method by a timed version on the instance, removed again in __exit__
+        fn = getattr(obj, attr)
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            with profile_section(name):
+                return fn(*args, **kwargs)
+        setattr(obj, attr, timed)
+        self._patched.append((obj, attr))
+
+    def __enter__(self):
+        global _active
+        assert _active is None, "only one DecodeProfiler can be active at a time"
+        for i, layer in enumerate(self.model.decoder.layers):
+            self._patch(layer, "_sa_block", f"layer{i}.sa_block")
+            self._patch(layer, "_ff_block", f"layer{i}.ff_block")
+        for head in self.model.predict_layer:
+            self._patch(head, "forward", "heads")
+        if self.trace_path is not None:
+            activities = [torch.profiler.ProfilerActivity.CPU] + ([torch.profiler.ProfilerActivity.CUDA] if self.cuda else [])
+            self._torch_profiler = torch.profiler.profile(activities=activities)
+            self._torch_profiler.__enter__()
+        _active = self
+        self._sync()
+        self._stime = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        global _active
+        self._sync()
+        self.wall_sec = time.perf_counter() - self._stime
+        _active = None
+        for obj, attr in self._patched:
+            delattr(obj, attr)
+        self._patched = []
+        if self._torch_profiler is not None:
+            self._torch_profiler.__exit__(*exc)
+            self._torch_profiler.export_chrome_trace(self.trace_path)
+        if len(self.steps[-1]) == 0:
+            self.steps.pop()
+        return False
+
+    def totals(self):
+        """seconds per section over the prefill (step 0) and all other steps"""
+        prefill, rest = defaultdict(float), defaultdict(float)
+        for i, step in enumerate(self.steps):
+            for name, sec in step.items():
+                (prefill if i == 0 else rest)[name] += sec
+        names = list(OrderedDict.fromkeys(name for step in self.steps for name in step))
+        return names, prefill, rest
+
+    def summary(self):
+        """table of the time per section, for the prefill and on average per step after it"""
+        names, prefill, rest = self.totals()
+        n_steps = max(1, len(self.steps) - 1)
+        total = sum(prefill.values()) + sum(rest.values())
+        lines = [f"{len(self.steps)} steps in {self.wall_sec * 1000:.1f} ms, {(self.wall_sec - total) * 1000:.1f} ms outside of the profiled sections",
+                 f"{'section':<20}{'prefill ms':>12}{'ms/step':>12}{'total ms':>12}{'%':>8}"]
+        for name in names:
+            name_total = prefill[name] + rest[name]
+            lines.append(f"{name:<20}{prefill[name] * 1000:>12.3f}{rest[name] / n_steps * 1000:>12.3f}{name_total * 1000:>12.1f}{100 * name_total / max(total, 1e-9):>8.1f}")
+        return "\n".join(lines)
@@ -45,13 +45,15 @@ def top_k_top_p_filtering(
         logits[indices_to_remove] = filter_value
     return logits
     
-def topk_sampling(logits, top_k=10, top_p=1.0, temperature=1.0):
+def topk_sampling(logits, top_k=10, top_p=1.0, temperature=1.0, generator=None):
     # temperature: (`optional`) float
     #     The value used to module the next token probabilities. Must be strictly positive. Default to 1.0.
     # top_k: (`optional`) int
     #     The number of highest probability vocabulary tokens to keep for top-k-filtering. Between 1 and infinity. Default to 50.
     # top_p: (`optional`) float
     #     The cumulative probability of parameter highest probability vocabulary tokens to keep for nucleus sampling. Must be between 0 and 1. Default to 1.
+    # generator: (`optional`) torch.Generator
+    #     Source of randomness for sampling, on the same device as logits. Default to the global RNG.
 
     # Temperature (higher temperature => more likely to sample low probability tokens)
     if temperature != 1.0:
@@ -59,5 +61,5 @@ def topk_sampling(logits, top_k=10, top_p=1.0, temperature=1.0):
     # Top-p/top-k filtering
     logits = top_k_top_p_filtering(logits, top_k=top_k, top_p=top_p)
     # Sample
-    token = torch.multinomial(F.softmax(logits, dim=-1), num_samples=1)
+    token = torch.multinomial(F.softmax(logits, dim=-1), num_samples=1, generator=generator)
     return token
\ No newline at end of file
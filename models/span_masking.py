@@ -0,0 +1,109 @@
+import random
+
+import torch
+
+# the training sequences of VoiceCraft: sample mask spans, rearrange y into its sections (non-masked parts, then masked parts), shift each section
+# with the delayed pattern and join them with mask tokens. used by the dataset, so this runs in the dataloader workers (with a random generator per
+# sample and epoch), and by VoiceCraft.prepare_input_target for batches that come without them (with the global random state)
+
+
+def sample_mask_intervals(y_len, args, rng=random, generator=None):
+    """
+    mask_intervals [(start, end)] and non_mask_intervals [(start, end)] of one sample of y_len frames.
+    rng is a random.Random (or the random module), generator a torch.Generator for the poisson draw (None for the global one)
+    """
+    if args.mask_sample_dist == "uniform":
+        n_spans = rng.choice(range(1, args.max_n_spans+1))
+    elif "poisson" in args.mask_sample_dist.lower():
+        param = float(args.mask_sample_dist[len("poisson"):])
+        poisson_sample = torch.poisson(torch.tensor([param]), generator=generator)
+        n_spans = int(poisson_sample.clamp(1, args.max_n_spans).item())
+
+    starts = rng.sample(range(1, y_len-1-args.mask_len_min), n_spans)
+    starts = sorted(starts)
+
+    for j in range(len(starts)-1, 0, -1):
+        if starts[j] - starts[j-1] < args.min_gap:
+            del starts[j] # If elements are too close, delete the later one
+    assert len(starts) > 0, f"there is no masked span left, y_len: {y_len}, sampled n_spans: {n_spans}"
+
+    temp_starts =  starts + [y_len]
+    gaps = [temp_starts[j+1] - temp_starts[j] for j in range(len(temp_starts)-1)]
+
+    ends = []
+
+    for j, (start, gap) in enumerate(zip(starts, gaps)):
+        mask_len = rng.randint(args.mask_len_min, args.mask_len_max)
+        if mask_len > gap - 1: # make sure the masks are not overlapping with each other
+            temp_mask_start = 1
+            temp_mask_end = gap - 1
+            mask_len = rng.randint(temp_mask_start, temp_mask_end)
+        ends.append(start + mask_len)
+
+    return [(s,e) for s,e in zip(starts, ends)], [(ns,ne) for ns, ne in zip([0]+ends, starts+[y_len])]
+
+
+def mask_embedding_ids(n_masks, args, rng=random):
+    """ids into the mask embedding of the 2*n_masks mask tokens of a sample, the token before a masked part has the id of the one at its position"""
+    emb_inds = list(range(args.max_n_spans))
+    if args.shuffle_mask_embedding:
+        rng.shuffle(emb_inds)
+    return emb_inds[:n_masks] * 2
+
+
+def build_masked_sequences(y, mask_intervals, non_mask_intervals, args):
+    """
+    the sequences of a batch y [B K T], with the mask intervals of each sample. the sections get eog/eos appended (see VoiceCraft.rearrange),
+    are shifted with the delayed pattern (frame t of codebook k at step t+1+k of the section) and joined by mask tokens, for which eog is a place holder.
+    returns seq [B K S] (padded with audio_pad_token), new_y_lens [B], and for all frames of all sections in order: frame_b and frame_pos [F],
+    the sample and the step at which the logits predict the frame in codebook 0 (codebook k is predicted at frame_pos+k), for all mask tokens: mask_b and mask_position [M]
+    """
+    K, device = args.n_codebooks, y.device
+    reduced_eog, eos = getattr(args, "reduced_eog", 0), getattr(args, "eos", -1)
+    if eos > 0:
+        assert reduced_eog
+
+    # one row per section: its sample, start and end in y, the token appended to it (-1 for none), and whether a mask token follows it
+    seg_b, seg_start, seg_end, seg_tail, seg_mask_after = [], [], [], [], []
+    for i in range(len(y)):
+        n_non_mask = len(non_mask_intervals[i])
+        sections = non_mask_intervals[i] + mask_intervals[i]
+        for j, (start, end) in enumerate(sections):
+            if j < n_non_mask - 1:
+                tail = -1 if reduced_eog else args.eog
+            elif j == n_non_mask - 1: # where the utterance actually ends
+                tail = eos if eos > 0 else args.eog
+            else:
+                tail = args.eog
+            seg_b.append(i)
+            seg_start.append(int(start))
+            seg_end.append(int(end))
+            seg_tail.append(tail)
+            seg_mask_after.append(int(j < len(sections) - 1))
+    seg_b, seg_start, seg_end, seg_tail, seg_mask_after = [torch.tensor(item, dtype=torch.long, device=device) for item in [seg_b, seg_start, seg_end, seg_tail, seg_mask_after]]
+
+    # a section of n frames takes n + K steps in the delayed pattern, followed by a mask token
+    seg_len = seg_end - seg_start + (seg_tail >= 0).long()
+    seg_steps = seg_len + K + seg_mask_after
+    new_y_lens = torch.zeros(len(y), dtype=torch.long, device=device).index_add_(0, seg_b, seg_steps)
+    sample_offset = torch.cumsum(new_y_lens, 0) - new_y_lens
+    seg_pos = torch.cumsum(seg_steps, 0) - seg_steps - sample_offset[seg_b] # first step of each section in its sample
+
+    # the frames of the sections, these are the targets
+    frame_seg = torch.repeat_interleave(torch.arange(len(seg_len), device=device), seg_len)
+    frame_t = torch.arange(len(frame_seg), device=device) - (torch.cumsum(seg_len, 0) - seg_len)[frame_seg]
+    frame_b = seg_b[frame_seg]
+    frame_pos = seg_pos[frame_seg] + frame_t
+    from_y = frame_t < (seg_end - seg_start)[frame_seg]
+    src_t = (seg_start[frame_seg] + frame_t).clamp(max=y.shape[-1]-1)
+    frames = torch.where(from_y.unsqueeze(1), y[frame_b, :, src_t], seg_tail[frame_seg].unsqueeze(1)) # [F K]
+    mask_seg = seg_mask_after.nonzero().squeeze(1)
+    mask_b, mask_position = seg_b[mask_seg], (seg_pos + seg_len + K)[mask_seg]
+
+    # pad after the end, the empty token where the pattern has no frame, and the eog token as a place holder for the mask tokens
+    seq = torch.full((len(y), K, int(new_y_lens.max())), args.audio_pad_token, dtype=torch.long, device=device)
+    seq.masked_fill_((torch.arange(seq.shape[-1], device=device).unsqueeze(0) < new_y_lens.unsqueeze(1)).unsqueeze(1), args.empty_token)
+    seq[mask_b, :, mask_position] = args.eog
+    codebook = torch.arange(K, device=device).unsqueeze(0)
+    seq[frame_b.unsqueeze(1), codebook, frame_pos.unsqueeze(1) + 1 + codebook] = frames
+    return seq, new_y_lens, frame_b, frame_pos, mask_b, mask_position
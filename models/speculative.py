@@ -0,0 +1,276 @@
+import logging
+
+import torch
+import torch.nn.functional as F
+
+from .voicecraft import top_k_top_p_filtering
+
+
+class _IncrementalDecoder:
+    """
+    kv-cached decoding state of one VoiceCraft model for tts, holds the text/prompt inputs, the embedded audio sequence and the kv cache,
+    and supports rolling back the last few tokens when draft frames are rejected
+    """
+    def __init__(self, model, x, x_lens, y):
+        # y: [1, K, T], special_first offset already applied
+        self.model = model
+        self.n_codebooks = model.args.n_codebooks
+        self.x_lens = x_lens
+        self.x_attention_mask = torch.triu(torch.ones(x.shape[1], x.shape[1]), diagonal=1).bool().to(x.device)
+        self.x_input = model.text_positional_embedding(model.text_embedding(x))
+        self.x_padding_mask = torch.full((1, x_lens[0]), False).to(x.device)
+
+        # same as inference_tts: shift the prompt with the delayed pattern and cut the tail of the shifted part
+        shifted_y, _ = model.shift([[y[0]]])
+        cated_y = shifted_y[0][0][:, :-(self.n_codebooks-1)].unsqueeze(-1) # [K,S,1]
+        embedded_y = torch.stack([model.audio_embedding[k](cated_y[k]) for k in range(self.n_codebooks)], dim=0) # [K, S, 1, D]
+        self.embedded_y = embedded_y.sum(dim=0).transpose(1,0) # [1,S,D]
+        self.past = None
+
+    @property
+    def y_len(self):
+        return self.embedded_y.shape[1]
+
+    def embed_frame(self, frame):
+        # frame: [K] -> [1,1,D]
+        return torch.stack([self.model.audio_embedding[k](frame[k:k+1]) for k in range(self.n_codebooks)], dim=0).sum(dim=0, keepdim=True)
+
+    def forward(self, frames=[]):
+        """
+        append frames (list of [K] tensors) and return the logits [n, K, card] predicted after each of them.
+        the first call runs the full prompt (prefill, frames should be empty) and returns the logits after the last prompt position, i.e. [1, K, card]
+        """
+        if len(frames) > 0:
+            self.embedded_y = torch.cat([self.embedded_y] + [self.embed_frame(f) for f in frames], dim=1)
+        y_input = self.model.audio_positional_embedding(self.embedded_y)
+        y_attention_mask = torch.triu(torch.ones(y_input.shape[1], y_input.shape[1]), diagonal=1).bool().to(y_input.device)
+        new_y_lens = torch.LongTensor([y_input.shape[1]]).to(y_input.device)
+        y_padding_mask = torch.full((1, new_y_lens[0]), False).to(y_input.device)
+        if self.past is None:
+            past = torch.ones([self.model.args.num_decoder_layers, 2, 1], device=y_input.device, dtype=torch.float32)
+            n_new = 1
+        else:
+            assert len(frames) > 0, "nothing to decode"
+            past = self.past
+            n_new = len(frames)
+        y_out, present = self.model.dec_forward(
+            self.x_input,
+            self.x_lens,
+            self.x_attention_mask,
+            self.x_padding_mask,
+            y_input,
+            new_y_lens,
+            y_attention_mask,
+            y_padding_mask,
+            past=past,
+            last_n_tokens=n_new
+        )
+        self.past = present.to(past.dtype) if self.past is None else torch.cat([self.past, present.to(past.dtype)], dim=-2)
+        y_out = y_out[:, -n_new:]
+        logits = torch.stack([self.model.predict_layer[i](y_out) for i in range(self.n_codebooks)], dim=1) # [1 K n card]
+        return logits[0].transpose(0, 1) # [n K card]
+
+    def truncate(self, n):
+        # drop the last n tokens from the sequence and the kv cache
+        if n > 0:
+            self.past = self.past[..., :-n, :]
+            self.embedded_y = self.embedded_y[:, :-n]
+
+
+class _SamplingState:
+    """the bits of state that inference_tts' sample_helper carries from frame to frame"""
+    def __init__(self, cur_num_gen, prev_token, consec_silence_count, y_len):
+        self.cur_num_gen = cur_num_gen
+        self.prev_token = prev_token
+        self.consec_silence_count = consec_silence_count
+        self.y_len = y_len # length of y_input when the frame is sampled
+
+    def advance(self, frame, silence_tokens):
+        token = frame[0].item()
+        if token in silence_tokens and token == self.prev_token:
+            consec_silence_count = self.consec_silence_count + 1
+        else:
+            consec_silence_count = 0
+        return _SamplingState(self.cur_num_gen + 1, token, consec_silence_count, self.y_len + 1)
+
+
+def _sampling_probs(logits, top_k, top_p, temperature):
+    # the distribution that topk_sampling draws from
+    if temperature != 1.0:
+        logits = logits / temperature
+    logits = top_k_top_p_filtering(logits.clone(), top_k=top_k, top_p=top_p)
+    return F.softmax(logits, dim=-1)
+
+
+def _speculative_sample(p, q, draft_tokens, generator=None):
+    """
+    accept/reject of speculative sampling, done per codebook. the codebooks of a frame are sampled independently given the context (under both models),
+    so accepting each draft token with prob min(1, p/q) and otherwise resampling from norm(max(0, p-q)) gives tokens that are exactly distributed as p
+    p, q: [K, card], draft_tokens: [K]
+    """
+    idx = draft_tokens.unsqueeze(-1)
+    p_d = p.gather(-1, idx).squeeze(-1)
+    q_d = q.gather(-1, idx).squeeze(-1)
+    accept = torch.rand(q_d.shape, device=q_d.device, generator=generator) * q_d < p_d
+    residual = (p - q).clamp(min=0)
+    residual_sum = residual.sum(dim=-1, keepdim=True)
+    residual = torch.where(residual_sum > 0, residual / residual_sum.clamp(min=1e-20), p) # residual is all zero only if p == q, in which case we always accept
+    resampled = torch.multinomial(residual, num_samples=1, generator=generator).squeeze(-1)
+    return torch.where(accept, draft_tokens, resampled)
+
+
+@torch.no_grad()
+def inference_tts_speculative(
+    model,
+    draft_model,
+    x: torch.Tensor,
+    x_lens: torch.Tensor,
+    y: torch.Tensor,
+    top_k: int=-100,
+    top_p: float=1.0,
+    temperature: float=1.0,
+    stop_repetition: int=3,
+    silence_tokens: list[int]=[1388,1898,131],
+    n_draft: int=4,
+    generator=None,
+):
+    """
+    speculative decoding for tts: draft_model (e.g. the 330M model) proposes up to n_draft frames of the delayed pattern,
+    model (e.g. the 830M model) scores all of them in one kv-cached forward pass and accepts/rejects them with the standard speculative sampling rule,
+    so the output follows model's distribution (including the eog and silence repetition handling of inference_tts).
+    The two models need to share the codec codebooks and the phoneme vocabulary. Same inputs and outputs as inference_tts
+    """
+    args = model.args
+    for name in ["n_codebooks", "audio_vocab_size", "empty_token", "eog", "eos", "special_first", "n_special", "encodec_sr"]:
+        assert getattr(args, name) == getattr(draft_model.args, name), f"the draft model has a different {name}: {getattr(draft_model.args, name)} vs {getattr(args, name)}"
+    if getattr(args, "phn2num", None) is not None and getattr(draft_model.args, "phn2num", None) is not None:
+        assert args.phn2num == draft_model.args.phn2num, "the draft model has a different phoneme vocabulary"
+    n_codebooks = args.n_codebooks
+    eog_inference = args.eos if args.eos>0 else args.eog
+    assert x.ndim == 2, x.shape
+    assert x_lens.ndim == 1, x_lens.shape
+    assert y.ndim == 3, y.shape
+    if args.special_first:
+        y = y + int(args.n_special)
+    y = y.transpose(2,1) # [1,T,K] -> [1,K,T]
+    assert y.shape[0] == 1 and y.shape[1] == n_codebooks, y.shape # there is no padding
+    y_len = y.shape[2]
+    max_y_len = x_lens[0] * (args.encodec_sr//5)
+
+    def adjust_logits(logits, state):
+        # same logits adjustment as sample_helper in inference_tts (n_eog == 0), applied to a copy
+        logits = logits.clone()
+        if args.eos > 0:
+            logits[:, args.eog] = -10000.
+        logits[1:, eog_inference] = -10000
+        logits[1:, args.empty_token] = -10000
+        if state.cur_num_gen <= args.encodec_sr // 5: # this shouldn't happen, but just in case the model stopped too early
+            logits[0, eog_inference] = -10000
+        if stop_repetition > 0 and state.prev_token in silence_tokens and state.consec_silence_count > stop_repetition:
+            if logits[0, state.prev_token] < 0:
+                logits[0, state.prev_token] = logits[0, state.prev_token] * (state.consec_silence_count - (stop_repetition-1))
+            else:
+                logits[0, state.prev_token] = logits[0, state.prev_token] / (state.consec_silence_count - (stop_repetition-1))
+        return logits
+
+    def finalize(samples, adjusted_logits, state):
+        # deterministic post processing of the sampled frame, returns the frame and whether eog is reached in the first codebook
+        samples = samples.clone()
+        if state.cur_num_gen < n_codebooks-1:
+            samples[state.cur_num_gen+1:] = args.empty_token
+        if samples[0] == eog_inference or torch.argmax(adjusted_logits[0], dim=-1) == eog_inference or state.y_len > max_y_len:
+            samples[0] = eog_inference
+            return samples, True
+        return samples, False
+
+    target = _IncrementalDecoder(model, x, x_lens, y)
+    draft = _IncrementalDecoder(draft_model, x, x_lens, y)
+    target_prefill_logits = target.forward()[0]
+    draft_prefill_logits = draft.forward()[0]
+
+    logging.info(f"silence tokens: {silence_tokens}, note that if you are not using the pretrained encodec 6f79c6a8, make sure you specified it yourself, rather than using the default")
+    state = _SamplingState(0, None, 0, target.y_len)
+    generated = [] # frames of the delayed pattern, same as cur_generated in inference_tts
+    pending = None # the last confirmed frame, which is not in the kv cache of either model yet
+    n_proposed, n_accepted, n_rounds = 0, 0, 0
+    reached_eog = False
+    while not reached_eog:
+        n_rounds += 1
+        # 1. the draft model proposes up to n_draft frames
+        fed = [pending] if pending is not None else []
+        draft_states, draft_probs, draft_raw, draft_frames = [], [], [], []
+        cur_state = state
+        for j in range(n_draft):
+            if j == 0:
+                draft_logits = draft.forward(fed)[-1] if len(fed) > 0 else draft_prefill_logits
+            else:
+                draft_logits = draft.forward([draft_frames[-1]])[-1]
+            adjusted = adjust_logits(draft_logits, cur_state)
+            q = _sampling_probs(adjusted, top_k, top_p, temperature)
+            raw = torch.multinomial(q, num_samples=1, generator=generator).squeeze(-1) # [K]
+            frame, hit_eog = finalize(raw, adjusted, cur_state)
+            draft_states.append(cur_state)
+            draft_probs.append(q)
+            draft_raw.append(raw)
+            draft_frames.append(frame)
+            cur_state = cur_state.advance(frame, silence_tokens)
+            if hit_eog:
+                break
+        n_draft_frames = len(draft_frames)
+        n_proposed += n_draft_frames
+
+        # 2. the target model scores all proposals in one forward pass
+        fed = fed + draft_frames[:-1]
+        target_logits = list(target.forward(fed)) if len(fed) > 0 else []
+        if pending is None:
+            target_logits = [target_prefill_logits] + target_logits
+        assert len(target_logits) == n_draft_frames, f"{len(target_logits)}, {n_draft_frames}"
+
+        # 3. accept/reject, stop at the first frame that differs from the proposal
+        confirmed = []
+        for i in range(n_draft_frames):
+            adjusted = adjust_logits(target_logits[i], draft_states[i])
+            p = _sampling_probs(adjusted, top_k, top_p, temperature)
+            raw = _speculative_sample(p, draft_probs[i], draft_raw[i], generator=generator)
+            frame, reached_eog = finalize(raw, adjusted, draft_states[i])
+            confirmed.append(frame)
+            if reached_eog or not torch.equal(frame, draft_frames[i]):
+                break
+            n_accepted += 1
+
+        # 4. roll back the kv cache of both models to the confirmed frames
+        keep = (0 if pending is None else 1) + len(confirmed) - 1
+        target.truncate(len(fed) - keep)
+        draft.truncate(len(fed) - keep)
+        for frame in confirmed:
+            state = state.advance(frame, silence_tokens)
+            generated.append(frame)
+        pending = confirmed[-1]
+
+    logging.info(f"speculative decoding: {n_accepted}/{n_proposed} draft frames accepted in {n_rounds} rounds")
+
+    # the remaining codebooks reach eog one by one, this is done by the target model alone
+    for n_eog in range(1, n_codebooks):
+        logits = target.forward([pending])[-1].clone()
+        if args.eos > 0:
+            logits[:, args.eog] = -10000.
+        logits[n_eog+1:, eog_inference] = -10000
+        logits[n_eog+1:, args.empty_token] = -10000
+        samples = torch.multinomial(_sampling_probs(logits, top_k, top_p, temperature), num_samples=1, generator=generator).squeeze(-1)
+        samples[:n_eog] = args.empty_token
+        samples[n_eog] = eog_inference
+        generated.append(samples)
+        pending = samples
+    num_gen = len(generated)
+
+    # revert the pattern
+    span = torch.stack(generated, dim=0).transpose(1,0) # [K, T]
+    unshifted_span = torch.stack([s[j:-(n_codebooks - j)] for j, s in enumerate(span)], dim=0)
+    assert unshifted_span.shape[1] == num_gen - n_codebooks, f"len(unshifted_spans[0]): {len(unshifted_span[0])}, num_gen: {num_gen}"
+
+    res = torch.cat([y[0], unshifted_span], dim=1).unsqueeze(0) # [K, new_t] -> [1, K, new_T]
+    gen = unshifted_span.unsqueeze(0)
+    if args.special_first:
+        res = res - int(args.n_special)
+        gen = gen - int(args.n_special)
+    return res, gen
@@ -2,6 +2,7 @@ import random
 
 import numpy as np
 import logging
+import time
 import argparse, copy
 from typing import Dict, Optional
 import torch
@@ -12,12 +13,15 @@ from torchmetrics.classification import MulticlassAccuracy
 from .modules.utils import make_pad_mask
 
 from .modules.embedding import SinePositionalEmbedding, TokenEmbedding
+from .modules.decode_step import BucketedDecodeStep
+from .modules.profiler import profile_section
 from .modules.transformer import (
     LayerNorm,
     TransformerEncoder,
     TransformerEncoderLayer,
 )
 from .codebooks_patterns import DelayedPatternProvider
+from .span_masking import build_masked_sequences, mask_embedding_ids, sample_mask_intervals
 
 from argparse import Namespace
 from huggingface_hub import PyTorchModelHubMixin
@@ -68,13 +72,15 @@ def top_k_top_p_filtering(
     return logits
 
 
-def topk_sampling(logits, top_k=10, top_p=1.0, temperature=1.0):
+def topk_sampling(logits, top_k=10, top_p=1.0, temperature=1.0, generator=None):
     # temperature: (`optional`) float
     #     The value used to module the next token probabilities. Must be strictly positive. Default to 1.0.
     # top_k: (`optional`) int
     #     The number of highest probability vocabulary tokens to keep for top-k-filtering. Between 1 and infinity. Default to 50.
     # top_p: (`optional`) float
     #     The cumulative probability of parameter highest probability vocabulary tokens to keep for nucleus sampling. Must be between 0 and 1. Default to 1.
+    # generator: (`optional`) torch.Generator
+    #     Source of randomness for sampling, on the same device as logits. Default to the global RNG.
 
     # Temperature (higher temperature => more likely to sample low probability tokens)
     if temperature != 1.0:
@@ -82,7 +88,7 @@ def topk_sampling(logits, top_k=10, top_p=1.0, temperature=1.0):
     # Top-p/top-k filtering
     logits = top_k_top_p_filtering(logits, top_k=top_k, top_p=top_p)
     # Sample
-    token = torch.multinomial(F.softmax(logits, dim=-1), num_samples=1)
+    token = torch.multinomial(F.softmax(logits, dim=-1), num_samples=1, generator=generator)
     return token
 
 
@@ -193,47 +199,37 @@ class VoiceCraft(
                 ignore_index=None,
             ) for k in range(self.args.n_codebooks)]
         )
+        self.decode_step = None # set by enable_compiled_decode
+        self.last_decode_stats = None # set by every inference call, see _set_decode_stats
 
+    def enable_compiled_decode(self, bucket_size=256, cache_dir=None, compile=True, mode=None):
+        """
+        opt-in, replace the per-frame kv-cached decoder call in inference_tts and inference_tts_batch by a torch.compile'd step,
+        the kv length is bucketed to multiples of bucket_size to limit the number of recompiles. compiled kernels are cached in cache_dir across restarts
+        """
+        self.decode_step = BucketedDecodeStep(self, bucket_size=bucket_size, compile=compile, cache_dir=cache_dir, mode=mode)
+        return self.decode_step
+
+    def disable_compiled_decode(self):
+        self.decode_step = None
+
+    def _set_decode_stats(self, stime, prefill_sec, n_steps, past, decode_step=None):
+        """timings of the last inference call, the first step (prefill and first sample) is reported separately from the per-frame steps"""
+        kv = decode_step.buf if decode_step is not None and decode_step.started else past
+        self.last_decode_stats = {
+            "prefill_sec": prefill_sec or 0.,
+            "decode_sec": time.time() - stime - (prefill_sec or 0.),
+            "n_steps": n_steps,
+            "kv_cache_bytes": kv.numel() * kv.element_size() if kv is not None and kv.ndim > 3 else 0,
+        }
     
     def prepare_mask_intervals(self, y_lens):
         mask_intervals = []
         non_mask_intervals = []
-
-        for i, y_len in enumerate(y_lens):
-            if self.args.mask_sample_dist == "uniform":
-                n_spans = random.choice(range(1, self.args.max_n_spans+1))
-            elif "poisson" in self.args.mask_sample_dist.lower():
-                param = float(self.args.mask_sample_dist[len("poisson"):])
-                poisson_sample = torch.poisson(torch.tensor([param]))
-                n_spans = int(poisson_sample.clamp(1, self.args.max_n_spans).item())
-
-            starts = random.sample(range(1, y_len-1-self.args.mask_len_min), n_spans)
-            starts = sorted(starts)
-
-            for j in range(len(starts)-1, 0, -1):
-                if starts[j] - starts[j-1] < self.args.min_gap:
-                    del starts[j] # If elements are too close, delete the later one
-            assert len(starts) > 0, f"there is no masked span left, y_len: {y_len}, sampled n_spans: {n_spans}"
-
-            temp_starts =  starts + [y_len]
-            gaps = [temp_starts[j+1] - temp_starts[j] for j in range(len(temp_starts)-1)]
-
-            ends = []
-
-            for j, (start, gap) in enumerate(zip(starts, gaps)):
-                mask_len = random.randint(self.args.mask_len_min, self.args.mask_len_max)
-                # if mask_len > gap * self.args.max_mask_portion: # make sure the masks are not overlapping with each other
-                if mask_len > gap - 1: # make sure the masks are not overlapping with each other
-                    # temp_mask_start = int(0.6*gap*self.args.max_mask_portion)
-                    # temp_mask_end = int(gap*self.args.max_mask_portion)
-                    temp_mask_start = 1
-                    temp_mask_end = gap - 1
-                    mask_len = random.randint(temp_mask_start, temp_mask_end)
-                ends.append(start + mask_len)
-            
-            mask_intervals.append([(s,e) for s,e in zip(starts, ends)])
-            non_mask_intervals.append([(ns,ne) for ns, ne in zip([0]+ends, starts+[y_len])])
-
+        for y_len in y_lens:
+            cur_mask_intervals, cur_non_mask_intervals = sample_mask_intervals(y_len, self.args)
+            mask_intervals.append(cur_mask_intervals)
+            non_mask_intervals.append(cur_non_mask_intervals)
         return mask_intervals, non_mask_intervals
     
     def rearrange(self, y, non_mask_intervals, mask_intervals):
@@ -320,88 +316,41 @@ class VoiceCraft(
         return embedded_y
     
     def prepare_input_target(self, y, y_lens):
-        # rearrange y
-        # assume y shape: [B T K], K is n_codebooks
+        """
+        for batches without the training sequences (see data/gigaspeech.py), build them here: sample the mask spans and the mask embeddings
+        with the global random state, and build the sequences of the whole batch with build_masked_sequences. returns the same as embed_input_target
+        """
+        # assume y shape: [B K T], K is n_codebooks
         assert y.shape[1] == self.args.n_codebooks, y.shape
-        # sample mask_intervals
         mask_intervals, non_mask_intervals = self.prepare_mask_intervals(y_lens)
+        mask_value = [v for cur_mask_intervals in mask_intervals for v in mask_embedding_ids(len(cur_mask_intervals), self.args)]
+        seq, new_y_lens, frame_b, frame_pos, mask_b, mask_position = build_masked_sequences(y, mask_intervals, non_mask_intervals, self.args)
+        return self.embed_input_target(seq, new_y_lens, frame_b, frame_pos, mask_b, mask_position, torch.tensor(mask_value, dtype=torch.long, device=y.device))
 
-        # need to have EOG in each section (SOG will be generated by the pattern class)
-        # but mask can be inserted later after we have shifted the input
-        # y could be rearranged in this way:
-        # [
-        # [tensor[4, 12], tensor[4, 45], tensor[4, 102], tensor[4, 32]], tensor[4, 22]],
-        # [tensor[4, 44], tensor[4, 56], tensor[4, 19]],
-        # ...
-        # ]
-        # for the first list of tensors (4 tensors), first 3 tensors are non_masked part, last 2 are masked part.
-        # NOTE #non_masked_part = #masked_part + 1
-        # NOTE *these are also the targets*
-        # added eog at the end of each segment (masked segment and unmasked segment)
-        rearranged_y = self.rearrange(y, non_mask_intervals, mask_intervals)
-        targets = rearranged_y # each element in each sample is of shape [K T]
-        assert targets[0][0].shape[0] == self.args.n_codebooks, targets[0][0].shape
-
-        # next we need to apply pattern shifting to each tensor, after which, we'll replace the starting tokens of each section with a token that's different from the special padding token
-        #  [[5, 1, 2, 3, 4, 5, 5],
-        #  [5, 5, 1, 2, 3, 4, 5],
-        #  [5, 5, 5, 1, 2, 3, 4]]
-        shifted_y, patterns = self.shift(rearranged_y) # each element [K S]
-        assert shifted_y[0][0].shape[0] == self.args.n_codebooks, shifted_y[0][0].shape[0]
-
+    def embed_input_target(self, seq, new_y_lens, frame_b, frame_pos, mask_b, mask_position, mask_value):
+        """
+        embed the training sequences seq [B K S] (see build_masked_sequences), the mask tokens get the mask embedding mask_value [M].
+        returns y_input [B S D], new_y_lens, targets [K F] (the frames of all sections of all samples, in order), padding and attention masks for y,
+        and logits_index, the indexes (sample, codebook, position) into logits [B K S card] of the logits that predict the targets, each [K F]
+        """
+        K = self.args.n_codebooks
+        codebook = torch.arange(K, device=seq.device).unsqueeze(1).expand(-1, len(frame_pos)) # [K F]
+        logits_index = (frame_b.unsqueeze(0).expand(K, -1), codebook, frame_pos.unsqueeze(0) + codebook)
+        targets = seq[logits_index[0], codebook, logits_index[2] + 1]
 
-        # then, insert mask token at the intersection of each tensor (we want to decide the arrangement of the mask (shuffle or not)), we better have a separate nn.embedding for it
-        # we also need to record the position of the inserted mask
-        inserted_y, mask_position, mask_value = self.insert_mask(shifted_y)
-        assert inserted_y[0][0].shape[0] == self.args.n_codebooks, inserted_y[0][0].shape[0]
-        assert inserted_y[0][1].shape == torch.Size((self.args.n_codebooks, 1)), f"this should be a mask, so should have shape {(self.args.n_codebooks, 1)}, but it's {inserted_y[0][1].shape}"
-        
-        # then concat tensors that belong to the same sample (in order) then get the length of each sample, and then stack them in batch dimension, pad them with pad_token
-        cated_y, new_y_lens = self.cat_y(inserted_y, mask_position, y_lens) # KTB
-        assert cated_y.shape == torch.Size((self.args.n_codebooks, cated_y.shape[1], len(inserted_y)))
-        
+        cated_y = seq.permute(1,2,0) # [B K S] -> [K S B]
+        embedded_y = torch.stack([self.audio_embedding[k](cated_y[k]) for k in range(self.args.n_codebooks)], dim=0) # [K, T, B, D]
+        embedded_y = embedded_y.sum(dim=0).transpose(1,0) # [K,T,B,D]->[T,B,D]->[B,T,D]
+        if len(mask_position) > 0:
+            embedded_y[mask_b, mask_position] = self.mask_embedding[mask_value]
 
-        # embed remember to separately embed the mask tokens
-        embedded_y = self.embed_y(cated_y, mask_position, mask_value) #BTD
-        assert embedded_y.shape[1:] == torch.Size((max(new_y_lens), self.args.d_model)), embedded_y.shape
-        
         # positional embedding
         y_input = self.audio_positional_embedding(embedded_y)
 
         # make attention mask and padding mask
-        y_padding_mask = make_pad_mask(new_y_lens).to(y.device)
+        y_padding_mask = make_pad_mask(new_y_lens).to(seq.device)
         y_attention_mask = torch.triu(torch.ones(y_input.shape[1], y_input.shape[1]), diagonal=1).bool().to(y_padding_mask.device)
-        return y_input, new_y_lens, targets, y_padding_mask, y_attention_mask, mask_position, patterns
-
-    def remove_mask(self, logits, mask_position, new_y_lens):
-        # logits: [B K S card]
-        logits_use = []
-        for i in range(len(logits)):
-            non_mask_positions = [-1] + mask_position[i] + [new_y_lens[i]]
-            non_mask_intervals = [[non_mask_positions[i]+1, non_mask_positions[i+1]] for i in range(len(non_mask_positions)-1)]
-            cur_logits_use = [logits[i, :, l:r] for l,r in non_mask_intervals]
-            logits_use.append(cur_logits_use)
-        
-        return logits_use
-    
-    def revert_pattern(self, patterns, logits_use):
-        logits_final = []
-        logit_masks = []
-        for i in range(len(logits_use)):
-            cur_logits = [
-                item.unsqueeze(0).permute(0, 3, 1, 2).contiguous() for item in logits_use[i]
-            ] # each item is of shape [1 K S card] [1 card K S]
-            cur_logits_final = [
-                cur_pattern.revert_pattern_logits(
-                item, 0, keep_only_valid_steps=False
-                )
-                for cur_pattern, item in zip(patterns[i], cur_logits)
-            ] # if input output order doesn't match, this step will give an error
-            cur_logits_final_ret = [item[0].permute(0,2,3,1).squeeze(0) for item in cur_logits_final] # each element is of shape [K,T,card]
-            logits_final.append(cur_logits_final_ret)
-            logit_masks.append([item[2] for item in cur_logits_final])
-
-        return logits_final, logit_masks
+        return y_input, new_y_lens, targets, y_padding_mask, y_attention_mask, logits_index
 
     def dec_forward(
             self, 
@@ -414,60 +363,67 @@ class VoiceCraft(
             y_attention_mask,
             y_padding_mask,
             past=None,
-            last_3_tokens=False
+            last_n_tokens=1
         ):
-            x_attn_mask = F.pad(
-                x_attention_mask,
-                (0, new_y_lens.max()),
-                value=True,
-            ) # x attn to all x, doesn't attn to any y, this follow figure 3 of the valle paper
-            y_attn_mask = F.pad(
-                y_attention_mask,
-                (x_lens.max(), 0), # y is padded at the front
-                value=False,
-            ) # y attn to all x, for y itself use lower triangle mask to ensure autoregressive
-            xy_attn_mask = torch.concat([x_attn_mask, y_attn_mask], dim=0)
-
-            # merge key padding and attention masks
-            bsz, src_len = x_input.shape[0], x_lens.max() + new_y_lens.max()
-            xy_padding_mask = torch.concat([x_padding_mask, y_padding_mask], dim=1)
-            _xy_padding_mask = (
-                xy_padding_mask.view(bsz, 1, 1, src_len)
-                .expand(-1, self.args.nhead, -1, -1)
-                .reshape(bsz * self.args.nhead, 1, src_len)
-            )
-            # Check shapes and resize+broadcast as necessary
-            if xy_attn_mask.shape != _xy_padding_mask.shape:
-                assert xy_attn_mask.ndim + 1 == _xy_padding_mask.ndim, f"xy_attn_mask.shape: {xy_attn_mask.shape}, _xy_padding_mask: {_xy_padding_mask.shape}"
-                xy_attn_mask = xy_attn_mask.unsqueeze(0).repeat(_xy_padding_mask.shape[0], 1, 1)  # Example approach
-            xy_attn_mask = xy_attn_mask.logical_or(_xy_padding_mask)
-
-            new_attn_mask = torch.zeros_like(xy_attn_mask)
-            new_attn_mask.masked_fill_(xy_attn_mask, float("-inf"))
-            xy_attn_mask = new_attn_mask
-
-            xy_input = torch.cat([x_input, y_input], dim=1)
+            incremental = past is not None and past.ndim > 3 # uses kvcache, only need to pass the last tokens
+            n_new = last_n_tokens # more than one new token: span transitions in editing, or scoring draft frames in speculative decoding
+            with profile_section("mask"):
+                bsz, src_len = x_input.shape[0], x_lens.max() + new_y_lens.max()
+                if incremental:
+                    # only the rows of the new tokens are needed: they attend to all of x, and to y up to themselves.
+                    # same values as the rows of the full mask below, without building the [src_len, src_len] mask every step
+                    y_len = new_y_lens.max()
+                    y_pos = torch.arange(y_len - n_new, y_len, device=y_input.device)
+                    y_attn_mask = torch.arange(y_len, device=y_input.device).unsqueeze(0) > y_pos.unsqueeze(1) # [n_new, y_len]
+                    xy_attn_mask = F.pad(y_attn_mask, (x_lens.max(), 0), value=False) # [n_new, src_len]
+                else:
+                    x_attn_mask = F.pad(
+                        x_attention_mask,
+                        (0, new_y_lens.max()),
+                        value=True,
+                    ) # x attn to all x, doesn't attn to any y, this follow figure 3 of the valle paper
+                    y_attn_mask = F.pad(
+                        y_attention_mask,
+                        (x_lens.max(), 0), # y is padded at the front
+                        value=False,
+                    ) # y attn to all x, for y itself use lower triangle mask to ensure autoregressive
+                    xy_attn_mask = torch.concat([x_attn_mask, y_attn_mask], dim=0)
+
+                # merge key padding and attention masks
+                xy_padding_mask = torch.concat([x_padding_mask, y_padding_mask], dim=1)
+                _xy_padding_mask = (
+                    xy_padding_mask.view(bsz, 1, 1, src_len)
+                    .expand(-1, self.args.nhead, -1, -1)
+                    .reshape(bsz * self.args.nhead, 1, src_len)
+                )
+                # Check shapes and resize+broadcast as necessary
+                if xy_attn_mask.shape != _xy_padding_mask.shape:
+                    assert xy_attn_mask.ndim + 1 == _xy_padding_mask.ndim, f"xy_attn_mask.shape: {xy_attn_mask.shape}, _xy_padding_mask: {_xy_padding_mask.shape}"
+                    xy_attn_mask = xy_attn_mask.unsqueeze(0).repeat(_xy_padding_mask.shape[0], 1, 1)  # Example approach
+                xy_attn_mask = xy_attn_mask.logical_or(_xy_padding_mask)
+
+                new_attn_mask = torch.zeros_like(xy_attn_mask)
+                new_attn_mask.masked_fill_(xy_attn_mask, float("-inf"))
+                xy_attn_mask = new_attn_mask
 
             if past == None: # do not use kvcache
+                xy_input = torch.cat([x_input, y_input], dim=1)
                 out, _ =  self.decoder((xy_input, None), mask=xy_attn_mask)
                 return out[:, x_lens.max():], None
             else: # use kvcache
-                if past.ndim > 3: # uses kvcache, only need to pass the last tokens, this doesn't work with multi-span speech editing yet
-                    if last_3_tokens:
-                        xy_input = xy_input[:, -3:]
-                        xy_attn_mask = xy_attn_mask[:, -3:]
-                    else:
-                        xy_input = xy_input[:, -1:]
-                        xy_attn_mask = xy_attn_mask[:, -1:]
+                if incremental: # the keys and values of everything before the new tokens are in past
+                    xy_input = y_input[:, -n_new:]
+                else:
+                    xy_input = torch.cat([x_input, y_input], dim=1)
 
                 out, present =  self.decoder((xy_input, None), mask=xy_attn_mask, past=past)
                 if isinstance(out, tuple): # get rid of stage_embedding
                     out = out[0]
 
-                if out.shape[1] > x_lens.max(): # the first pass, not kvcache yet
-                    return out[:, x_lens.max():], present
-                else: # used kvcache
+                if incremental: # used kvcache, out only covers the newly passed tokens
                     return out, present
+                else: # the first pass, not kvcache yet
+                    return out[:, x_lens.max():], present
 
     def forward(self, batch):
         """
@@ -498,7 +454,14 @@ class VoiceCraft(
         x_attention_mask = torch.triu(torch.ones(x.shape[1], x.shape[1]), diagonal=1).bool().to(x_padding_mask.device)
         x_input = self.text_embedding(x)
         x_input = self.text_positional_embedding(x_input)
-        y_input, new_y_lens, targets, y_padding_mask, y_attention_mask, mask_position, patterns = self.prepare_input_target(y, y_lens)
+        if "y_seq" in batch: # built by the dataloader workers, padded per sample
+            new_y_lens = batch["y_seq_lens"]
+            seq = batch["y_seq"][:, :, :new_y_lens.max()]
+            frame_b, frame_pos = (batch["frame_pos"] >= 0).nonzero(as_tuple=True)
+            mask_b, mask_i = (batch["mask_position"] >= 0).nonzero(as_tuple=True)
+            y_input, new_y_lens, targets, y_padding_mask, y_attention_mask, logits_index = self.embed_input_target(seq, new_y_lens, frame_b, batch["frame_pos"][frame_b, frame_pos], mask_b, batch["mask_position"][mask_b, mask_i], batch["mask_value"][mask_b, mask_i])
+        else:
+            y_input, new_y_lens, targets, y_padding_mask, y_attention_mask, logits_index = self.prepare_input_target(y, y_lens)
         y_out = self.dec_forward(
                     x_input, 
                     x_lens,
@@ -513,25 +476,9 @@ class VoiceCraft(
         assert y_out.shape == y_input.shape, f"y_out.shape: {y_out.shape}, y_input.shape: {y_input.shape}" # [B S D]
         
         logits = torch.stack([self.predict_layer[i](y_out) for i in range(self.args.n_codebooks)], dim=1) # [B K S card]
-        # take out the mask token (using mask_position and new_y_lens) and revert (using function provided by self.pattern)
         assert logits.shape[1] == self.args.n_codebooks and logits.shape[3] == self.n_audio_tokens[0], logits.shape
-
-        logits_use = self.remove_mask(logits, mask_position, new_y_lens)
-        
-        # revert the pattern shift for each logits section in each sample
-        logits_final, logit_masks = self.revert_pattern(patterns, logits_use)
-        assert logits_final[0][0].shape[0] == self.args.n_codebooks and logits_final[0][0].shape[2] == self.n_audio_tokens[0], f"it is: {logits_final[0][0].shape}, but should be [K, T, card]"
-        # testing
-        sample_to_test = 0
-        assert len(logits_final[sample_to_test]) == len(targets[sample_to_test]), f"{len(logits_final[sample_to_test])}, {len(targets[sample_to_test])}"
-        temp = sum([logits_final[sample_to_test][i].shape[:-1] != targets[sample_to_test][i].shape for i in range(len(targets[sample_to_test]))])
-        assert temp == 0, f"none equal positions: {temp}, total number of elements: {len(targets[sample_to_test])}"
-
-        logit_masked = sum([(item==False).any() for cur_mask in logit_masks for item in cur_mask])
-        assert logit_masked == 0, logit_masks
-
-        logits = torch.cat([torch.cat(item, dim=1) for item in logits_final], dim=1) # [K, T1+T2+T3+..., card]
-        targets = torch.cat([torch.cat(item, dim=1) for item in targets], dim=1) # [K, T1+T2+T3+...]
+        # take the logits of the frames of all sections (i.e. without the mask tokens, and with the pattern shift reverted)
+        logits = logits[logits_index] # [K, T1+T2+T3+..., card]
         assert targets.shape[0] == logits.shape[0], f"{targets.shape}, {logits.shape}"
         loss = []
         ntokens = []
@@ -570,6 +517,7 @@ class VoiceCraft(
         stop_repetition: int=-1,
         kvcache: int=1,
         silence_tokens: list[int]=[1388,1898,131],
+        generator: Optional[torch.Generator]=None,
     ) -> torch.Tensor:
         """
         Args:
@@ -596,6 +544,8 @@ class VoiceCraft(
             by inspecting the validation set, get a few tokens that indeed repeat a significant amount of time, and exclude those tokens from prevent repetition
           ultimate_stop_repetition (`optional`) int
             no matter that token it is, stop repetition once after this number
+          generator: (`optional`) torch.Generator
+            Source of randomness for sampling, on the same device as the model. Pass a seeded generator for reproducible outputs.
         """
         assert x.ndim == 2, x.shape
         assert x_lens.ndim == 1, x_lens.shape
@@ -712,8 +662,8 @@ class VoiceCraft(
         # prepare the cache placeholder
         # n_layers, 2, bsz, num_heads, src_len, head_dim
         past = torch.ones([self.args.num_decoder_layers, 2, x.shape[0]], device=x.device, dtype=torch.float32) if kvcache else None
-        # handle multi-span kv-cache
-        new_masked_span = False
+        # number of embeddings appended in the last step, 3 at a span transition (last token, mask token, empty token), these are passed to the decoder when using kvcache
+        n_new = 1
         
         def sample_helper(n_eog, logits, codebook_eog, top_k, top_p, temperature, prev_token, consec_silence_count, stop_repetition, silence_tokens, cur_num_gen):
             if n_eog == 0:
@@ -734,13 +684,13 @@ class VoiceCraft(
                         # print(logit)
                         # print(logit.shape)
                         cur_sample = topk_sampling(
-                            logit.unsqueeze(0), top_k=top_k, top_p=top_p, temperature=temperature
+                            logit.unsqueeze(0), top_k=top_k, top_p=top_p, temperature=temperature, generator=generator
                         ) # [1, 1]
                         samples_list.append(cur_sample)
                     samples = torch.cat(samples_list, dim=0) # [K, 1]
                 else:
                     samples = topk_sampling(
-                            logits_adjust, top_k=top_k, top_p=top_p, temperature=temperature
+                            logits_adjust, top_k=top_k, top_p=top_p, temperature=temperature, generator=generator
                         ) # [K, 1]
                 assert samples.shape == torch.Size((self.args.n_codebooks, 1)), f"samples.shape: {samples.shape}"
                 if cur_num_gen < self.args.n_codebooks-1:
@@ -772,13 +722,13 @@ class VoiceCraft(
                     samples_list= []
                     for logit in logits_adjust:
                         cur_sample = topk_sampling(
-                            logit.unsqueeze(0), top_k=top_k, top_p=top_p, temperature=temperature
+                            logit.unsqueeze(0), top_k=top_k, top_p=top_p, temperature=temperature, generator=generator
                         ) # [1, 1]
                         samples_list.append(cur_sample)
                     samples = torch.cat(samples_list, dim=0) # [K, 1]
                 else:
                     samples = topk_sampling(
-                            logits_adjust, top_k=top_k, top_p=top_p, temperature=temperature
+                            logits_adjust, top_k=top_k, top_p=top_p, temperature=temperature, generator=generator
                         ) # [K, 1]
                 for jj in range(n_eog):
                     samples[jj, 0] = self.args.empty_token
@@ -786,6 +736,7 @@ class VoiceCraft(
                 codebook_eog[n_eog] = True
                 return samples, codebook_eog, prev_token, consec_silence_count
 
+        stime, prefill_sec, n_steps = time.time(), None, 0
         while True:
             y_out, present = self.dec_forward(
                                     x_input, 
@@ -797,10 +748,8 @@ class VoiceCraft(
                                     y_attention_mask,
                                     y_padding_mask,
                                     past=past,
-                                    last_3_tokens = new_masked_span
+                                    last_n_tokens = n_new
                                     )
-            if new_masked_span:
-                new_masked_span = False
 
             if past != None:
                 past = torch.cat([past, present.to(past.dtype)], dim=-2) if past.ndim > 3 else present.to(past.dtype)
@@ -817,7 +766,11 @@ class VoiceCraft(
                 for jj in range(self.args.n_codebooks):
                     logits[jj][self.args.eos] = -10000.
             # need to use a helper function to hand different n_eog cases
-            samples, codebook_eog, prev_token, consec_silence_count = sample_helper(n_eog, logits, codebook_eog, top_k, top_p, temperature, prev_token, consec_silence_count, stop_repetition, silence_tokens, cur_num_gen)
+            with profile_section("sample"):
+                samples, codebook_eog, prev_token, consec_silence_count = sample_helper(n_eog, logits, codebook_eog, top_k, top_p, temperature, prev_token, consec_silence_count, stop_repetition, silence_tokens, cur_num_gen)
+            n_steps += 1
+            if prefill_sec is None:
+                prefill_sec = time.time() - stime
             cur_num_gen += 1
             cur_generated.append(samples.squeeze(-1)) # [K,1] -> [K]
             # get samples_emb
@@ -853,19 +806,17 @@ class VoiceCraft(
                     prev_token = None
                     ##################### silence repetition handling #####################
                     ##################### silence repetition handling #####################
-
-                    # handling kv-caching for multi-span editing
-                    new_masked_span = True
                 else:
                     break
             else:
                 assert samples_emb.shape == torch.Size((1,1,self.args.d_model)), f"samples_emb.shape: {samples_emb.shape}"
+            n_new = samples_emb.shape[1]
 
             embedded_y = torch.cat([embedded_y, samples_emb], dim=1)
             # positional embedding
             y_input = self.audio_positional_embedding(embedded_y) # [B T D]
-            # make attention mask and padding mask
-            y_attention_mask = torch.triu(torch.ones(y_input.shape[1], y_input.shape[1]), diagonal=1).bool().to(y.device)
+            # make attention mask and padding mask, with kvcache dec_forward only builds the rows of the new tokens
+            y_attention_mask = torch.triu(torch.ones(y_input.shape[1], y_input.shape[1]), diagonal=1).bool().to(y.device) if past is None else None
             new_y_lens = torch.LongTensor([y_input.shape[1]]).to(y.device)
             y_padding_mask = torch.full((1,new_y_lens[0]), False).to(y.device)
         
@@ -903,6 +854,8 @@ class VoiceCraft(
         if self.args.special_first:
             res = res - int(self.args.n_special)
 
+        self._set_decode_stats(stime, prefill_sec, n_steps, past)
+        self.last_decode_stats["span_lens"] = [item - self.args.n_codebooks for item in num_gen] # frames generated for each mask span, in the order of mask_interval
         return res
 
     def inference_tts(
@@ -916,6 +869,7 @@ class VoiceCraft(
         stop_repetition: int=3,
         kvcache: int=1,
         silence_tokens: list[int]=[1388,1898,131],
+        generator: Optional[torch.Generator]=None,
         *kargs
     ) -> torch.Tensor:
         """
@@ -934,6 +888,8 @@ class VoiceCraft(
             For Neucleus sampling
           temperature: (`optional`) float
             The value used to module the next token probabilities. Must be strictly positive. Default to 1.0.
+          generator: (`optional`) torch.Generator
+            Source of randomness for sampling, on the same device as the model. Pass a seeded generator for reproducible outputs.
         """
         eog_inference = self.args.eos if self.args.eos>0 else self.args.eog
         assert x.ndim == 2, x.shape
@@ -1031,7 +987,7 @@ class VoiceCraft(
                         logits_adjust[0, prev_token] = logits_adjust[0, prev_token] / (consec_silence_count - (stop_repetition-1))
                 ##################### silence repetition handling #####################
                 samples = topk_sampling(
-                        logits_adjust, top_k=top_k, top_p=top_p, temperature=temperature
+                        logits_adjust, top_k=top_k, top_p=top_p, temperature=temperature, generator=generator
                     ) # [K, 1]
                 assert samples.shape == torch.Size((self.args.n_codebooks, 1)), f"samples.shape: {samples.shape}"
                 if cur_num_gen < self.args.n_codebooks-1:
@@ -1058,31 +1014,41 @@ class VoiceCraft(
                     logits_adjust[jj][eog_inference] = -10000
                     logits_adjust[jj][self.args.empty_token] = -10000
                 samples = topk_sampling(
-                        logits_adjust, top_k=top_k, top_p=top_p, temperature=temperature
+                        logits_adjust, top_k=top_k, top_p=top_p, temperature=temperature, generator=generator
                     ) # [K, 1]
                 for jj in range(n_eog):
                     samples[jj, 0] = self.args.empty_token
                 samples[n_eog, 0] = eog_inference
                 codebook_eog[n_eog] = True
                 return samples, codebook_eog, prev_token, consec_silence_count
+        decode_step = self.decode_step if kvcache else None
+        if decode_step is not None:
+            decode_step.reset()
+        stime, prefill_sec, n_steps = time.time(), None, 0
         while True:
-            y_out, present = self.dec_forward(
-                            x_input, 
-                            x_lens,
-                            x_attention_mask,
-                            x_padding_mask,
-                            y_input,
-                            new_y_lens,
-                            y_attention_mask,
-                            y_padding_mask,
-                            past=past
-                        )
-            if past != None:
-                past = torch.cat([past, present.to(past.dtype)], dim=-2) if past.ndim > 3 else present.to(past.dtype)
-
-
-            y_out = y_out[:, -1:] # only take the last token
-            logits = torch.stack([self.predict_layer[i](y_out) for i in range(self.args.n_codebooks)], dim=1) # [B K S card], B==S==1, so [1 K 1 card]
+            if decode_step is not None and decode_step.started:
+                # compiled single step, the kv cache is kept inside decode_step
+                logits = decode_step(y_input[:, -1:]) # [1 K 1 card]
+            else:
+                y_out, present = self.dec_forward(
+                                x_input, 
+                                x_lens,
+                                x_attention_mask,
+                                x_padding_mask,
+                                y_input,
+                                new_y_lens,
+                                y_attention_mask,
+                                y_padding_mask,
+                                past=past
+                            )
+                if past != None:
+                    past = torch.cat([past, present.to(past.dtype)], dim=-2) if past.ndim > 3 else present.to(past.dtype)
+                    if decode_step is not None:
+                        decode_step.start(past)
+
+
+                y_out = y_out[:, -1:] # only take the last token
+                logits = torch.stack([self.predict_layer[i](y_out) for i in range(self.args.n_codebooks)], dim=1) # [B K S card], B==S==1, so [1 K 1 card]
             logits = logits.squeeze(0).squeeze(1) # [K card]
             assert logits.shape == torch.Size((self.args.n_codebooks, self.n_audio_tokens[0])), f"{logits.shape}"
 
@@ -1092,7 +1058,11 @@ class VoiceCraft(
                 for jj in range(self.args.n_codebooks):
                     logits[jj][self.args.eog] = -10000.
             
-            samples, codebook_eog, prev_token, consec_silence_count = sample_helper(n_eog, logits, codebook_eog, top_k, top_p, temperature, prev_token, consec_silence_count, stop_repetition, silence_tokens, cur_num_gen)
+            with profile_section("sample"):
+                samples, codebook_eog, prev_token, consec_silence_count = sample_helper(n_eog, logits, codebook_eog, top_k, top_p, temperature, prev_token, consec_silence_count, stop_repetition, silence_tokens, cur_num_gen)
+            n_steps += 1
+            if prefill_sec is None:
+                prefill_sec = time.time() - stime
             
             cur_num_gen += 1
             cur_generated.append(samples.squeeze(-1)) # [K,1] -> [K]
@@ -1114,8 +1084,8 @@ class VoiceCraft(
             
             embedded_y = torch.cat([embedded_y, samples_emb], dim=1)
             y_input = self.audio_positional_embedding(embedded_y) # [B T D]
-            # make attention mask and padding mask
-            y_attention_mask = torch.triu(torch.ones(y_input.shape[1], y_input.shape[1]), diagonal=1).bool().to(y.device)
+            # make attention mask and padding mask, with kvcache dec_forward only builds the rows of the new tokens
+            y_attention_mask = torch.triu(torch.ones(y_input.shape[1], y_input.shape[1]), diagonal=1).bool().to(y.device) if past is None else None
             new_y_lens = torch.LongTensor([y_input.shape[1]]).to(y.device)
             y_padding_mask = torch.full((1,new_y_lens[0]), False).to(y.device)
         
@@ -1150,6 +1120,7 @@ class VoiceCraft(
             res = res - int(self.args.n_special)
             flatten_gen = flatten_gen - int(self.args.n_special)
 
+        self._set_decode_stats(stime, prefill_sec, n_steps, past, decode_step)
         return res, flatten_gen[0].unsqueeze(0)
 
 
@@ -1165,6 +1136,7 @@ class VoiceCraft(
         kvcache: int=1,
         batch_size: int=5,
         silence_tokens: list[int]=[1388,1898,131],
+        generator: Optional[torch.Generator]=None,
         *kargs
     ) -> torch.Tensor:
         """
@@ -1184,6 +1156,8 @@ class VoiceCraft(
             For Neucleus sampling
           temperature: (`optional`) float
             The value used to module the next token probabilities. Must be strictly positive. Default to 1.0.
+          generator: (`optional`) torch.Generator
+            Source of randomness for sampling, on the same device as the model. Pass a seeded generator for reproducible outputs.
         """
         eog_inference = self.args.eos if self.args.eos>0 else self.args.eog
         assert x.ndim == 2, x.shape
@@ -1266,6 +1240,9 @@ class VoiceCraft(
         # logging.info(f"number of decoder layers: {self.args.num_decoder_layers}")
         # logging.info(f"number of decoder layers: {self.args.num_decoder_layers}")
         keep = None # NOTE: this very important, tells which sample to keep
+        decode_step = self.decode_step if kvcache else None
+        if decode_step is not None:
+            decode_step.reset()
         def sample_helper(n_eog, logits, codebook_eog, top_k, top_p, temperature, prev_tokens, consec_silence_counts, stop_repetition, silence_tokens, cur_num_gen, keep):
             if n_eog == 0:
                 logits_adjust = logits
@@ -1285,7 +1262,7 @@ class VoiceCraft(
                             logits_adjust[b, 0, prev_token] = logits_adjust[b, 0, prev_token] / (consec_silence_count - (stop_repetition-1))
                 ##################### silence repetition handling #####################
                 samples = topk_sampling(
-                        logits_adjust.reshape(batch_size * self.args.n_codebooks, logits_adjust.shape[-1]), top_k=top_k, top_p=top_p, temperature=temperature
+                        logits_adjust.reshape(batch_size * self.args.n_codebooks, logits_adjust.shape[-1]), top_k=top_k, top_p=top_p, temperature=temperature, generator=generator
                     ) # [B*K, 1]
                 samples = samples.reshape(batch_size, self.args.n_codebooks, 1)
                 assert samples.shape == torch.Size((batch_size, self.args.n_codebooks, 1)), f"samples.shape: {samples.shape}"
@@ -1315,7 +1292,7 @@ class VoiceCraft(
                     logits_adjust[:,jj,eog_inference] = -10000
                     logits_adjust[:,jj,self.args.empty_token] = -10000
                 samples = topk_sampling(
-                        logits_adjust.reshape(batch_size * self.args.n_codebooks, logits_adjust.shape[-1]), top_k=top_k, top_p=top_p, temperature=temperature
+                        logits_adjust.reshape(batch_size * self.args.n_codebooks, logits_adjust.shape[-1]), top_k=top_k, top_p=top_p, temperature=temperature, generator=generator
                     ) # [B, K, 1]
                 samples = samples.reshape(batch_size, self.args.n_codebooks, 1)
                 for jj in range(n_eog):
@@ -1323,6 +1300,7 @@ class VoiceCraft(
                 samples[keep, n_eog, 0] = eog_inference
                 codebook_eog[n_eog] = True
                 return samples, codebook_eog, prev_tokens, consec_silence_counts, keep
+        stime, prefill_sec, n_steps = time.time(), None, 0
         while True:
             # if cur_num_gen > 0, should have everything in kvcache, so only pass in the last token
             # in the first generation step, we repeat each tensor to make their first dimension of length the batch size 
@@ -1343,25 +1321,31 @@ class VoiceCraft(
                 past = past.repeat(1, 1, batch_size) if past != None else None
             else:
                 assert x_input.shape[0] == batch_size and x_padding_mask.shape[0] == batch_size and y_input.shape[0] == batch_size and new_y_lens.shape[0] == batch_size, f"x_input.shape: {x_input.shape}, x_padding_mask.shape: {x_padding_mask.shape}, y_input.shape: {y_input.shape}, new_y_lens.shape: {new_y_lens.shape}"
-            y_out, present = self.dec_forward(
-                            x_input, 
-                            x_lens,
-                            x_attention_mask,
-                            x_padding_mask,
-                            y_input,
-                            new_y_lens,
-                            y_attention_mask,
-                            y_padding_mask,
-                            past=past
-                        )
-            if past != None:
-                past = torch.cat([past, present.to(past.dtype)], dim=-2) if past.ndim > 3 else present.to(past.dtype)
-
-            # if no eog emerges, y_out should have batch size of batch_size
-            if sum(codebook_eog) == 0:
-                assert y_out.shape[0] == batch_size and y_out.ndim == 3, y_out.shape
-            y_out = y_out[:, -1:] # only take the last token
-            logits = torch.stack([self.predict_layer[i](y_out) for i in range(self.args.n_codebooks)], dim=1) # [B K S card], S==1, so [B K 1 card]
+            if decode_step is not None and decode_step.started:
+                # compiled single step, the kv cache is kept inside decode_step
+                logits = decode_step(y_input[:, -1:]) # [B K 1 card]
+            else:
+                y_out, present = self.dec_forward(
+                                x_input, 
+                                x_lens,
+                                x_attention_mask,
+                                x_padding_mask,
+                                y_input,
+                                new_y_lens,
+                                y_attention_mask,
+                                y_padding_mask,
+                                past=past
+                            )
+                if past != None:
+                    past = torch.cat([past, present.to(past.dtype)], dim=-2) if past.ndim > 3 else present.to(past.dtype)
+                    if decode_step is not None:
+                        decode_step.start(past)
+
+                # if no eog emerges, y_out should have batch size of batch_size
+                if sum(codebook_eog) == 0:
+                    assert y_out.shape[0] == batch_size and y_out.ndim == 3, y_out.shape
+                y_out = y_out[:, -1:] # only take the last token
+                logits = torch.stack([self.predict_layer[i](y_out) for i in range(self.args.n_codebooks)], dim=1) # [B K S card], S==1, so [B K 1 card]
             logits = logits.squeeze(2) # [B K card]
             assert logits.shape == torch.Size((batch_size, self.args.n_codebooks, self.n_audio_tokens[0])), f"{logits.shape}"
 
@@ -1369,7 +1353,11 @@ class VoiceCraft(
             if self.args.eos > 0:
                 for jj in range(self.args.n_codebooks):
                     logits[:,jj,self.args.eog] = -10000.
-            samples, codebook_eog, prev_tokens, consec_silence_counts, keep = sample_helper(n_eog, logits, codebook_eog, top_k, top_p, temperature, prev_tokens, consec_silence_counts, stop_repetition, silence_tokens, cur_num_gen, keep)
+            with profile_section("sample"):
+                samples, codebook_eog, prev_tokens, consec_silence_counts, keep = sample_helper(n_eog, logits, codebook_eog, top_k, top_p, temperature, prev_tokens, consec_silence_counts, stop_repetition, silence_tokens, cur_num_gen, keep)
+            n_steps += 1
+            if prefill_sec is None:
+                prefill_sec = time.time() - stime
             
             cur_num_gen += 1
             if sum(codebook_eog) == 0: # no eog yet, keep batch_size of samples
@@ -1400,8 +1388,8 @@ class VoiceCraft(
             
             embedded_y = torch.cat([embedded_y, samples_emb], dim=1)
             y_input = self.audio_positional_embedding(embedded_y) # [B T D]
-            # make attention mask and padding mask
-            y_attention_mask = torch.triu(torch.ones(y_input.shape[1], y_input.shape[1]), diagonal=1).bool().to(y.device)
+            # make attention mask and padding mask, with kvcache dec_forward only builds the rows of the new tokens
+            y_attention_mask = torch.triu(torch.ones(y_input.shape[1], y_input.shape[1]), diagonal=1).bool().to(y.device) if past is None else None
             new_y_lens = torch.LongTensor([y_input.shape[1]]).to(y.device).repeat(batch_size)
             y_padding_mask = torch.full((batch_size,new_y_lens[0]), False).to(y.device)
         
@@ -1436,4 +1424,5 @@ class VoiceCraft(
             res = res - int(self.args.n_special)
             flatten_gen = flatten_gen - int(self.args.n_special)
 
+        self._set_decode_stats(stime, prefill_sec, n_steps, past, decode_step)
         return res, flatten_gen[0].unsqueeze(0)
@@ -0,0 +1,56 @@
+import logging
+import os
+
+import requests
+import torch
+
+from models import voicecraft
+
+
+# loaded models, keyed by (model_name, device), so that the target and draft models are not reloaded for every request
+loaded_models = {}
+model_cache_stats = {"hits": 0, "misses": 0}
+
+def get_model(model_name, device=None):
+    if device is None:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    if (model_name, str(device)) in loaded_models:
+        model_cache_stats["hits"] += 1
+        return loaded_models[(model_name, str(device))]
+    model_cache_stats["misses"] += 1
+
+    model_dir = f"./pretrained_models/{model_name}"
+    config_path = os.path.join(model_dir, "config.json")
+    model_file_path = os.path.join(model_dir, "model.safetensors")
+    
+    if not os.path.exists(model_dir):
+        os.makedirs(model_dir)
+    
+    try:
+        if not os.path.isfile(config_path) or not os.path.isfile(model_file_path):
+            if model_name == "VoiceCraft_830M_TTSEnhanced":
+                base_url = "https://huggingface.co/pyp1/VoiceCraft_830M_TTSEnhanced/resolve/main/"
+            elif model_name == "VoiceCraft_gigaHalfLibri330M_TTSEnhanced_max16s":
+                base_url = "https://huggingface.co/pyp1/VoiceCraft_gigaHalfLibri330M_TTSEnhanced_max16s/resolve/main/"
+            else:
+                raise ValueError(f"Unsupported model: {model_name}")
+
+            # Download config and model files
+            response = requests.get(f"{base_url}config.json")
+            response.raise_for_status()
+            with open(config_path, 'wb') as f:
+                f.write(response.content)
+
+            response = requests.get(f"{base_url}model.safetensors")
+            response.raise_for_status()
+            with open(model_file_path, 'wb') as f:
+                f.write(response.content)
+    except Exception as e:
+        logging.error(f"Failed to download model '{model_name}': {str(e)}")
+        raise
+
+    model = voicecraft.VoiceCraft.from_pretrained(model_dir)
+    model.to(device)
+    model.eval()
+    loaded_models[(model_name, str(device))] = model
+    return model
@@ -0,0 +1,98 @@
+import hashlib
+import json
+import logging
+import os
+import uuid
+
+import torch
+
+
+class ResultCache:
+    """
+    content addressed on-disk cache of generation results (codes and encoded audio), keyed by a hash of everything that determines the output.
+    the total size is capped at max_bytes, least recently used entries (by mtime, which is refreshed on every hit) are evicted first.
+    only deterministic requests (i.e. with a fixed seed) should be cached
+    """
+    def __init__(self, cache_dir, max_bytes=2 * 1024**3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._size = None # total size of the entries, computed on the first put
+        self.hits, self.misses = 0, 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(**inputs):
+        """sha256 of the inputs, bytes values (e.g. uploaded files) are hashed by content, everything else needs to be json serializable"""
+        h = hashlib.sha256()
+        for name in sorted(inputs):
+            value = inputs[name]
+            h.update(name.encode())
+            if isinstance(value, (bytes, bytearray)):
+                h.update(hashlib.sha256(value).digest())
+            else:
+                h.update(json.dumps(value, sort_keys=True).encode())
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.pt")
+
+    def get(self, key):
+        """returns a dict with codes, audio (bytes) and meta, or None"""
+        path = self._path(key)
+        if not os.path.isfile(path):
+            self.misses += 1
+            return None
+        try:
+            entry = torch.load(path, map_location="cpu")
+        except Exception as e: # e.g. a truncated file
+            logging.warning(f"dropping unreadable cache entry {path}: {e}")
+            os.remove(path)
+            self.misses += 1
+            return None
+        os.utime(path) # mark as recently used
+        self.hits += 1
+        return entry
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.
+
+    def put(self, key, codes, audio, meta=None):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary file first, so that readers never see a partial entry
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        torch.save({"codes": codes.cpu() if codes is not None else None, "audio": audio, "meta": meta or {}}, tmp_path)
+        old_size = os.path.getsize(path) if os.path.isfile(path) else 0
+        os.replace(tmp_path, path)
+        if self._size is None:
+            self._size = sum(size for _, size, _ in self._entries())
+        else:
+            self._size += os.path.getsize(path) - old_size
+        if self._size > self.max_bytes:
+            self._evict()
+
+    def _entries(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for fn in files:
+                if fn.endswith(".pt"):
+                    path = os.path.join(root, fn)
+                    try:
+                        st = os.stat(path)
+                    except FileNotFoundError: # evicted by another process
+                        continue
+                    yield path, st.st_size, st.st_mtime
+
+    def _evict(self):
+        entries = sorted(self._entries(), key=lambda e: e[2])
+        self._size = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if self._size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self._size -= size
+            logging.info(f"evicted {path} from the result cache")
@@ -0,0 +1,158 @@
+import logging
+import time
+
+import torch
+
+from data.tokenizer import crossfade, tokenize_text
+from edit_utils import get_span, get_spans
+from inference_tts_scale import timed
+
+# speech editing of a recording whose codes are already known, only the regenerated spans are decoded by the codec,
+# everything else is taken from the original waveform
+
+
+def word_times(alignment_file):
+    """(start, end) in seconds of every word of an mfa alignment csv, in order"""
+    words = []
+    with open(alignment_file, "r") as f:
+        for line in f.readlines()[1:]: # skip header
+            begin, end, label, type, *_ = line.strip().split(",")
+            if type == "words":
+                words.append((float(begin), float(end)))
+    return words
+
+
+def word_span_interval(words, s, e, editType, audio_dur, left_margin=0.08, right_margin=0.08, codec_sr=50):
+    """
+    [start, end] in codec frames of the words s to e (indices into words, from word_times), widened by the margins (in seconds).
+    for an insertion, s and e are the words around the insertion point (-1 or len(words) at the ends), and the gap between them is used
+    """
+    if editType == "insertion":
+        start = words[s][1] if s >= 0 else 0.
+        end = words[e][0] if e < len(words) else audio_dur
+    else:
+        start, end = words[s][0], words[e][1]
+    start, end = max(start - left_margin, 1/codec_sr), min(end + right_margin, audio_dur)
+    return [round(start*codec_sr), round(end*codec_sr)]
+
+
+def edit_mask_intervals(alignment_file, orig_transcript, new_transcript, audio_dur, edit_type="auto", left_margin=0.08, right_margin=0.08, codec_sr=50, max_n_spans=3):
+    """
+    the mask intervals [M,2] in codec frames for editing orig_transcript into new_transcript, from the word alignment of the recording, widened by the margins (in seconds).
+    with edit_type auto, all edits are found with edit_utils.get_spans, otherwise the transcripts have to differ by one edit of edit_type (edit_utils.get_span).
+    intervals that overlap are merged, and the closest ones are merged until there are at most max_n_spans (the number of mask embeddings of the model)
+    """
+    words = word_times(alignment_file)
+    n_words = len(orig_transcript.split())
+    if len(words) != n_words:
+        raise ValueError(f"the transcript has {n_words} words, but the alignment {alignment_file} has {len(words)}")
+    if edit_type == "auto":
+        edits = get_spans(orig_transcript, new_transcript)
+    else:
+        orig_span, new_span = get_span(orig_transcript, new_transcript, edit_type)
+        edits = [(edit_type, orig_span, new_span)]
+    if len(edits) == 0:
+        raise ValueError("the new transcript is the same as the original one")
+
+    intervals = sorted(word_span_interval(words, s, e, editType, audio_dur, left_margin, right_margin, codec_sr) for editType, (s, e), _ in edits)
+    merged = [intervals[0]]
+    for start, end in intervals[1:]:
+        if start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    while len(merged) > max_n_spans:
+        i = min(range(len(merged) - 1), key=lambda i: merged[i + 1][0] - merged[i][1])
+        merged[i:i + 2] = [[merged[i][0], merged[i + 1][1]]]
+    return torch.LongTensor(merged) # [M,2]
+
+
+def splice_spans(wav, edited_codes, spans, audio_tokenizer, context_frames=50, crossfade_sec=0.02):
+    """
+    replace the spans of the original waveform wav [C,T] by the audio of the edited codes [1,K,T'].
+    spans are (start, end, new_len) in codec frames, start and end are in the original codes and new_len is the number of frames that were generated for the span.
+    all spans are decoded in one batch, each with context_frames of the edited codes on both sides, which only serve as codec context and for the crossfades
+    """
+    hop = audio_tokenizer.hop_length
+    n_fade = int(crossfade_sec * audio_tokenizer.sample_rate)
+    windows, positions = [], []
+    shift = 0 # position of the original frames in the edited codes
+    for start, end, new_len in spans:
+        new_start, new_end = start + shift, start + shift + new_len
+        win_start, win_end = max(0, new_start - context_frames), min(edited_codes.shape[-1], new_end + context_frames)
+        windows.append(edited_codes[0, :, win_start:win_end])
+        positions.append((new_start - win_start, new_end - win_start, win_end - win_start))
+        shift += new_len - (end - start)
+    decoded = audio_tokenizer.decode_batch(windows)
+
+    out = wav[:, :spans[0][0] * hop]
+    for i, ((start, end, _), (span_start, span_end, win_len), window_wav) in enumerate(zip(spans, positions, decoded)):
+        # the new audio extends into the context by the length of the crossfade, so that the overlapping samples are at the same positions.
+        # neighbouring spans split the original audio between them for their crossfades, so that the crossfades don't overlap
+        prev_end = spans[i - 1][1] * hop if i > 0 else 0
+        next_start = spans[i + 1][0] * hop if i + 1 < len(spans) else wav.shape[-1]
+        gap_before, gap_after = start * hop - prev_end, next_start - end * hop
+        left = min(n_fade, span_start * hop, gap_before - gap_before // 2 if i > 0 else gap_before)
+        right = min(n_fade, (win_len - span_end) * hop, gap_after // 2 if i + 1 < len(spans) else gap_after)
+        new = window_wav[:, span_start * hop - left:span_end * hop + right].to(wav.device)
+        out = crossfade(out, new, left)
+        out = crossfade(out, wav[:, end * hop:next_start], right)
+    return out
+
+
+@torch.no_grad()
+def generate_edit_codes(model, model_args, text_tokens, text_tokens_lens, codes, mask_interval, device, decode_config, generator=None, timer=None):
+    """
+    run speech editing on already phonemized text and encoded audio, codes is [1,K,T] and mask_interval [M,2] in codec frames. returns the edited codes [1,K,T'],
+    the number of frames generated for each span is in model.last_decode_stats["span_lens"].
+    if timer (a metrics.StageTimer) is given, the prefill and decoding time of the model are added to it
+    """
+    stime = time.time()
+    model.last_decode_stats = None
+    edited_codes = model.inference(
+        text_tokens.to(device),
+        text_tokens_lens.to(device),
+        codes.transpose(2,1)[...,:model_args.n_codebooks].to(device), # [1,T,K]
+        mask_interval=mask_interval.unsqueeze(0).to(device),
+        top_k=decode_config['top_k'],
+        top_p=decode_config['top_p'],
+        temperature=decode_config['temperature'],
+        stop_repetition=decode_config['stop_repetition'],
+        kvcache=decode_config['kvcache'],
+        silence_tokens=eval(decode_config['silence_tokens']) if type(decode_config['silence_tokens']) == str else decode_config['silence_tokens'],
+        generator=generator,
+    ) # [1,K,T']
+    if type(edited_codes) == tuple:
+        edited_codes = edited_codes[0]
+    logging.info(f"editing inference took: {time.time() - stime:.4f} sec, edited codes: {edited_codes.shape}")
+    if timer is not None:
+        timer.add_decode_stats(model.last_decode_stats)
+    return edited_codes
+
+
+@torch.no_grad()
+def edit_one_sample(model, model_args, phn2num, text_tokenizer, audio_tokenizer, codes, wav, target_text, mask_interval, device, decode_config, generator=None, context_frames=50, crossfade_sec=0.02, timer=None):
+    """
+    regenerate the masked spans (mask_interval [M,2] in codec frames) of a recording so that it says target_text.
+    codes [1,K,T] and wav [C,T] are the codec codes and the waveform (at the codec sample rate) of the recording, they are not encoded again.
+    returns the edited waveform [1,C,T'] and the edited codes [1,K,T'].
+    timer is an optional metrics.StageTimer that the time of each stage is added to
+    """
+    # phonemize
+    with timed(timer, "phonemize"):
+        text_tokens = [phn2num[phn] for phn in
+                tokenize_text(
+                    text_tokenizer, text=target_text.strip()
+                ) if phn in phn2num
+            ]
+    text_tokens = torch.LongTensor(text_tokens).unsqueeze(0)
+    text_tokens_lens = torch.LongTensor([text_tokens.shape[-1]])
+
+    # forward
+    edited_codes = generate_edit_codes(model, model_args, text_tokens, text_tokens_lens, codes, mask_interval, device, decode_config, generator=generator, timer=timer)
+
+    # all spans are decoded in one pass
+    spans = [(start, end, new_len) for (start, end), new_len in zip(mask_interval.tolist(), model.last_decode_stats["span_lens"])]
+    with timed(timer, "codec_decode"):
+        edited_wav = splice_spans(wav, edited_codes, spans, audio_tokenizer, context_frames=context_frames, crossfade_sec=crossfade_sec)
+    return edited_wav.unsqueeze(0), edited_codes
@@ -58,6 +58,7 @@ class Trainer:
         data_start_time = time.time()
         while flag:
             self.train_sampler.set_epoch(self.progress['epoch'])
+            self.train_loader.dataset.set_epoch(self.progress['epoch'])
             for i, batch in enumerate(self.train_loader):
                 data_end_time = time.time()
                 self.model.train()
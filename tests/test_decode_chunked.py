@@ -0,0 +1,41 @@
+import pytest
+import torch
+import torch.nn as nn
+
+from data.tokenizer import AudioTokenizer
+
+
+class StubCodec(nn.Module):
+    """stands in for the encodec decoder: codes [B,K,T] -> waveform [B,1,T*hop], with an lstm, so like encodec it has no strict receptive field"""
+    def __init__(self, n_codebooks=4, card=2048, dim=32, hop=320):
+        super().__init__()
+        self.embeddings = nn.ModuleList([nn.Embedding(card, dim) for _ in range(n_codebooks)])
+        self.lstm = nn.LSTM(dim, dim, batch_first=True)
+        self.conv = nn.Conv1d(dim, dim, 7, padding=3)
+        self.upsample = nn.ConvTranspose1d(dim, 1, hop, stride=hop)
+
+    def decode(self, codes):
+        x = sum(emb(codes[:, k]) for k, emb in enumerate(self.embeddings)) # [B,T,D]
+        x = self.lstm(x)[0].transpose(1, 2)
+        return self.upsample(torch.tanh(self.conv(x)))
+
+
+def stub_tokenizer():
+    torch.manual_seed(0)
+    tokenizer = AudioTokenizer.__new__(AudioTokenizer)
+    tokenizer.codec = StubCodec().eval()
+    tokenizer.hop_length = 320
+    tokenizer._device = torch.device("cpu")
+    return tokenizer
+
+
+# T is not a multiple of the window, and for 1203 the last window is shorter than the overlap
+@pytest.mark.parametrize("T,num_workers", [(1230, 2), (1203, 1), (300, 2)])
+def test_decode_chunked_matches_full_decode(T, num_workers):
+    tokenizer = stub_tokenizer()
+    codes = torch.randint(0, 2048, (1, 4, T), generator=torch.Generator().manual_seed(1))
+    with torch.no_grad():
+        full = tokenizer.codec.decode(codes)
+    chunked = tokenizer.decode_chunked(codes, window=200, context=50, overlap=5, num_workers=num_workers)
+    assert chunked.shape == full.shape == (1, 1, T * 320)
+    assert torch.allclose(chunked, full, atol=1e-4)
@@ -0,0 +1,43 @@
+import pytest
+import torch
+
+from config import MyParser
+from models import voicecraft
+
+
+def tiny_model():
+    args = MyParser().parse_args([])
+    args.d_model, args.audio_embedding_dim, args.nhead, args.num_decoder_layers = 64, 64, 4, 2
+    torch.manual_seed(1)
+    model = voicecraft.VoiceCraft(args)
+    # random weights never stop on their own, suppress eog so that the length limit decides the number of frames
+    model.predict_layer[0][-1].bias.data[args.eog] = -1e4
+    return model.eval()
+
+
+@torch.no_grad()
+def generate(model, x, y, seed):
+    generator = torch.Generator().manual_seed(seed)
+    return model.inference_tts(x, torch.LongTensor([x.shape[1]]), y, top_k=0, top_p=0.8, temperature=1.0, stop_repetition=3, kvcache=1, generator=generator)
+
+
+# the kv cache of the first pass is about 30 long, bucket_size 16 crosses several bucket boundaries during decoding, 256 none.
+# compiling takes a while on cpu (one compile per bucket), so it's only run with the small buckets
+@pytest.mark.parametrize("bucket_size,compile", [(16, False), (256, False), (16, True)])
+def test_decode_step_matches_eager(bucket_size, compile):
+    model = tiny_model()
+    g = torch.Generator().manual_seed(0)
+    x = torch.randint(0, model.args.text_vocab_size, (1, 6), generator=g)
+    y = torch.randint(0, model.args.audio_vocab_size, (1, 20, model.args.n_codebooks), generator=g)
+    eager = generate(model, x, y, seed=3)
+
+    decode_step = model.enable_compiled_decode(bucket_size=bucket_size, compile=compile)
+    bucketed = generate(model, x, y, seed=3)
+    model.disable_compiled_decode()
+
+    assert decode_step.started
+    if bucket_size == 16:
+        assert decode_step.buf.shape[-2] > 2 * bucket_size # moved to a new bucket more than once
+    assert eager[1].shape[-1] > 20
+    for a, b in zip(eager, bucketed):
+        assert torch.equal(a, b)
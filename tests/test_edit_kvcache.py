@@ -0,0 +1,41 @@
+import pytest
+import torch
+
+from config import MyParser
+from models import voicecraft
+
+
+def tiny_model():
+    args = MyParser().parse_args([])
+    args.d_model, args.audio_embedding_dim, args.nhead, args.num_decoder_layers = 64, 64, 4, 2
+    torch.manual_seed(1)
+    model = voicecraft.VoiceCraft(args)
+    # with random weights a span ends when eog happens to be the most likely token, this makes every span end after a few frames.
+    # with much more, eog is the most likely token right away and the spans are empty
+    model.predict_layer[0][-1].bias.data[args.eog] = 0.5
+    return model.eval()
+
+
+@torch.no_grad()
+def edit(model, x, y, mask_interval, kvcache, seed):
+    generator = torch.Generator().manual_seed(seed)
+    out = model.inference(x, torch.LongTensor([x.shape[1]]), y, mask_interval=mask_interval, top_k=0, top_p=0.8, temperature=1.0, stop_repetition=3, kvcache=kvcache, generator=generator)
+    return out, model.last_decode_stats["span_lens"]
+
+
+@pytest.mark.parametrize("mask_interval", [
+    [[10, 20], [35, 40]],
+    [[5, 12], [25, 30], [50, 58]],
+])
+def test_kvcache_edit_matches_uncached(mask_interval):
+    model = tiny_model()
+    g = torch.Generator().manual_seed(0)
+    x = torch.randint(0, model.args.text_vocab_size, (1, 20), generator=g)
+    y = torch.randint(0, model.args.audio_vocab_size, (1, 64, model.args.n_codebooks), generator=g)
+    mask_interval = torch.LongTensor([mask_interval])
+    for seed in [3, 4]:
+        uncached, uncached_lens = edit(model, x, y, mask_interval, kvcache=0, seed=seed)
+        cached, cached_lens = edit(model, x, y, mask_interval, kvcache=1, seed=seed)
+        assert len(cached_lens) == mask_interval.shape[1] and all(n > 0 for n in cached_lens)
+        assert cached_lens == uncached_lens
+        assert torch.equal(cached, uncached)
@@ -0,0 +1,103 @@
+import pytest
+import torch
+
+from edit_utils import get_spans
+from speech_edit import edit_mask_intervals, splice_spans
+
+WORDS = "w0 w1 w2 w3 w4 w5 w6 w7 w8 w9".split()
+
+
+@pytest.fixture
+def alignment_file(tmp_path):
+    # word k is at [0.5k, 0.5k+0.4] sec., i.e. frames [25k, 25k+20] at 50 Hz
+    fn = tmp_path / "alignment.csv"
+    lines = ["Begin,End,Label,Type,Speaker"]
+    for k, word in enumerate(WORDS):
+        lines.append(f"{0.5*k:.2f},{0.5*k+0.4:.2f},{word},words,spk")
+        lines.append(f"{0.5*k:.2f},{0.5*k+0.4:.2f},AH0,phones,spk")
+    fn.write_text("\n".join(lines) + "\n")
+    return str(fn)
+
+
+def replace(words, replacements):
+    return " ".join(replacements.get(i, word) for i, word in enumerate(words))
+
+
+@pytest.mark.parametrize("orig, new, expected", [
+    ("the quick brown fox", "the slow brown fox", [("substitution", [1, 1], [1, 1])]),
+    ("quick brown fox", "a quick brown fox", [("insertion", [-1, 0], [0, 0])]),
+    ("the quick brown fox", "the quick brown fox jumps high", [("insertion", [3, 4], [4, 5])]),
+    ("the quick brown fox", "the fox", [("deletion", [1, 2], [0, 1])]),
+    ("The quick, brown fox.", "the quick brown Fox", []),
+    ("the quick brown fox jumps", "a quick fox jumps high",
+     [("substitution", [0, 0], [0, 0]), ("deletion", [2, 2], [1, 2]), ("insertion", [4, 5], [4, 4])]),
+])
+def test_get_spans(orig, new, expected):
+    assert get_spans(orig, new) == expected
+
+
+@pytest.mark.parametrize("new, expected", [
+    (replace(WORDS, {1: "x"}), [[21, 49]]),
+    ("x " + " ".join(WORDS), [[1, 4]]),
+    (" ".join(WORDS) + " x", [[241, 250]]),
+    (" ".join(WORDS[:4] + WORDS[5:]), [[96, 124]]),
+])
+def test_edit_mask_intervals(alignment_file, new, expected):
+    intervals = edit_mask_intervals(alignment_file, " ".join(WORDS), new, audio_dur=5.0)
+    assert intervals.tolist() == expected
+
+
+def test_edit_mask_intervals_merges_overlapping(alignment_file):
+    new = replace(WORDS, {1: "x", 3: "y"})
+    assert edit_mask_intervals(alignment_file, " ".join(WORDS), new, 5.0).tolist() == [[21, 49], [71, 99]]
+    # with wider margins, the two intervals overlap
+    assert edit_mask_intervals(alignment_file, " ".join(WORDS), new, 5.0, left_margin=0.35, right_margin=0.35).tolist() == [[8, 112]]
+
+
+def test_edit_mask_intervals_merges_closest(alignment_file):
+    new = replace(WORDS, {1: "a", 3: "b", 6: "c", 8: "d"})
+    # the intervals are [21, 49], [71, 99], [146, 174] and [196, 224], the gaps between them are 22, 47 and 22 frames
+    intervals = edit_mask_intervals(alignment_file, " ".join(WORDS), new, 5.0, max_n_spans=4)
+    assert intervals.tolist() == [[21, 49], [71, 99], [146, 174], [196, 224]]
+    intervals = edit_mask_intervals(alignment_file, " ".join(WORDS), new, 5.0, max_n_spans=3)
+    assert intervals.tolist() == [[21, 99], [146, 174], [196, 224]]
+    intervals = edit_mask_intervals(alignment_file, " ".join(WORDS), new, 5.0, max_n_spans=2)
+    assert intervals.tolist() == [[21, 99], [146, 224]]
+
+
+def test_edit_mask_intervals_errors(alignment_file):
+    with pytest.raises(ValueError):
+        edit_mask_intervals(alignment_file, " ".join(WORDS), " ".join(WORDS).upper() + ".", 5.0)
+    with pytest.raises(ValueError):
+        edit_mask_intervals(alignment_file, " ".join(WORDS[:-1]), " ".join(WORDS[:-2]), 5.0)
+
+
+class StubTokenizer:
+    """decodes every frame to hop samples of its code, plus 100 times the index of the window in the batch"""
+    hop_length = 4
+    sample_rate = 400
+
+    def decode_batch(self, codes):
+        return [c[:1].float().repeat_interleave(self.hop_length, dim=-1) + 100 * i for i, c in enumerate(codes)]
+
+
+@pytest.mark.parametrize("gap", [0, 1, 3, 10])
+def test_splice_spans_keeps_generated_audio(gap):
+    # the crossfades are 8 samples (2 frames) long, spans closer than two crossfades share the original audio between them
+    tokenizer, hop = StubTokenizer(), StubTokenizer.hop_length
+    spans = [(5, 7, 3), (7 + gap, 9 + gap, 2)]
+    T = 20 + gap
+    wav = torch.zeros(1, T * hop)
+    # original frames are 5 in the edited codes (and 0 in wav), generated frames are 9
+    edited = torch.full((1, 4, T + 1), 5)
+    edited[..., 5:8] = 9
+    edited[..., 8 + gap:10 + gap] = 9
+    out = splice_spans(wav, edited, spans, tokenizer, context_frames=4, crossfade_sec=0.02)
+    assert out.shape == (1, (T + 1) * hop)
+    assert torch.all(out[:, 5*hop:8*hop] == 9)
+    assert torch.all(out[:, (8 + gap)*hop:(10 + gap)*hop] == 109)
+    # outside the crossfades, the original audio is kept
+    assert torch.all(out[:, :3*hop] == 0)
+    assert torch.all(out[:, (12 + gap)*hop:] == 0)
+    if gap == 10:
+        assert torch.all(out[:, 10*hop:16*hop] == 0)
@@ -0,0 +1,116 @@
+import logging
+import os
+import random
+
+import pytest
+import torch
+
+from config import MyParser
+from data import gigaspeech
+
+PHONEMES = ["a", "b", "c", "<SIL>", "_"]
+
+
+def make_dataset_dir(root, n_segments=8):
+    """a dataset in the text layout: vocab, manifest, and one phoneme and one encodec file per segment"""
+    rng = random.Random(0)
+    for folder in ["phonemes", "encodec_16khz_4codebooks", "manifest", "exp"]:
+        os.makedirs(os.path.join(root, folder))
+    with open(os.path.join(root, "vocab.txt"), "w") as f:
+        f.write("\n".join(f"{i} {phn}" for i, phn in enumerate(PHONEMES)))
+    lines = []
+    for i in range(n_segments):
+        write_segment(root, f"seg{i}", rng)
+        lines.append(f"0\tseg{i}\t0")
+    with open(os.path.join(root, "manifest", "train.txt"), "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def write_segment(root, segment_id, rng, n_frames=None):
+    n_frames = n_frames or rng.randint(120, 400)
+    with open(os.path.join(root, "phonemes", segment_id + ".txt"), "w") as f:
+        f.write(" ".join(rng.choice(PHONEMES) for _ in range(rng.randint(5, 50))))
+    with open(os.path.join(root, "encodec_16khz_4codebooks", segment_id + ".txt"), "w") as f:
+        f.write("\n".join(" ".join(str(rng.randint(0, 2047)) for _ in range(n_frames)) for _ in range(4)))
+
+
+def make_args(root):
+    args = MyParser().parse_args([])
+    args.dataset_dir, args.exp_dir = root, os.path.join(root, "exp")
+    # segments longer than 4 sec. are cropped at random
+    args.audio_max_length = 4
+    args.dynamic_batching, args.pad_x, args.num_workers = 1, 0, 1
+    return args
+
+
+@pytest.fixture
+def dataset_dir(tmp_path):
+    make_dataset_dir(str(tmp_path))
+    return str(tmp_path)
+
+
+def sample(item):
+    return {key: item[key].tolist() for key in ["x", "y_seq", "mask_position", "mask_value"]}
+
+
+def test_getitem_depends_on_seed_epoch_and_index(dataset_dir):
+    ds = gigaspeech.dataset(make_args(dataset_dir), "train")
+    first = [sample(ds[i]) for i in range(len(ds))]
+    assert [sample(ds[i]) for i in range(len(ds))] == first
+    # another copy of the dataset, e.g. in another dataloader worker
+    assert [sample(gigaspeech.dataset(make_args(dataset_dir), "train")[i]) for i in range(len(ds))] == first
+
+    ds.set_epoch(1)
+    second = [sample(ds[i]) for i in range(len(ds))]
+    assert [sample(ds[i]) for i in range(len(ds))] == second
+    assert all(a != b for a, b in zip(first, second))
+    ds.set_epoch(0)
+    assert [sample(ds[i]) for i in range(len(ds))] == first
+
+
+def test_length_index_follows_text_files(dataset_dir, caplog):
+    caplog.set_level(logging.INFO)
+    index_fn = os.path.join(dataset_dir, "manifest", "train_lengths.tsv")
+    # seg8 is in the manifest, but its files are only added later
+    with open(os.path.join(dataset_dir, "manifest", "train.txt"), "a") as f:
+        f.write("0\tseg8\t0\n")
+
+    def load():
+        caplog.clear()
+        ds = gigaspeech.dataset(make_args(dataset_dir), "train")
+        built = [r.getMessage() for r in caplog.records if r.getMessage().startswith("building the length index")]
+        return ds, built
+
+    ds, built = load()
+    assert built == ["building the length index of 9 segments for train split..."]
+    assert [d[1] for d in ds.data] == [f"seg{i}" for i in range(8)]
+    ds, built = load()
+    assert built == []
+
+    # a file rewritten in place. the other files and the index are moved into the past, so that only the rewrite is newer than the index
+    # whatever the resolution of mtimes
+    for folder in ["phonemes", "encodec_16khz_4codebooks"]:
+        for fn in os.listdir(os.path.join(dataset_dir, folder)):
+            os.utime(os.path.join(dataset_dir, folder, fn), (0, 0))
+    index_mtime = os.path.getmtime(index_fn)
+    os.utime(index_fn, (index_mtime - 10, index_mtime - 10))
+    write_segment(dataset_dir, "seg3", random.Random(1), n_frames=150)
+    ds, built = load()
+    assert built == ["building the length index of 1 segments for train split..."]
+    assert ds.lengths_list[3] == 150
+
+    # files added with an old mtime, e.g. copied with rsync -a
+    write_segment(dataset_dir, "seg8", random.Random(2), n_frames=160)
+    for folder in ["phonemes", "encodec_16khz_4codebooks"]:
+        os.utime(os.path.join(dataset_dir, folder, "seg8.txt"), (0, 0))
+    ds, built = load()
+    assert built == ["building the length index of 1 segments for train split..."]
+    assert ds.data[-1][1] == "seg8" and ds.lengths_list[-1] == 160
+
+    # a removed file
+    os.remove(os.path.join(dataset_dir, "phonemes", "seg0.txt"))
+    ds, built = load()
+    assert built == ["building the length index of 1 segments for train split..."]
+    assert "seg0" not in [d[1] for d in ds.data]
+    ds, built = load()
+    assert built == []
@@ -0,0 +1,80 @@
+import pytest
+
+pytest.importorskip("phonemizer")
+from phonemizer.backend import EspeakBackend
+
+import data.tokenizer as tokenizer
+from data.tokenizer import PhonemeCache, TextTokenizer
+
+SENTENCES = [
+    "the quick brown fox jumps over the lazy dog.",
+    "hello, world!",
+    "the quick brown fox jumps over the lazy dog.",
+    "she sells sea shells by the sea shore",
+    "hello world",
+    "the lazy dog sleeps",
+]
+
+
+class FakeEspeak:
+    """phonemizes every word on its own, one phone per character"""
+    def __init__(self, *args, **kwargs):
+        pass
+
+    @staticmethod
+    def version():
+        return (0, 0)
+
+    def phonemize(self, text, separator=None, strip=True, njobs=1):
+        return [separator.word.join(separator.phone.join(word) for word in t.split()) for t in text]
+
+
+@pytest.fixture
+def backend_calls(monkeypatch):
+    if not EspeakBackend.is_available():
+        monkeypatch.setattr(tokenizer, "EspeakBackend", FakeEspeak)
+    # the texts that reach the backend
+    calls = []
+    backend_phonemize = TextTokenizer._backend_phonemize
+    def counting(self, text, strip):
+        calls.extend(text)
+        return backend_phonemize(self, text, strip)
+    monkeypatch.setattr(TextTokenizer, "_backend_phonemize", counting)
+    return calls
+
+
+def test_cached_and_reloaded_match_uncached(tmp_path, backend_calls):
+    expected = TextTokenizer()(SENTENCES)
+    assert [TextTokenizer()(s)[0] for s in SENTENCES] == expected
+    del backend_calls[:]
+
+    cache = PhonemeCache(str(tmp_path / "phonemes.sqlite"))
+    text_tokenizer = TextTokenizer(cache=cache)
+    assert text_tokenizer(SENTENCES) == expected
+    assert backend_calls == list(dict.fromkeys(SENTENCES))
+    assert cache.hit_rate == 0.
+    assert text_tokenizer(SENTENCES) == expected
+    assert [text_tokenizer(s)[0] for s in SENTENCES] == expected
+    assert len(backend_calls) == len(set(SENTENCES))
+    assert cache.hit_rate == pytest.approx(2 / 3)
+
+    reloaded = PhonemeCache(str(tmp_path / "phonemes.sqlite"))
+    assert TextTokenizer(cache=reloaded)(SENTENCES) == expected
+    assert len(backend_calls) == len(set(SENTENCES))
+    assert reloaded.hit_rate == 1.
+    assert reloaded.info()["size"] == len(set(SENTENCES))
+
+
+def test_word_level_cache_matches_uncached(backend_calls):
+    expected = TextTokenizer()(SENTENCES)
+    del backend_calls[:]
+
+    text_tokenizer = TextTokenizer(cache=PhonemeCache(), word_level_cache=True)
+    assert text_tokenizer(SENTENCES) == expected
+    words = [word for sentence in SENTENCES for word in sentence.split()]
+    assert backend_calls == list(dict.fromkeys(words))
+    # a new sentence of known words needs no backend call
+    expected = TextTokenizer()("the lazy fox")
+    n_calls = len(backend_calls)
+    assert text_tokenizer("the lazy fox") == expected
+    assert len(backend_calls) == n_calls
@@ -0,0 +1,150 @@
+import os
+import shutil
+import subprocess
+import sys
+import textwrap
+import wave
+
+import numpy as np
+import pytest
+
+from data.token_store import TokenStore
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(REPO, "data", "phonemize_encodec_encode_hf.py")
+
+# loaded in the script and in its spawned dataloader workers: a phonemizer that needs no espeak, a torchaudio.load that needs no
+# torchcodec, and an encodec stand-in that kills the process after CRASH_AFTER encode calls, and runs out of memory (and logs it to OOM_LOG)
+# for batches of more than OOM_LIMIT samples
+SITECUSTOMIZE = """
+import sys, wave
+import numpy as np, torch, torchaudio
+sys.path.insert(0, {data_dir!r})
+import tokenizer
+
+class FakePhonemizer:
+    def __init__(self, n_workers=1):
+        pass
+    def __call__(self, texts):
+        return [list(text.replace(" ", "_")) for text in texts]
+    def close(self):
+        pass
+tokenizer.BatchPhonemizer = FakePhonemizer
+
+def load(fn):
+    with wave.open(fn) as w:
+        audio = np.frombuffer(w.readframes(w.getnframes()), dtype=np.int16).astype(np.float32) / 32768
+        return torch.from_numpy(audio)[None], w.getframerate()
+torchaudio.load = load
+"""
+
+SOLVERS = """
+import os, torch
+calls = [0]
+class Model(torch.nn.Module):
+    num_codebooks = 4
+    def encode(self, wav):
+        calls[0] += 1
+        if calls[0] > int(os.environ.get("CRASH_AFTER", "1000000")):
+            os._exit(1)
+        if wav.numel() > int(os.environ.get("OOM_LIMIT", "1000000000000")):
+            with open(os.environ["OOM_LOG"], "a") as f:
+                f.write(f"{wav.shape[0]}x{wav.shape[-1]}\\n")
+            raise torch.cuda.OutOfMemoryError("stub")
+        T = -(-wav.shape[-1] // 320)
+        frames = torch.nn.functional.pad(wav, (0, T*320 - wav.shape[-1]))[:, 0].reshape(wav.shape[0], T, 320)
+        codes = (frames.abs().sum(-1) * 1000).long() % 2048
+        return [torch.stack([(codes + k) % 2048 for k in range(4)], 1)]
+class CompressionSolver:
+    @staticmethod
+    def model_from_checkpoint(path):
+        return Model()
+"""
+
+
+def make_local_dir(root):
+    rng = np.random.RandomState(1)
+    words = "the quick brown fox jumps over a lazy dog again and then".split()
+    for split, n in [("validation", 5), ("train", 23)]:
+        os.makedirs(os.path.join(root, split))
+        for i in range(n):
+            sr = int(rng.choice([16000, 24000]))
+            audio = (rng.randn(int(sr * rng.uniform(0.1, 4))) * 3000).astype(np.int16)
+            with wave.open(os.path.join(root, split, f"{split}{i:03d}.wav"), "wb") as w:
+                w.setnchannels(1)
+                w.setsampwidth(2)
+                w.setframerate(sr)
+                w.writeframes(audio.tobytes())
+            with open(os.path.join(root, split, f"{split}{i:03d}.txt"), "w") as f:
+                f.write(" ".join(rng.choice(words, rng.randint(2, 10))))
+
+
+def run(tmp_path, save_dir, crash_after=None, oom_limit=None, extra_args=()):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([str(tmp_path / "stubs"), os.environ.get("PYTHONPATH", "")]))
+    for name in ["CRASH_AFTER", "OOM_LIMIT", "OOM_LOG"]:
+        env.pop(name, None)
+    if crash_after is not None:
+        env["CRASH_AFTER"] = str(crash_after)
+    if oom_limit is not None:
+        env["OOM_LIMIT"], env["OOM_LOG"] = str(oom_limit), str(tmp_path / "oom.log")
+    cmd = [sys.executable, SCRIPT, "--local_dir", str(tmp_path / "local"), "--save_dir", str(save_dir), "--device", "cpu",
+           "--n_workers", "1", "--phonemize_workers", "1", "--mega_batch_size", "4", "--batch_size", "3", *extra_args]
+    return subprocess.run(cmd, env=env, cwd=str(tmp_path), capture_output=True, text=True, timeout=600)
+
+
+def read_output(save_dir):
+    root = os.path.join(save_dir, "xs")
+    out = {}
+    for fn in sorted(os.listdir(os.path.join(root, "manifest"))):
+        with open(os.path.join(root, "manifest", fn)) as f:
+            out[fn] = sorted(f.read().splitlines())
+    with open(os.path.join(root, "vocab.txt")) as f:
+        out["vocab"] = f.read()
+    store = TokenStore(os.path.join(root, "token_store"))
+    for kind in ["codes", "phonemes"]:
+        array = getattr(store, kind)
+        out[kind] = {segment_id: array.get(segment_id).tolist() for segment_id in array.index}
+    return out
+
+
+@pytest.fixture
+def prep_dir(tmp_path):
+    pytest.importorskip("phonemizer")
+    stubs = tmp_path / "stubs"
+    (stubs / "audiocraft").mkdir(parents=True)
+    (stubs / "sitecustomize.py").write_text(SITECUSTOMIZE.format(data_dir=os.path.join(REPO, "data")))
+    (stubs / "audiocraft" / "__init__.py").write_text("")
+    (stubs / "audiocraft" / "solvers.py").write_text(SOLVERS)
+    make_local_dir(str(tmp_path / "local"))
+    return tmp_path
+
+
+def test_resumed_run_matches_clean_run(prep_dir):
+    clean = run(prep_dir, prep_dir / "clean")
+    assert clean.returncode == 0, clean.stderr
+    expected = read_output(str(prep_dir / "clean"))
+    assert len(expected["codes"]) == 28 and len(expected["phonemes"]) == 28
+
+    crashed = run(prep_dir, prep_dir / "resumed", crash_after=4)
+    assert crashed.returncode != 0
+    with open(prep_dir / "resumed" / "xs" / "journal" / "encode.txt") as f:
+        n_done = len(f.read().splitlines())
+    assert 0 < n_done < 28, textwrap.shorten(crashed.stderr, 2000)
+
+    resumed = run(prep_dir, prep_dir / "resumed")
+    assert resumed.returncode == 0, resumed.stderr
+    assert read_output(str(prep_dir / "resumed")) == expected
+
+
+def test_oom_resplits_queued_batches(prep_dir):
+    # one mega batch of 23 train segments, made into batches of 8, 8 and 7. the first batch runs out of memory, which halves the budget
+    # for the two batches that are queued behind it as well
+    shutil.rmtree(prep_dir / "local" / "validation")
+    extra_args = ["--mega_batch_size", "23", "--batch_size", "8"]
+    clean = run(prep_dir, prep_dir / "clean", extra_args=extra_args)
+    assert clean.returncode == 0, clean.stderr
+    oom = run(prep_dir, prep_dir / "oom", oom_limit=300000, extra_args=extra_args)
+    assert oom.returncode == 0, oom.stderr
+    with open(prep_dir / "oom.log") as f:
+        assert len(f.read().splitlines()) == 1
+    assert read_output(str(prep_dir / "oom")) == read_output(str(prep_dir / "clean"))
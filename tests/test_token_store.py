@@ -0,0 +1,43 @@
+import os
+
+import numpy as np
+
+from data.token_store import ShardedArray, ShardedArrayWriter
+
+
+def test_reopen_after_torn_write(tmp_path):
+    store_dir = str(tmp_path)
+    a = np.arange(12).reshape(3, 4)
+    with ShardedArrayWriter(store_dir, "codes", 4) as writer:
+        writer.add("a", a)
+    # a crash in the middle of the next add: part of its rows are written, its index line is not
+    with open(os.path.join(store_dir, "codes_00000.bin"), "ab") as f:
+        f.write(b"\x01" * 10)
+    with open(os.path.join(store_dir, "codes_index.tsv"), "a") as f:
+        f.write("b\t0\t")
+
+    b = np.arange(8).reshape(2, 4) + 100
+    with ShardedArrayWriter(store_dir, "codes", 4) as writer:
+        writer.add("b", b)
+
+    store = ShardedArray(store_dir, "codes", 4)
+    assert store.index["b"] == (0, 3, 2)
+    assert np.array_equal(store.get("a"), a)
+    assert np.array_equal(store.get("b"), b)
+    assert np.array_equal(store.get("b", 1), b[1:])
+
+
+def test_reopen_cuts_unindexed_shard(tmp_path):
+    # a crash right after starting a new shard leaves rows in it that nothing in the index points to
+    store_dir = str(tmp_path)
+    with ShardedArrayWriter(store_dir, "phonemes", 1, shard_bytes=4) as writer:
+        writer.add("a", np.arange(3))
+    with open(os.path.join(store_dir, "phonemes_00001.bin"), "wb") as f:
+        f.write(b"\x02" * 7)
+    with ShardedArrayWriter(store_dir, "phonemes", 1, shard_bytes=4) as writer:
+        writer.add("b", np.arange(5))
+
+    store = ShardedArray(store_dir, "phonemes", 1)
+    assert store.index["b"] == (1, 0, 5)
+    assert np.array_equal(store.get("a")[:, 0], np.arange(3))
+    assert np.array_equal(store.get("b")[:, 0], np.arange(5))
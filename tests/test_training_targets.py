@@ -0,0 +1,116 @@
+import random
+
+import pytest
+import torch
+import torch.nn.functional as F
+
+from config import MyParser
+from models import voicecraft
+from models.modules.utils import make_pad_mask
+
+
+def tiny_model(**kwargs):
+    args = MyParser().parse_args([])
+    args.d_model, args.audio_embedding_dim, args.nhead, args.num_decoder_layers = 32, 32, 4, 2
+    args.text_vocab_size, args.text_pad_token = 50, 50
+    args.mask_sample_dist, args.max_n_spans = "uniform", 3
+    for key, value in kwargs.items():
+        setattr(args, key, value)
+    torch.manual_seed(0)
+    return voicecraft.VoiceCraft(args).eval()
+
+
+def make_batch(B=6):
+    g = torch.Generator().manual_seed(1)
+    y_lens = torch.randint(60, 300, (B,), generator=g)
+    x_lens = torch.randint(5, 40, (B,), generator=g)
+    y = torch.randint(0, 2048, (B, 4, int(y_lens.max())), generator=g)
+    y[torch.arange(y.shape[-1])[None, None, :].expand(B, 4, -1) >= y_lens[:, None, None]] = 2050
+    x = torch.randint(0, 50, (B, int(x_lens.max())), generator=g)
+    return {"x": x, "x_lens": x_lens, "y": y, "y_lens": y_lens}
+
+
+def loss_from_logits(logits, targets):
+    # the loss of VoiceCraft.forward, for [K F card] logits and [K F] targets
+    ntokens = logits.shape[1]
+    return sum(F.cross_entropy(logit, target, reduction="mean") * ntokens for logit, target in zip(logits, targets))
+
+
+def reference_logits_targets(model, batch, mask_intervals, non_mask_intervals):
+    """
+    the per-sample construction the batched one replaced: rearrange -> shift -> insert_mask -> cat_y -> embed_y for the input,
+    and for every section, the logits without the mask tokens with the pattern shift reverted. returns logits [K F card] and targets [K F]
+    """
+    x, x_lens, y, y_lens = batch["x"], batch["x_lens"], batch["y"], batch["y_lens"]
+    x_padding_mask = make_pad_mask(x_lens)
+    x_attention_mask = torch.triu(torch.ones(x.shape[1], x.shape[1]), diagonal=1).bool()
+    x_input = model.text_positional_embedding(model.text_embedding(x))
+
+    rearranged_y = model.rearrange(y, non_mask_intervals, mask_intervals)
+    shifted_y, patterns = model.shift(rearranged_y)
+    inserted_y, mask_position, mask_value = model.insert_mask(shifted_y)
+    cated_y, new_y_lens = model.cat_y(inserted_y, mask_position, y_lens)
+    y_input = model.audio_positional_embedding(model.embed_y(cated_y, mask_position, mask_value))
+    y_padding_mask = make_pad_mask(new_y_lens)
+    y_attention_mask = torch.triu(torch.ones(y_input.shape[1], y_input.shape[1]), diagonal=1).bool()
+    y_out = model.dec_forward(x_input, x_lens, x_attention_mask, x_padding_mask, y_input, new_y_lens, y_attention_mask, y_padding_mask)[0]
+    logits = torch.stack([model.predict_layer[k](y_out) for k in range(model.args.n_codebooks)], dim=1) # [B K S card]
+
+    logits_final = []
+    for i in range(len(logits)):
+        bounds = [-1] + mask_position[i] + [int(new_y_lens[i])]
+        for j, pattern in enumerate(patterns[i]):
+            section = logits[i, :, bounds[j]+1:bounds[j+1]].unsqueeze(0).permute(0, 3, 1, 2) # [1 card K S]
+            reverted, _, valid = pattern.revert_pattern_logits(section, 0, keep_only_valid_steps=False)
+            assert valid.all()
+            logits_final.append(reverted.permute(0, 2, 3, 1).squeeze(0)) # [K T card]
+    targets = torch.cat([item for cur_y in rearranged_y for item in cur_y], dim=1)
+    return torch.cat(logits_final, dim=1), targets
+
+
+def batched_logits_targets(model, batch):
+    x, x_lens, y, y_lens = batch["x"], batch["x_lens"], batch["y"], batch["y_lens"]
+    x_padding_mask = make_pad_mask(x_lens)
+    x_attention_mask = torch.triu(torch.ones(x.shape[1], x.shape[1]), diagonal=1).bool()
+    x_input = model.text_positional_embedding(model.text_embedding(x))
+    y_input, new_y_lens, targets, y_padding_mask, y_attention_mask, logits_index = model.prepare_input_target(y, y_lens)
+    y_out = model.dec_forward(x_input, x_lens, x_attention_mask, x_padding_mask, y_input, new_y_lens, y_attention_mask, y_padding_mask)[0]
+    logits = torch.stack([model.predict_layer[k](y_out) for k in range(model.args.n_codebooks)], dim=1)
+    return logits[logits_index], targets
+
+
+@pytest.mark.parametrize("kwargs", [
+    dict(),
+    dict(reduced_eog=1),
+    dict(reduced_eog=1, eos=2051, n_special=4),
+    dict(shuffle_mask_embedding=1),
+])
+def test_batched_targets_match_per_sample(kwargs, monkeypatch):
+    model = tiny_model(**kwargs)
+    batch = make_batch()
+    random.seed(2)
+    torch.manual_seed(2)
+    mask_intervals, non_mask_intervals = model.prepare_mask_intervals(batch["y_lens"])
+    assert max(len(item) for item in mask_intervals) > 1
+    # both paths get the same spans, the mask embedding shuffle draws from the same random state
+    monkeypatch.setattr(model, "prepare_mask_intervals", lambda y_lens: (mask_intervals, non_mask_intervals))
+
+    random.seed(3)
+    ref_logits, ref_targets = reference_logits_targets(model, batch, mask_intervals, non_mask_intervals)
+    ref_loss = loss_from_logits(ref_logits, ref_targets)
+    ref_loss.backward()
+    ref_grads = [p.grad.clone() for p in model.parameters() if p.grad is not None]
+    model.zero_grad()
+
+    random.seed(3)
+    logits, targets = batched_logits_targets(model, batch)
+    assert torch.equal(targets, ref_targets)
+    assert torch.allclose(logits, ref_logits, atol=1e-6)
+
+    random.seed(3)
+    loss = model(batch)["loss"]
+    assert torch.allclose(loss, ref_loss, rtol=1e-6)
+    loss.backward()
+    grads = [p.grad.clone() for p in model.parameters() if p.grad is not None]
+    assert len(grads) == len(ref_grads)
+    assert all(torch.allclose(a, b, atol=1e-6) for a, b in zip(grads, ref_grads))
@@ -0,0 +1,38 @@
+import os
+
+from voice import alignment_path, codes_path, find_voice, save_voice
+
+
+def make_derived(voice_folder, audio_fn):
+    # the alignment and the codes that are computed from a saved voice
+    for fn in [alignment_path(voice_folder, audio_fn), codes_path(voice_folder, audio_fn)]:
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        with open(fn, "w") as f:
+            f.write("x")
+
+
+def test_save_voice_same_upload_keeps_alignment(tmp_path):
+    voice_folder = str(tmp_path / "spk")
+    audio_fn, _ = save_voice(voice_folder, "spk.wav", b"audio", b"hello")
+    make_derived(voice_folder, audio_fn)
+    save_voice(voice_folder, "spk.wav", b"audio", b"hello")
+    assert os.path.isfile(alignment_path(voice_folder, audio_fn))
+    assert os.path.isfile(codes_path(voice_folder, audio_fn))
+
+
+def test_save_voice_changed_upload_replaces_voice(tmp_path):
+    voice_folder = str(tmp_path / "spk")
+    audio_fn, _ = save_voice(voice_folder, "spk.wav", b"audio", b"hello")
+    make_derived(voice_folder, audio_fn)
+    audio_fn, transcript_fn = save_voice(voice_folder, "spk.wav", b"other audio", b"hello")
+    assert not os.path.isfile(alignment_path(voice_folder, audio_fn))
+    assert not os.path.isfile(codes_path(voice_folder, audio_fn))
+    with open(audio_fn, "rb") as f:
+        assert f.read() == b"other audio"
+
+    # a new transcript, and an upload with another extension
+    make_derived(voice_folder, audio_fn)
+    save_voice(voice_folder, "spk.wav", b"other audio", b"hello there")
+    assert not os.path.isfile(alignment_path(voice_folder, audio_fn))
+    mp3_fn, _ = save_voice(voice_folder, "spk.mp3", b"mp3 audio", b"hello there")
+    assert find_voice(voice_folder) == (mp3_fn, transcript_fn)
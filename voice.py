@@ -0,0 +1,147 @@
+import glob
+import logging
+import os
+import subprocess
+
+import torch
+
+from data.tokenizer import convert_audio, load_audio, tokenize_audio
+
+
+def same_content(fn, content):
+    if not os.path.isfile(fn) or os.path.getsize(fn) != len(content):
+        return False
+    with open(fn, "rb") as f:
+        return f.read() == content
+
+
+def save_voice(voice_folder, audio_filename, audio_content, transcript_content):
+    """
+    save an uploaded voice (audio and transcript bytes) to voice_folder, returns the paths of the saved audio and transcript.
+    if a voice of the same name was saved before with a different audio or transcript, its alignment and codes are deleted, so that they are computed again
+    """
+    os.makedirs(voice_folder, exist_ok=True)
+    logging.debug(f"Created voice folder: {voice_folder}")
+
+    audio_fn = os.path.join(voice_folder, audio_filename)
+    transcript_fn = os.path.join(voice_folder, f"{os.path.splitext(audio_filename)[0]}.txt")
+    if same_content(audio_fn, audio_content) and same_content(transcript_fn, transcript_content):
+        logging.debug(f"Uploaded files are the same as the saved ones: {audio_fn}, {transcript_fn}")
+        return audio_fn, transcript_fn
+    # also the audio of an earlier upload with another extension, which find_voice could pick up
+    stale_audio = [fn for fn in glob.glob(os.path.join(voice_folder, f"{glob.escape(os.path.splitext(audio_filename)[0])}.*")) if fn not in [audio_fn, transcript_fn]]
+    for fn in [alignment_path(voice_folder, audio_fn), codes_path(voice_folder, audio_fn)] + stale_audio:
+        if os.path.isfile(fn):
+            logging.info(f"Voice {audio_filename} changed, removing {fn}")
+            os.remove(fn)
+    with open(audio_fn, "wb") as f:
+        f.write(audio_content)
+    with open(transcript_fn, "wb") as f:
+        f.write(transcript_content)
+    logging.debug(f"Saved uploaded files: {audio_fn}, {transcript_fn}")
+    return audio_fn, transcript_fn
+
+
+def alignment_path(voice_folder, audio_fn):
+    return os.path.join(voice_folder, "mfa", f"{os.path.splitext(os.path.basename(audio_fn))[0]}.csv")
+
+
+def find_voice(voice_folder):
+    """
+    the audio and transcript of a voice that was saved with save_voice, returns (audio_fn, transcript_fn), or (None, None) if there is none
+    """
+    name = os.path.basename(os.path.normpath(voice_folder))
+    transcript_fn = os.path.join(voice_folder, f"{name}.txt")
+    audio_fns = [fn for fn in glob.glob(os.path.join(voice_folder, f"{name}.*")) if fn != transcript_fn]
+    if not audio_fns or not os.path.isfile(transcript_fn):
+        return None, None
+    return audio_fns[0], transcript_fn
+
+
+def codes_path(voice_folder, audio_fn):
+    return os.path.join(voice_folder, "codes", f"{os.path.splitext(os.path.basename(audio_fn))[0]}.pt")
+
+
+def encode_voice(voice_folder, audio_fn, audio_tokenizer):
+    """
+    codec codes [1,K,T] and waveform at the codec sample rate [C,T] of a saved voice.
+    the codes are cached in the voice folder, and encoded again if the audio file is newer than them
+    """
+    codes_file = codes_path(voice_folder, audio_fn)
+    if os.path.isfile(codes_file) and os.path.getmtime(codes_file) >= os.path.getmtime(audio_fn):
+        logging.info(f"Using cached codes: {codes_file}")
+        wav, sr = load_audio(audio_fn)
+        wav = convert_audio(wav, sr, audio_tokenizer.sample_rate, audio_tokenizer.channels)
+        return torch.load(codes_file, map_location="cpu"), wav
+    encoded_frames, wav = tokenize_audio(audio_tokenizer, audio_fn, return_wav=True)
+    codes = encoded_frames[0][0].cpu()
+    os.makedirs(os.path.dirname(codes_file), exist_ok=True)
+    torch.save(codes, codes_file)
+    logging.info(f"Saved codes: {codes_file}")
+    return codes, wav
+
+
+def align_voice(voice_folder, audio_fn):
+    """
+    run mfa on the voice folder if it isn't aligned yet (the audio and transcript need to be saved there), returns the path of the alignment csv
+    """
+    mfa_folder = os.path.join(voice_folder, "mfa")
+    os.makedirs(mfa_folder, exist_ok=True)
+    alignment_file = alignment_path(voice_folder, audio_fn)
+    if not os.path.isfile(alignment_file):
+        logging.info("Preparing alignment...")
+        subprocess.run(["mfa", "align", "-v", "--clean", "-j", "1", "--output_format", "csv",
+                        voice_folder, "english_us_arpa", "english_us_arpa", mfa_folder])
+        logging.info("Alignment completed")
+    else:
+        logging.info("Alignment file already exists. Skipping alignment.")
+    return alignment_file
+
+
+def prepare_prompt(voice_folder, audio_fn, transcript_fn, cut_off_sec):
+    """
+    find the last word that ends before cut_off_sec in the voice, returns the transcript up to that word and its end time in seconds.
+    raises ValueError if no such word can be found
+    """
+    alignment_file = align_voice(voice_folder, audio_fn)
+    with open(transcript_fn, "r") as f:
+        transcript_text = f.read()
+    logging.debug(f"Reading transcript file: {transcript_fn}")
+    return find_prompt(alignment_file, transcript_text, cut_off_sec)
+
+
+def find_prompt(alignment_file, transcript_text, cut_off_sec):
+    """same as prepare_prompt, for a voice that is already aligned, and a transcript that is already in memory"""
+    # Read the alignment file and find the closest end time
+    prompt_end_word = ""
+    closest_end = 0
+    with open(alignment_file, "r") as f:
+        lines = f.readlines()[1:]  # Skip header
+        for line in lines:
+            begin, end, label, type, *_ = line.strip().split(",")
+            end = float(end)
+            if end > cut_off_sec:
+                break
+            closest_end = end
+            prompt_end_word = label
+
+    logging.info(f"Identified end value closest to desired time: {closest_end} seconds")
+
+    if not prompt_end_word:
+        raise ValueError("No suitable word found within the desired time frame.")
+
+    # Extract the prompt from the transcript
+    transcript_words = transcript_text.strip().split()
+    prompt_end_idx = -1
+    for idx, word in enumerate(transcript_words):
+        if word.strip(".,!?;:") == prompt_end_word:
+            prompt_end_idx = idx
+            break
+
+    if prompt_end_idx == -1:
+        raise ValueError("Error: Prompt end word not found in the transcript.")
+
+    prompt_transcript = " ".join(transcript_words[:prompt_end_idx+1])
+
+    logging.info(f"Prompt transcript up to closest end word: {prompt_transcript}")
+    return prompt_transcript, closest_end